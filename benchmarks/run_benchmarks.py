@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmarks of PyRDM's import time, hashing, archiving and publishing. The publishing benchmarks run against stand-in Figshare and Zenodo servers
+(see servers.py) and PyRDM's local service, so no Internet connection or account is needed. All the data is generated from fixed seeds,
+so the request counts are exactly reproducible (except those of the rate limit benchmarks, which depend on the timing of the concurrent processes)
+and the timings can be compared against a previous run using --baseline. """
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_path = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(benchmarks_path, os.pardir))
+sys.path.insert(0, benchmarks_path)
+
+import pyrdm
+from pyrdm.checksum import md5sum, md5sum_many
+from pyrdm.checksum_index import INDEX_PATH
+from servers import FigshareServer, ZenodoServer
+
+_LOG = logging.getLogger(__name__)
+_HANDLER = logging.StreamHandler()
+_LOG.addHandler(_HANDLER)
+_HANDLER.setFormatter(logging.Formatter('%(message)s'))
+del(_HANDLER)
+_LOG.setLevel(logging.INFO)
+
+KiB = 1024
+MiB = 1024*1024
+
+def write_file(path, size, seed):
+   """ Write a file of 'size' bytes of pseudo-random data, which is always the same for a given seed. """
+   rng = random.Random(seed)
+   block = struct.pack("!%dI" % (MiB/4), *[rng.getrandbits(32) for i in range(MiB/4)])
+   with open(path, "wb") as f:
+      written = 0
+      while written < size:
+         # Make each block different, so that the file does not compress.
+         chunk = struct.pack("!Q", written) + block[8:]
+         chunk = chunk[:size - written]
+         f.write(chunk)
+         written += len(chunk)
+   return path
+
+def publish_data_in_process(arguments):
+   """ Publish a new dataset with a new Publisher. This is run in separate processes by benchmark_rate_limit. Returns the publication ID. """
+   from pyrdm.publisher import Publisher
+   service, parameters = arguments
+   pid, doi = Publisher(service=service, processes=1).publish_data(parameters)
+   return pid
+
+def format_size(size):
+   if(size >= MiB):
+      return "%dMiB" % (size/MiB)
+   return "%dKiB" % (size/KiB)
+
+def median(values):
+   values = sorted(values)
+   return values[len(values)//2]
+
+class Benchmarks:
+   """ Runs the benchmarks and records their results. """
+
+   def __init__(self, directory, repeat=3, latency=0.0, bandwidth=None, quick=False):
+      """ Store all the generated data in 'directory'. Each benchmark is run 'repeat' times. The stand-in servers add 'latency' seconds
+      to each request, and receive data at no more than 'bandwidth' bytes per second on each connection. """
+      self.directory = directory
+      self.repeat = repeat
+      self.latency = latency
+      self.bandwidth = bandwidth
+      self.quick = quick
+      self.results = []
+      return
+
+   def record(self, name, times, **details):
+      """ Record the times taken by each repetition of a benchmark, along with any other details (e.g. the number of requests made). """
+      result = {"name": name, "time": median(times), "min": min(times)}
+      result.update(details)
+      self.results.append(result)
+      line = "%-50s %9.4f s (min %9.4f s)" % (name, result["time"], result["min"])
+      if("throughput" in details):
+         line += " %8.1f MiB/s" % (details["throughput"]/MiB)
+      if("requests" in details):
+         line += " %5d requests" % details["requests"]
+      if("refused" in details):
+         line += " (%d refused)" % details["refused"]
+      _LOG.info(line)
+      return result
+
+   def run(self):
+      self.benchmark_import()
+      self.benchmark_hashing()
+      self.benchmark_archive()
+      if(self.quick):
+         counts, count_size = [1, 8], 64*KiB
+         sizes, size_count = [4*MiB], 2
+      else:
+         counts, count_size = [1, 16, 64], 256*KiB
+         sizes, size_count = [1*MiB, 32*MiB], 4
+      self.benchmark_listing(200 if self.quick else 2000)
+      for service in ["local", "figshare", "zenodo"]:
+         for count in counts:
+            self.benchmark_publish_data(service, count, count_size)
+         for size in sizes:
+            self.benchmark_publish_data(service, size_count, size)
+      for service in ["figshare", "zenodo"]:
+         self.benchmark_rate_limit(service, 4, 4 if self.quick else 16, 64*KiB, rate_limit=50)
+      return self.results
+
+   # -------------------------------------------
+   # Importing
+   # -------------------------------------------
+   def benchmark_import(self):
+      """ Measure the time taken to import the publisher module in a fresh interpreter (which should not import any of the service backends). 
+      Only the import itself is timed, not the start-up of the interpreter. """
+      code = "import sys, time; start = time.time(); import pyrdm.publisher; sys.stdout.write('%f' % (time.time() - start))"
+      times = []
+      # Each import takes only a few milliseconds, so it is repeated more often than the other benchmarks to get a stable median.
+      for i in range(max(self.repeat, 5)):
+         output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.join(benchmarks_path, os.pardir))
+         times.append(float(output))
+      self.record("import/pyrdm.publisher", times)
+      return
+
+   # -------------------------------------------
+   # Hashing
+   # -------------------------------------------
+   def benchmark_hashing(self):
+      """ Measure the throughput of md5sum on a single large file, and of md5sum_many on many smaller files. """
+      directory = tempfile.mkdtemp(dir=self.directory)
+      size = 16*MiB if self.quick else 128*MiB
+      path = write_file(os.path.join(directory, "large.dat"), size, seed=1)
+      times = []
+      for i in range(self.repeat):
+         start = time.time()
+         md5sum(path)
+         times.append(time.time() - start)
+      self.record("hashing/md5sum/1x%s" % format_size(size), times, throughput=size/median(times))
+
+      count, size = (16, 1*MiB) if self.quick else (64, 2*MiB)
+      files = [write_file(os.path.join(directory, "small%d.dat" % i), size, seed=i) for i in range(count)]
+      for processes in [1, None]:
+         times = []
+         for i in range(self.repeat):
+            start = time.time()
+            md5sum_many(files, processes=processes)
+            times.append(time.time() - start)
+         self.record("hashing/md5sum_many/%dx%s/processes=%s" % (count, format_size(size), processes or "auto"), times, throughput=count*size/median(times))
+      shutil.rmtree(directory)
+      return
+
+   # -------------------------------------------
+   # Archiving
+   # -------------------------------------------
+   def benchmark_archive(self):
+      """ Measure the time taken to create an archive of PyRDM's own Git repository, and to re-use a cached archive of it. """
+      try:
+         from pyrdm.git_handler import GitHandler, ARCHIVE_FORMATS, get_compressor
+         import git
+         repository = git.Repo(os.path.join(benchmarks_path, os.pardir))
+      except Exception as e:
+         _LOG.warning("Skipping the archive benchmark, since PyRDM's Git repository could not be opened (%s)." % e)
+         return
+      git_handler = GitHandler(repository.working_dir)
+      version = git_handler.get_head_version()
+      for archive_format in ["zip", "tar.gz", "tar.zst"]:
+         try:
+            get_compressor(archive_format)
+         except OSError as e:
+            _LOG.warning("Skipping the %s archive benchmark (%s)." % (archive_format, e))
+            continue
+         archive_path = os.path.join(self.directory, "archive" + ARCHIVE_FORMATS[archive_format])
+         times = []
+         for i in range(self.repeat):
+            start = time.time()
+            git_handler.archive(version, archive_path, archive_format=archive_format)
+            times.append(time.time() - start)
+         size = os.path.getsize(archive_path)
+         os.remove(archive_path)
+         self.record("archive/pyrdm" if archive_format == "zip" else "archive/pyrdm/" + archive_format, times, size=size)
+         if(archive_format == "zip"):
+            zip_size = size
+
+      archive_path = os.path.join(self.directory, "archive.zip")
+
+      # Archiving (and hashing) the same version again, using the cache of archives.
+      from pyrdm.publisher import Publisher
+      home = self.make_home(None)
+      os.environ["HOME"] = home
+      publisher = Publisher(service="local")
+      publisher.get_archive(git_handler, version, archive_path)
+      times = []
+      for i in range(self.repeat):
+         start = time.time()
+         publisher.get_archive(git_handler, version, archive_path)
+         times.append(time.time() - start)
+      shutil.rmtree(home)
+      self.record("archive/pyrdm/cached", times, size=zip_size)
+      return
+
+   # -------------------------------------------
+   # Publishing
+   # -------------------------------------------
+   def start_server(self, service, rate_limit=None):
+      if(service == "figshare"):
+         return FigshareServer(latency=self.latency, bandwidth=self.bandwidth, rate_limit=rate_limit).start()
+      elif(service == "zenodo"):
+         return ZenodoServer(latency=self.latency, bandwidth=self.bandwidth, rate_limit=rate_limit).start()
+      return None
+
+   def make_home(self, server):
+      """ Create a new home directory containing a PyRDM configuration file which points at the stand-in servers, 
+      so that every repetition starts without any cached responses, authentication records, or upload journals. """
+      home = tempfile.mkdtemp(dir=self.directory)
+      os.makedirs(os.path.join(home, ".config"))
+      with open(os.path.join(home, ".config", "pyrdm.ini"), "w") as f:
+         f.write("[general]\nname = Benchmark\naffiliation = PyRDM\n\n")
+         f.write("[figshare]\ntoken = benchmark\nbase_url = %s\n\n" % (server.url if server else ""))
+         f.write("[zenodo]\naccess_token = benchmark\napi_url = %s/api/\n\n" % (server.url if server else ""))
+         f.write("[local]\npath = %s\n" % os.path.join(home, "local"))
+      return home
+
+   def benchmark_listing(self, count, page_size=100):
+      """ Measure the time taken, and the number of requests made, to list all 'count' articles in a Figshare account,
+      fetching 'page_size' articles at a time, with and without the next page being fetched in the background. """
+      from pyrdm.publisher import Publisher
+      server = self.start_server("figshare")
+      os.environ["HOME"] = self.make_home(server)
+      try:
+         publisher = Publisher(service="figshare")
+         for i in range(count):
+            publisher.figshare.create_article(title="Benchmark (%d)" % i, description="Benchmark article", defined_type="code", tags=[], categories=[])
+         for prefetch in [False, True]:
+            times = []
+            for i in range(self.repeat):
+               server.reset_counts()
+               start = time.time()
+               listed = sum(1 for article in publisher.figshare.iter_articles(page_size=page_size, prefetch=prefetch))
+               times.append(time.time() - start)
+               assert(listed == count)
+            self.record("list/figshare/%d" % count + ("/prefetch" if prefetch else ""), times, requests=server.request_count())
+      finally:
+         server.stop()
+      return
+
+   def benchmark_publish_data(self, service, count, size):
+      """ Measure the time taken, and the number of requests made, to publish 'count' files of 'size' bytes as a new publication,
+      to publish them again without any changes, to publish them again from a fresh copy of the data (without a checksum index), 
+      and to publish them again after one of them has been modified. """
+      from pyrdm.publisher import Publisher
+      steps = ["new", "unchanged", "fresh-copy", "one-modified"]
+      times = dict((step, []) for step in steps)
+      requests = {}
+      for i in range(self.repeat):
+         server = self.start_server(service)
+         home = self.make_home(server)
+         os.environ["HOME"] = home
+         data = os.path.join(home, "data")
+         os.makedirs(data)
+         files = [write_file(os.path.join(data, "file%d.dat" % j), size, seed=j) for j in range(count)]
+         parameters = {"title": "Benchmark", "description": "Benchmark data", "files": files, "category": "Computational Physics", "tag_name": ["benchmark"]}
+         try:
+            pid = None
+            for step in steps:
+               if(step == "fresh-copy"):
+                  os.remove(os.path.expanduser(INDEX_PATH))
+               if(step == "one-modified"):
+                  with open(files[0], "ab") as f:
+                     f.write("modified")
+               if(server is not None):
+                  server.reset_counts()
+               start = time.time()
+               publisher = Publisher(service=service, processes=1)
+               pid, doi = publisher.publish_data(parameters, pid=pid)
+               times[step].append(time.time() - start)
+               if(server is not None):
+                  requests[step] = server.request_count()
+         finally:
+            if(server is not None):
+               server.stop()
+            shutil.rmtree(home)
+      for step in steps:
+         self.record("publish_data/%s/%s/%dx%s" % (service, step, count, format_size(size)), times[step], throughput=count*size/median(times[step]) if step == "new" else 0, 
+                     **({"requests": requests[step]} if step in requests else {}))
+      return
+
+   def benchmark_rate_limit(self, service, processes, count, size, rate_limit):
+      """ Measure the time taken, and the number of requests made and refused, for 'processes' processes to each publish 'count' files of 'size' bytes
+      at the same time, to a server which accepts no more than 'rate_limit' requests per second. """
+      times = []
+      requests = 0
+      refused = 0
+      for i in range(self.repeat):
+         server = self.start_server(service, rate_limit=rate_limit)
+         home = self.make_home(server)
+         os.environ["HOME"] = home
+         jobs = []
+         for j in range(processes):
+            data = os.path.join(home, "data%d" % j)
+            os.makedirs(data)
+            files = [write_file(os.path.join(data, "file%d.dat" % k), size, seed=k) for k in range(count)]
+            jobs.append((service, {"title": "Benchmark %d" % j, "description": "Benchmark data", "files": files, "category": "Computational Physics", "tag_name": ["benchmark"]}))
+         pool = multiprocessing.Pool(processes)
+         try:
+            start = time.time()
+            pids = pool.map(publish_data_in_process, jobs)
+            times.append(time.time() - start)
+            assert(None not in pids)
+            refused = server.refused
+            requests = server.request_count() - refused # The refused requests are retried, so they are not counted twice.
+         finally:
+            pool.close()
+            pool.join()
+            server.stop()
+            shutil.rmtree(home)
+      # The number of requests depends on how the processes' requests interleave (e.g. which of them find the server's responses in the shared HTTP cache), 
+      # so it is not compared against the baseline.
+      self.record("rate_limit/%s/%dx%dx%s" % (service, processes, count, format_size(size)), times, requests=requests, refused=refused, reproducible=False)
+      return
+
+def compare(results, baseline, tolerance):
+   """ Compare the results against those of a previous run. A benchmark has regressed if its median time has increased by more than
+   the fraction 'tolerance' (and by more than a millisecond), or if it makes a different number of requests (unless its request count is not reproducible). 
+   Return the number of regressions. """
+   previous = dict((r["name"], r) for r in baseline["results"])
+   regressions = 0
+   for r in results:
+      p = previous.get(r["name"])
+      if(p is None):
+         continue
+      if(r["time"] > p["time"]*(1 + tolerance) and r["time"] - p["time"] > 1e-3):
+         _LOG.warning("REGRESSION: %s took %.4f s (previously %.4f s)" % (r["name"], r["time"], p["time"]))
+         regressions += 1
+      if(r.get("reproducible", True) and r.get("requests") != p.get("requests")):
+         _LOG.warning("REGRESSION: %s made %s requests (previously %s)" % (r["name"], r.get("requests"), p.get("requests")))
+         regressions += 1
+   return regressions
+
+if(__name__ == "__main__"):
+   parser = argparse.ArgumentParser(prog="run_benchmarks", description="Benchmarks PyRDM's hashing, archiving and publishing, using stand-in Figshare and Zenodo servers.")
+   parser.add_argument("-q", "--quick", help="Use smaller data sets, e.g. for a quick check in CI.", action="store_true", default=False)
+   parser.add_argument("-r", "--repeat", help="The number of times each benchmark is run. The median time is reported.", action="store", type=int, default=3)
+   parser.add_argument("--latency", help="The latency (in seconds) added to each request by the stand-in servers.", action="store", type=float, default=0.0)
+   parser.add_argument("--bandwidth", help="The maximum rate (in MiB/s) at which each connection to the stand-in servers receives data.", action="store", type=float, default=None)
+   parser.add_argument("-o", "--output", help="Write the results to this JSON file.", action="store", type=str, default=None)
+   parser.add_argument("-b", "--baseline", help="Compare the results against those in this JSON file (written by a previous run with --output), and exit with a non-zero status if any benchmark has regressed.", action="store", type=str, default=None)
+   parser.add_argument("-t", "--tolerance", help="The fractional increase in time allowed before a benchmark is considered to have regressed. Defaults to 0.25.", action="store", type=float, default=0.25)
+   parser.add_argument("-v", "--verbose", help="Show PyRDM's log messages.", action="store_true", default=False)
+   args = parser.parse_args()
+
+   if(not args.verbose):
+      pyrdm.LOG.setLevel(logging.WARNING)
+
+   directory = tempfile.mkdtemp(prefix="pyrdm-benchmarks-")
+   home = os.environ.get("HOME")
+   try:
+      benchmarks = Benchmarks(directory, repeat=args.repeat, latency=args.latency, bandwidth=args.bandwidth*MiB if args.bandwidth else None, quick=args.quick)
+      results = benchmarks.run()
+   finally:
+      if(home is not None):
+         os.environ["HOME"] = home
+      shutil.rmtree(directory)
+
+   if(args.output is not None):
+      environment = {"python": platform.python_version(), "platform": platform.platform(), "processors": os.sysconf("SC_NPROCESSORS_ONLN")}
+      parameters = {"quick": args.quick, "repeat": args.repeat, "latency": args.latency, "bandwidth": args.bandwidth}
+      with open(args.output, "w") as f:
+         json.dump({"environment": environment, "parameters": parameters, "results": results}, f, indent=1, sort_keys=True)
+
+   if(args.baseline is not None):
+      with open(args.baseline, "r") as f:
+         regressions = compare(results, json.load(f), args.tolerance)
+      if(regressions > 0):
+         _LOG.error("%d benchmark(s) regressed." % regressions)
+         sys.exit(1)
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Stand-in Figshare (version 2) and Zenodo API servers, which run locally so that PyRDM's publishing code can be benchmarked without an Internet connection or
+an account. The servers emulate the endpoints used by PyRDM (creating articles/depositions, the Figshare part-upload flow, the Zenodo file buckets, etc),
+keep their state in memory, and count the requests they receive. A fixed latency can be added to every request, and the rate at which request bodies
+are received can be limited, to emulate a real network connection. Like the real services, the servers can also enforce a rate limit, refusing
+requests beyond it with a 429 (Too Many Requests) response. """
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from StringIO import StringIO
+from urlparse import urlparse, parse_qs
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   """ A multi-threaded HTTP server, listening on a free port on the loopback interface, which counts the requests it handles. """
+
+   daemon_threads = True
+   
+   def __init__(self, handler_class, latency=0.0, bandwidth=None, rate_limit=None, window=1.0):
+      """ Serve requests using 'handler_class'. Each response is delayed by 'latency' seconds, and request bodies are received
+      at no more than 'bandwidth' bytes per second on each connection (or as fast as possible, if 'bandwidth' is None). 
+      If 'rate_limit' is given, no more than 'rate_limit' requests are accepted in each window of 'window' seconds. """
+      BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), handler_class)
+      self.url = "http://127.0.0.1:%d" % self.server_port
+      self.latency = latency
+      self.bandwidth = bandwidth
+      self.lock = threading.RLock() # Guards the server's state and the request counts.
+      self.requests = {}
+      self.bytes_received = 0
+      self.refused = 0
+      self.rate_limit = rate_limit
+      self.window = window
+      self.window_reset = 0
+      self.window_remaining = 0
+      self.directory = tempfile.mkdtemp()
+      self.thread = None
+      return
+
+   def start(self):
+      """ Start serving requests in a background thread. """
+      self.thread = threading.Thread(target=self.serve_forever)
+      self.thread.daemon = True
+      self.thread.start()
+      return self
+
+   def stop(self):
+      """ Stop serving requests, and remove any uploaded data. """
+      self.shutdown()
+      self.server_close()
+      shutil.rmtree(self.directory, ignore_errors=True)
+      return
+
+   def record(self, route, size):
+      """ Count a request for a given route, which had a body of 'size' bytes. """
+      with self.lock:
+         self.requests[route] = self.requests.get(route, 0) + 1
+         self.bytes_received += size
+      return
+
+   def reset_counts(self):
+      """ Reset the request counts to zero. """
+      with self.lock:
+         self.requests = {}
+         self.bytes_received = 0
+         self.refused = 0
+      return
+
+   def take_token(self):
+      """ Count a request against the server's rate limit. Returns the rate limit headers to send back, and whether the request is accepted. """
+      if(self.rate_limit is None):
+         return {}, True
+      with self.lock:
+         now = time.time()
+         if(now >= self.window_reset):
+            self.window_reset = now + self.window
+            self.window_remaining = self.rate_limit
+         accepted = self.window_remaining > 0
+         if(accepted):
+            self.window_remaining -= 1
+         else:
+            self.refused += 1
+         headers = {"X-RateLimit-Limit": str(self.rate_limit), "X-RateLimit-Remaining": str(self.window_remaining), 
+                    "X-RateLimit-Reset": str(int(math.ceil(self.window_reset)))}
+         if(not accepted):
+            headers["Retry-After"] = str(int(math.ceil(self.window_reset - now)))
+         return headers, accepted
+
+   def request_count(self):
+      """ Return the total number of requests handled. """
+      with self.lock:
+         return sum(self.requests.values())
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   """ The base class of the request handlers. Each subclass lists its routes as tuples (method, path regular expression, name of the handling method).
+   The handling method is called with the request body (a file-like object) and the groups matched in the path, and returns a tuple (status, result),
+   where 'result' is sent back as JSON. """
+
+   protocol_version = "HTTP/1.1" # Keep connections alive, like the real services, so that connection pooling can be measured.
+   # Send each response in one go, without waiting for the acknowledgement of the previous packet. Otherwise, each request takes at least 40 ms over the loopback interface.
+   disable_nagle_algorithm = True
+   wbufsize = -1
+   routes = []
+   block_size = 64*1024
+
+   def log_message(self, format, *args):
+      return # Be quiet.
+
+   def handle_request(self, method):
+      time.sleep(self.server.latency)
+      url = urlparse(self.path)
+      self.query = parse_qs(url.query)
+      body = self.read_body()
+      size = body.tell()
+      body.seek(0)
+      self.extra_headers, accepted = self.server.take_token()
+      if(not accepted):
+         self.server.record("%s (refused)" % method, size)
+         self.respond(429, {"message": "Too many requests."})
+         return
+      for route_method, pattern, name in self.routes:
+         if(route_method != method):
+            continue
+         m = re.match(pattern + "$", url.path)
+         if(m is not None):
+            self.server.record("%s %s" % (method, pattern), size)
+            status, result = getattr(self, name)(body, *m.groups())
+            self.respond(status, result)
+            return
+      self.server.record("%s (unknown)" % method, size)
+      self.respond(404, {"message": "Not found: %s %s" % (method, url.path)})
+      return
+
+   def read_body(self):
+      """ Read the request body into a temporary file, at no more than the server's bandwidth. Both Content-Length and chunked bodies are supported. """
+      body = tempfile.SpooledTemporaryFile(max_size=1024*1024, dir=self.server.directory)
+      if(self.headers.get("Transfer-Encoding", "").lower() == "chunked"):
+         while True:
+            length = int(self.rfile.readline().split(";")[0].strip(), 16)
+            if(length == 0):
+               # Skip any trailers.
+               while self.rfile.readline().strip() != "":
+                  pass
+               break
+            self.copy(length, body)
+            self.rfile.readline()
+      else:
+         self.copy(int(self.headers.get("Content-Length", 0)), body)
+      return body
+
+   def copy(self, length, body):
+      while length > 0:
+         block = self.rfile.read(min(length, self.block_size))
+         if(not block):
+            break
+         body.write(block)
+         length -= len(block)
+         if(self.server.bandwidth is not None):
+            time.sleep(float(len(block))/self.server.bandwidth)
+      return
+
+   def page(self, items, size_parameter, default_size=10):
+      """ Return the page of the list 'items' given by the 'page' query parameter (numbered from 1), with the page size given by the 'size_parameter' query parameter. """
+      page = int(self.query.get("page", ["1"])[0])
+      size = int(self.query.get(size_parameter, [str(default_size)])[0])
+      return items[(page-1)*size:page*size]
+
+   def respond(self, status, result):
+      content = json.dumps(result) if result is not None else ""
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(content)))
+      for name, value in getattr(self, "extra_headers", {}).items():
+         self.send_header(name, value)
+      self.end_headers()
+      self.wfile.write(content)
+      return
+
+   def do_GET(self):
+      self.handle_request("GET")
+
+   def do_POST(self):
+      self.handle_request("POST")
+
+   def do_PUT(self):
+      self.handle_request("PUT")
+
+   def do_DELETE(self):
+      self.handle_request("DELETE")
+
+def md5_of(body):
+   """ Return the MD5 checksum of the contents of a file-like object. """
+   checksum = hashlib.md5()
+   for block in iter(lambda: body.read(1024*1024), b""):
+      checksum.update(block)
+   return checksum.hexdigest()
+
+# -------------------------------------------
+# Figshare
+# -------------------------------------------
+
+class FigshareHandler(StandInHandler):
+   """ Emulates the parts of version 2 of the Figshare API used by PyRDM, including the upload service. 
+   The server's state is stored in its 'articles' and 'uploads' dictionaries. """
+
+   routes = [("GET", "/account/articles", "list_articles"),
+             ("POST", "/account/articles", "create_article"),
+             ("GET", "/(?:account/)?articles/(\d+)", "get_article"),
+             ("PUT", "/account/articles/(\d+)", "update_article"),
+             ("DELETE", "/account/articles/(\d+)", "delete_article"),
+             ("POST", "/(?:account/)?articles/search", "search"),
+             ("POST", "/account/articles/(\d+)/reserve_doi", "reserve_doi"),
+             ("POST", "/account/articles/(\d+)/categories", "add_categories"),
+             ("PUT", "/account/articles/(\d+)/authors", "add_authors"),
+             ("POST", "/account/articles/(\d+)/publish", "publish"),
+             ("GET", "/categories", "list_categories"),
+             ("GET", "/account/articles/(\d+)/files", "list_files"),
+             ("POST", "/account/articles/(\d+)/files", "create_file"),
+             ("GET", "/account/articles/(\d+)/files/(\d+)", "get_file"),
+             ("POST", "/account/articles/(\d+)/files/(\d+)", "complete_upload"),
+             ("DELETE", "/account/articles/(\d+)/files/(\d+)", "delete_file"),
+             ("GET", "/upload/([0-9a-f]+)", "get_upload"),
+             ("PUT", "/upload/([0-9a-f]+)/(\d+)", "upload_part")]
+
+   categories = [{"id": 2, "title": "Computer Software"}, {"id": 3, "title": "Computational Physics"}, {"id": 4, "title": "Physics"}]
+
+   def article(self, article_id):
+      return self.server.articles.get(int(article_id))
+
+   def list_articles(self, body):
+      with self.server.lock:
+         articles = [dict((k, a[k]) for k in ("id", "title", "doi", "published_date")) for a in sorted(self.server.articles.values(), key=lambda a: a["id"])]
+      return 200, self.page(articles, "page_size")
+
+   def create_article(self, body):
+      details = json.load(body)
+      with self.server.lock:
+         article_id = self.server.next_id()
+         self.server.articles[article_id] = {"id": article_id, "title": details["title"], "description": details["description"], "defined_type": details["defined_type"],
+                                             "tags": details.get("tags", []), "categories": [], "authors": [], "doi": "", "is_public": False, "published_date": None, "files": {}}
+      return 201, {"location": "%s/account/articles/%d" % (self.server.url, article_id)}
+
+   def get_article(self, body, article_id):
+      with self.server.lock:
+         a = self.article(article_id)
+         if(a is None):
+            return 404, {"message": "Article not found"}
+         details = dict(a)
+         details["files"] = list(a["files"].values())
+         return 200, details
+
+   def update_article(self, body, article_id):
+      with self.server.lock:
+         self.article(article_id).update(json.load(body))
+      return 205, None
+
+   def delete_article(self, body, article_id):
+      with self.server.lock:
+         self.server.articles.pop(int(article_id), None)
+      return 204, None
+
+   def search(self, body):
+      parameters = json.load(body)
+      keyword = parameters["search_for"].lower()
+      with self.server.lock:
+         results = [{"id": a["id"], "title": a["title"], "doi": a["doi"], "tags": a["tags"]} for a in sorted(self.server.articles.values(), key=lambda a: a["id"]) if keyword in a["title"].lower()]
+      page, size = parameters.get("page", 1), parameters.get("page_size", 10)
+      return 200, results[(page-1)*size:page*size]
+
+   def reserve_doi(self, body, article_id):
+      with self.server.lock:
+         a = self.article(article_id)
+         a["doi"] = "10.5072/FK2.figshare.%d" % a["id"]
+         return 200, {"doi": a["doi"]}
+
+   def add_categories(self, body, article_id):
+      with self.server.lock:
+         self.article(article_id)["categories"] += json.load(body)["categories"]
+      return 205, None
+
+   def add_authors(self, body, article_id):
+      with self.server.lock:
+         self.article(article_id)["authors"] += json.load(body)["authors"]
+      return 205, None
+
+   def publish(self, body, article_id):
+      with self.server.lock:
+         self.article(article_id)["is_public"] = True
+         self.article(article_id)["published_date"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+      return 201, {"location": "%s/articles/%s" % (self.server.url, article_id)}
+
+   def list_categories(self, body):
+      return 200, self.categories
+
+   def list_files(self, body, article_id):
+      with self.server.lock:
+         files = sorted(self.article(article_id)["files"].values(), key=lambda f: f["id"])
+      return 200, self.page(files, "page_size")
+
+   def create_file(self, body, article_id):
+      details = json.load(body)
+      with self.server.lock:
+         file_id = self.server.next_id()
+         token = uuid.uuid4().hex
+         size = details["size"]
+         parts = []
+         for i, start in enumerate(range(0, max(size, 1), self.server.part_size)):
+            parts.append({"partNo": i + 1, "startOffset": start, "endOffset": min(start + self.server.part_size, size) - 1, "status": "PENDING", "locked": False})
+         self.server.uploads[token] = {"parts": parts, "path": os.path.join(self.server.directory, token)}
+         self.article(article_id)["files"][file_id] = {"id": file_id, "name": details["name"], "size": size, "supplied_md5": details["md5"], "computed_md5": "",
+                                                       "status": "created", "upload_url": "%s/upload/%s" % (self.server.url, token)}
+      open(self.server.uploads[token]["path"], "wb").close()
+      return 201, {"location": "%s/account/articles/%s/files/%d" % (self.server.url, article_id, file_id)}
+
+   def get_file(self, body, article_id, file_id):
+      with self.server.lock:
+         a = self.article(article_id)
+         if(a is None or int(file_id) not in a["files"]):
+            return 404, {"message": "File not found"}
+         return 200, a["files"][int(file_id)]
+
+   def complete_upload(self, body, article_id, file_id):
+      with self.server.lock:
+         f = self.article(article_id)["files"][int(file_id)]
+         upload = self.server.uploads.pop(f["upload_url"].split("/")[-1])
+      with open(upload["path"], "rb") as data:
+         computed_md5 = md5_of(data)
+      os.remove(upload["path"])
+      with self.server.lock:
+         f["computed_md5"] = computed_md5
+         f["status"] = "available"
+      return 202, None
+
+   def delete_file(self, body, article_id, file_id):
+      with self.server.lock:
+         self.article(article_id)["files"].pop(int(file_id), None)
+      return 204, None
+
+   def get_upload(self, body, token):
+      with self.server.lock:
+         upload = self.server.uploads.get(token)
+         if(upload is None):
+            return 404, {"message": "Upload not found"}
+         return 200, {"token": token, "parts": upload["parts"]}
+
+   def upload_part(self, body, token, part_number):
+      with self.server.lock:
+         upload = self.server.uploads[token]
+         part = upload["parts"][int(part_number) - 1]
+      # Each part is written to its own byte range, so that parts can be received concurrently and in any order.
+      with open(upload["path"], "r+b") as data:
+         data.seek(part["startOffset"])
+         shutil.copyfileobj(body, data)
+      with self.server.lock:
+         part["status"] = "COMPLETE"
+      return 200, None
+
+class FigshareServer(StandInServer):
+   """ A stand-in Figshare server. Files are split into parts of 'part_size' bytes for uploading. """
+
+   def __init__(self, latency=0.0, bandwidth=None, part_size=10*1024*1024, rate_limit=None):
+      StandInServer.__init__(self, FigshareHandler, latency=latency, bandwidth=bandwidth, rate_limit=rate_limit)
+      self.part_size = part_size
+      self.articles = {}
+      self.uploads = {}
+      self.last_id = 1000
+      return
+
+   def next_id(self):
+      with self.lock:
+         self.last_id += 1
+         return self.last_id
+
+# -------------------------------------------
+# Zenodo
+# -------------------------------------------
+
+class ZenodoHandler(StandInHandler):
+   """ Emulates the parts of the Zenodo deposition and file bucket APIs used by PyRDM. The server's state is stored in its 'depositions' and 'buckets' dictionaries. """
+
+   routes = [("GET", "/api/deposit/depositions", "list_depositions"),
+             ("POST", "/api/deposit/depositions", "create_deposition"),
+             ("GET", "/api/deposit/depositions/(\d+)", "get_deposition"),
+             ("DELETE", "/api/deposit/depositions/(\d+)", "delete_deposition"),
+             ("GET", "/api/deposit/depositions/(\d+)/files", "list_files"),
+             ("POST", "/api/deposit/depositions/(\d+)/files", "create_file"),
+             ("DELETE", "/api/deposit/depositions/(\d+)/files/([0-9a-f-]+)", "delete_file"),
+             ("POST", "/api/deposit/depositions/(\d+)/actions/publish", "publish"),
+             ("PUT", "/api/files/([0-9a-f-]+)/([^/]+)", "upload_to_bucket")]
+
+   def deposition(self, deposition_id):
+      return self.server.depositions.get(int(deposition_id))
+
+   def details(self, d):
+      details = dict((k, v) for k, v in d.items() if k != "files")
+      details["files"] = [self.file_details(f) for f in d["files"].values()]
+      return details
+
+   def file_details(self, f):
+      return {"id": f["id"], "filename": f["filename"], "filesize": f["filesize"], "checksum": f["checksum"]}
+
+   def list_depositions(self, body):
+      # Only queries of the form 'keywords:"<keyword>"' are supported.
+      keyword = None
+      if("q" in self.query):
+         keyword = re.match('keywords:"(.*)"$', self.query["q"][0]).group(1)
+      with self.server.lock:
+         depositions = [self.details(d) for d in sorted(self.server.depositions.values(), key=lambda d: d["id"]) 
+                        if keyword is None or keyword in d["metadata"].get("keywords", [])]
+      return 200, self.page(depositions, "size")
+
+   def create_deposition(self, body):
+      metadata = json.load(body)["metadata"]
+      with self.server.lock:
+         deposition_id = self.server.next_id()
+         bucket = str(uuid.uuid4())
+         metadata["prereserve_doi"] = {"doi": "10.5072/zenodo.%d" % deposition_id, "recid": deposition_id}
+         d = {"id": deposition_id, "metadata": metadata, "state": "unsubmitted", "submitted": False, "files": {},
+              "links": {"bucket": "%s/api/files/%s" % (self.server.url, bucket)}}
+         self.server.depositions[deposition_id] = d
+         self.server.buckets[bucket] = d
+         return 201, self.details(d)
+
+   def get_deposition(self, body, deposition_id):
+      with self.server.lock:
+         d = self.deposition(deposition_id)
+         if(d is None):
+            return 404, {"message": "PID does not exist.", "status": 404} # As returned by Zenodo.
+         return 200, self.details(d)
+
+   def delete_deposition(self, body, deposition_id):
+      with self.server.lock:
+         self.server.depositions.pop(int(deposition_id), None)
+      return 204, None
+
+   def list_files(self, body, deposition_id):
+      with self.server.lock:
+         return 200, [self.file_details(f) for f in self.deposition(deposition_id)["files"].values()]
+
+   def add_file(self, d, filename, size, checksum):
+      with self.server.lock:
+         f = {"id": str(uuid.uuid4()), "filename": filename, "filesize": size, "checksum": checksum}
+         d["files"][filename] = f
+         return f
+
+   def create_file(self, body, deposition_id):
+      form = cgi.FieldStorage(fp=body, headers=self.headers, environ={"REQUEST_METHOD": "POST"})
+      data = form["file"].file
+      size = os.fstat(data.fileno()).st_size if hasattr(data, "fileno") else len(data.getvalue())
+      f = self.add_file(self.deposition(deposition_id), form.getvalue("filename"), size, md5_of(data))
+      return 201, self.file_details(f)
+
+   def delete_file(self, body, deposition_id, file_id):
+      with self.server.lock:
+         d = self.deposition(deposition_id)
+         for name, f in list(d["files"].items()):
+            if(f["id"] == file_id):
+               del d["files"][name]
+      return 204, None
+
+   def publish(self, body, deposition_id):
+      with self.server.lock:
+         d = self.deposition(deposition_id)
+         d["state"] = "done"
+         d["submitted"] = True
+         return 202, self.details(d)
+
+   def upload_to_bucket(self, body, bucket, key):
+      body.seek(0, 2)
+      size = body.tell()
+      body.seek(0)
+      checksum = md5_of(body)
+      with self.server.lock:
+         d = self.server.buckets[bucket]
+      f = self.add_file(d, key, size, checksum)
+      # NOTE: As with Zenodo, the ID of the object version in the bucket is not the ID of the file in the deposition.
+      return 200, {"key": key, "size": size, "checksum": "md5:" + checksum, "version_id": str(uuid.uuid4()), "mimetype": "application/octet-stream"}
+
+class ZenodoServer(StandInServer):
+   """ A stand-in Zenodo server, whose API is at the URL 'url' + '/api/'. """
+
+   def __init__(self, latency=0.0, bandwidth=None, rate_limit=None):
+      StandInServer.__init__(self, ZenodoHandler, latency=latency, bandwidth=bandwidth, rate_limit=rate_limit)
+      self.depositions = {}
+      self.buckets = {}
+      self.last_id = 1000
+      return
+
+   def next_id(self):
+      with self.lock:
+         self.last_id += 1
+         return self.last_id
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+import errno
+import shutil
+import unittest
+import tempfile
+
+_LOG = logging.getLogger(__name__)
+
+class ArchiveCache:
+   """ A cache of software archives, kept on the local file system. Each archive is stored under a key derived from the SHA-1 hash of the
+   Git tree it contains, so an archive of the same tree can be re-used instead of being created again. The total size of the cache is bounded;
+   once it grows too large, the least recently used archives are removed. """
+
+   def __init__(self, directory, max_size=1024*1024*1024):
+      """ Open (or create) the cache stored in the directory with path 'directory', which holds at most 'max_size' bytes of archives. """
+      self.directory = directory
+      self.max_size = max_size
+      try:
+         os.makedirs(directory)
+      except OSError as e:
+         if(e.errno != errno.EEXIST): # Another process may have just created it.
+            raise
+      return
+
+   @staticmethod
+   def get_key(tree_sha, archive_format, level=None):
+      """ Return the key of an archive of the tree with a given SHA-1 hash, in a given format (e.g. 'zip') and compression level
+      (or None if the compressor's default level was used). """
+      if(level is None):
+         return "%s.%s" % (tree_sha, archive_format)
+      return "%s.%d.%s" % (tree_sha, level, archive_format)
+
+   def get(self, key, destination):
+      """ If the cache holds an archive with a given key, make it available at the path 'destination' (which is replaced if it already exists)
+      and return its MD5 checksum. Otherwise, return None. """
+      path = os.path.join(self.directory, key)
+      try:
+         with open(path + ".md5", "r") as f:
+            md5 = f.read().strip()
+         link(path, destination)
+      except (IOError, OSError):
+         return None
+      os.utime(path, None) # Mark the archive as recently used.
+      return md5
+
+   def put(self, key, source, md5):
+      """ Add the archive at the path 'source', whose MD5 checksum is 'md5', to the cache under a given key. """
+      path = os.path.join(self.directory, key)
+      try:
+         link(source, path)
+         write(path + ".md5", md5)
+      except (IOError, OSError) as e:
+         _LOG.warning("Could not add the archive %s to the cache: %s" % (source, e))
+         return
+      self.evict(keep=key)
+      return
+
+   def evict(self, keep=None):
+      """ Remove the least recently used archives (other than the one with the key 'keep') until the cache is no larger than its maximum size. """
+      archives = []
+      for name in os.listdir(self.directory):
+         path = os.path.join(self.directory, name)
+         if(name.endswith(".md5") or name.endswith(".tmp") or name == keep):
+            continue
+         try:
+            st = os.stat(path)
+         except OSError:
+            continue # Removed by another process.
+         archives.append((st.st_mtime, st.st_size, path))
+      size = sum(archive[1] for archive in archives)
+      if(keep is not None and os.path.exists(os.path.join(self.directory, keep))):
+         size += os.path.getsize(os.path.join(self.directory, keep))
+      for mtime, archive_size, path in sorted(archives):
+         if(size <= self.max_size):
+            break
+         _LOG.debug("Removing archive %s from the cache." % path)
+         for p in [path, path + ".md5"]:
+            try:
+               os.remove(p)
+            except OSError:
+               pass
+         size -= archive_size
+      return
+
+def link(source, destination):
+   """ Make the file at the path 'source' available at the path 'destination', without copying it if possible. 
+   The destination is replaced atomically, so other processes never see a partially-written file. 
+   NOTE: Since the two paths may then share the same file, neither may be opened for writing afterwards; a new file must be renamed over them instead. """
+   if(os.path.exists(destination) and os.path.samefile(source, destination)):
+      return # Already linked. (Renaming a link over another link to the same file would do nothing.)
+   temporary_path = "%s.%d.%d.tmp" % (destination, os.getpid(), threading.current_thread().ident)
+   try:
+      os.link(source, temporary_path)
+   except OSError:
+      shutil.copyfile(source, temporary_path) # e.g. the source is on a different file system.
+   os.rename(temporary_path, destination)
+   return
+
+def write(path, data):
+   temporary_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+   with open(temporary_path, "w") as f:
+      f.write(data)
+   os.rename(temporary_path, path)
+   return
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's archive cache module. """
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.cache = ArchiveCache(os.path.join(self.directory, "archives"), max_size=100)
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def make_archive(self, name, size):
+      path = os.path.join(self.directory, name)
+      with open(path, "wb") as f:
+         f.write(b"x"*size)
+      return path
+
+   def test_archive_cache(self):
+      key = ArchiveCache.get_key("4b825dc642cb6eb9a060e54bf8d69288fbee4904", "zip")
+      destination = os.path.join(self.directory, "PyRDM-1.0.zip")
+      assert(self.cache.get(key, destination) is None)
+      self.cache.put(key, self.make_archive("a.zip", 40), "0123456789abcdef0123456789abcdef")
+      assert(self.cache.get(key, destination) == "0123456789abcdef0123456789abcdef")
+      assert(os.path.getsize(destination) == 40)
+
+   def test_archive_cache_eviction(self):
+      for i in range(3):
+         self.cache.put("tree%d.zip" % i, self.make_archive("%d.zip" % i, 40), "md5")
+         os.utime(os.path.join(self.cache.directory, "tree%d.zip" % i), (1000 + i, 1000 + i))
+      # The least recently used archive is removed once the cache is full.
+      assert(self.cache.get("tree0.zip", os.path.join(self.directory, "out.zip")) is None)
+      assert(self.cache.get("tree1.zip", os.path.join(self.directory, "out.zip")) == "md5")
+      self.cache.put("tree3.zip", self.make_archive("3.zip", 40), "md5")
+      # tree1 has just been used, so tree2 is removed instead.
+      assert(self.cache.get("tree2.zip", os.path.join(self.directory, "out.zip")) is None)
+      assert(self.cache.get("tree1.zip", os.path.join(self.directory, "out.zip")) == "md5")
+
+if(__name__ == '__main__'):
+   unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import logging
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from pyrdm.publisher import PublicationError
+
+_LOG = logging.getLogger(__name__)
+
+class AsyncPublisher:
+   """ A non-blocking interface to a Publisher. Each method starts the corresponding Publisher operation in the background and returns
+   immediately with a handle (a multiprocessing.pool.AsyncResult object) whose get() method waits for, and returns, the operation's result.
+   An optional 'callback' is called (in a worker thread) with the result as soon as the operation completes, so that the caller's own event loop
+   can be notified, e.g. by passing the result to it with a thread-safe call.
+   The operations are run by a fixed-size pool of worker threads shared by all calls. Each operation holds a worker thread until it completes,
+   so the number of workers is the number of operations which can be in progress at once; any others wait for a worker to become free.
+   If an operation fails, the exception (e.g. a PublicationError) is raised by the handle's get() method. """
+
+   def __init__(self, publisher, workers=8):
+      """ Run the operations of 'publisher' (a pyrdm.publisher.Publisher object, whose connection to the service is shared by all operations)
+      using a pool of 'workers' threads, which should be as large as the number of operations that are to be in progress at once (e.g. several hundred
+      for a service which publishes many datasets at the same time). The operations are run by a non-interactive copy of 'publisher', since they cannot 
+      prompt the user or exit the program. 'publisher' itself is not modified. """
+      # NOTE: The copy shares the publisher's connections, caches and registry. A version of some software is only published once, 
+      # even if it is published by several operations at the same time (see Publisher.publish_software).
+      self.publisher = copy.copy(publisher)
+      self.publisher.interactive = False
+      self.pool = ThreadPool(workers)
+      return
+
+   def _apply_async(self, method, args, kwargs, callback):
+      """ Start calling 'method' with the arguments 'args' and 'kwargs' in one of the worker threads. """
+      def run():
+         try:
+            return method(*args, **kwargs)
+         except SystemExit:
+            # A SystemExit raised in a worker thread would never be passed back to get(), which would then wait forever.
+            raise PublicationError("%s exited instead of returning a result." % method.__name__)
+      return self.pool.apply_async(run, (), {}, callback)
+
+   def publish_software(self, name, local_repo_location, version=None, private=False, stream=None, archive_format=None, compression_level=None, callback=None):
+      """ Start publishing the software in a local repository. The result is a tuple (pid, doi). See Publisher.publish_software. """
+      return self._apply_async(self.publisher.publish_software, (name, local_repo_location), {"version": version, "private": private, "stream": stream, 
+                                     "archive_format": archive_format, "compression_level": compression_level}, callback)
+
+   def publish_data(self, parameters, pid=None, private=False, callback=None):
+      """ Start publishing a dataset. The result is a tuple (pid, doi). See Publisher.publish_data. """
+      return self._apply_async(self.publisher.publish_data, (parameters,), {"pid": pid, "private": private}, callback)
+
+   def is_uploaded(self, pid, files, callback=None):
+      """ Start checking whether the files in the list 'files' are all present on the server. The result is True or False. See Publisher.is_uploaded. """
+      return self._apply_async(self.publisher.is_uploaded, (pid, files), {}, callback)
+
+   def publication_exists(self, pid, callback=None):
+      """ Start checking whether the publication with ID 'pid' exists. The result is True or False. See Publisher.publication_exists. """
+      return self._apply_async(self.publisher.publication_exists, (pid,), {}, callback)
+
+   def close(self):
+      """ Wait for all the operations that have been started to complete, and then stop the worker threads. """
+      self.pool.close()
+      self.pool.join()
+      return
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's AsyncPublisher module. """
+
+   class DummyPublisher:
+      """ Stands in for a Publisher, taking a while to respond to each request. """
+      interactive = True
+      def publication_exists(self, pid):
+         time.sleep(0.2)
+         return pid > 0
+      def publish_data(self, parameters, pid=None, private=False):
+         # Stands in for the failures of a Publisher which exit the program (e.g. when the configuration file cannot be read).
+         import sys
+         sys.exit(1)
+
+   def setUp(self):
+      self.dummy_publisher = TestLog.DummyPublisher()
+      self.publisher = AsyncPublisher(self.dummy_publisher, workers=10)
+      return
+
+   def tearDown(self):
+      self.publisher.close()
+      return
+
+   def test_async_publication_exists(self):
+      notified = []
+      start = time.time()
+      results = [self.publisher.publication_exists(pid, callback=notified.append) for pid in range(-4, 6)]
+      assert([r.get() for r in results] == [pid > 0 for pid in range(-4, 6)])
+      _LOG.debug("Time taken: %f seconds" % (time.time() - start))
+      assert(time.time() - start < 1.0) # The requests should have been made concurrently.
+      assert(sorted(notified) == sorted(pid > 0 for pid in range(-4, 6)))
+
+   def test_async_exit(self):
+      assert(not self.publisher.publisher.interactive)
+      assert(self.dummy_publisher.interactive) # The caller's publisher is left as it was.
+      result = self.publisher.publish_data({})
+      # The failure is raised by get(), rather than leaving it waiting forever.
+      self.assertRaises(PublicationError, result.get, 5)
+
+if(__name__ == '__main__'):
+   unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+import errno
+import json
+import time
+import hashlib
+import unittest
+import tempfile
+import shutil
+
+_LOG = logging.getLogger(__name__)
+
+class AuthenticationError(Exception):
+   """ Raised when a service does not accept the authentication token given in the configuration file. """
+   pass
+
+class AuthCache:
+   """ A short-lived record, kept on the local file system, of the authentication tokens that have recently been accepted by each service.
+   This allows the authentication test to be skipped when a token was validated only a short while ago (e.g. by a previous run of PyRDM).
+   Only a hash of each token is stored, never the token itself. """
+
+   def __init__(self, path, ttl=3600):
+      """ Open (or create) the record stored in the file with path 'path'. A token is considered valid for 'ttl' seconds after it was last validated. """
+      self.path = path
+      self.ttl = ttl
+      directory = os.path.dirname(path)
+      if(directory != ""):
+         try:
+            os.makedirs(directory, 0o700)
+         except OSError as e:
+            if(e.errno != errno.EEXIST): # Another process may have just created it.
+               raise
+      return
+
+   @staticmethod
+   def get_key(service, token):
+      """ Return the key identifying a given token for a given service. """
+      return service + ":" + hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+   def _load(self):
+      try:
+         with open(self.path, "r") as f:
+            return json.load(f)
+      except (IOError, ValueError):
+         return {}
+
+   def _save(self, entries):
+      # Write to a temporary file first, so that other threads and processes never see a partially-written file.
+      temporary_path = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.current_thread().ident)
+      with open(temporary_path, "w") as f:
+         json.dump(entries, f)
+      os.rename(temporary_path, self.path)
+      return
+
+   def is_valid(self, service, token):
+      """ Return True if the token 'token' was accepted by the service 'service' less than 'ttl' seconds ago. """
+      validated = self._load().get(AuthCache.get_key(service, token))
+      return validated is not None and 0 <= time.time() - validated < self.ttl
+
+   def record(self, service, token):
+      """ Record that the token 'token' has just been accepted by the service 'service'. """
+      now = time.time()
+      # Drop any expired tokens while we are here.
+      entries = dict((key, validated) for key, validated in self._load().items() if now - validated < self.ttl)
+      entries[AuthCache.get_key(service, token)] = now
+      self._save(entries)
+      return
+
+   def forget(self, service, token):
+      """ Remove the token 'token' for the service 'service', e.g. after it has been rejected by the service. """
+      entries = self._load()
+      if(entries.pop(AuthCache.get_key(service, token), None) is not None):
+         self._save(entries)
+      return
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's authentication cache module. """
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.cache = AuthCache(os.path.join(self.directory, "pyrdm", "auth.json"), ttl=60)
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def test_auth_cache(self):
+      assert(not self.cache.is_valid("figshare", "my-secret-token"))
+      self.cache.record("figshare", "my-secret-token")
+      assert(self.cache.is_valid("figshare", "my-secret-token"))
+      assert(not self.cache.is_valid("zenodo", "my-secret-token"))
+      assert(not self.cache.is_valid("figshare", "my-other-token"))
+      assert("my-secret-token" not in open(self.cache.path).read()) # The token itself must not be stored.
+
+      self.cache.forget("figshare", "my-secret-token")
+      assert(not self.cache.is_valid("figshare", "my-secret-token"))
+
+   def test_auth_cache_expiry(self):
+      self.cache.record("zenodo", "my-secret-token")
+      expired = AuthCache(self.cache.path, ttl=0)
+      assert(not expired.is_valid("zenodo", "my-secret-token"))
+
+if(__name__ == '__main__'):
+   unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import unittest
+import hashlib # For MD5 checksums
+import multiprocessing
+import os
+import time
+import tempfile
+import shutil
+
+_LOG = logging.getLogger(__name__)
+
+# The number of bytes read from a file at a time when computing its checksum.
+CHUNK_SIZE = 1024*1024
+
+def md5sum(file_path, chunk_size=CHUNK_SIZE, buffer=None):
+   """ Return the MD5 checksum (as a hexadecimal string) of the file with path 'file_path'.
+   The file is streamed through the hash function in chunks of 'chunk_size' bytes, which are read into a single buffer,
+   so the memory used does not depend on the size of the file. A bytearray can be passed in via 'buffer' to be re-used
+   between calls (in which case its length determines the chunk size). """
+   if(buffer is None):
+      buffer = bytearray(chunk_size)
+   view = memoryview(buffer)
+   md5 = hashlib.md5()
+   with open(file_path, "rb") as f:
+      while True:
+         n = f.readinto(buffer)
+         if(not n):
+            break
+         md5.update(view[:n])
+   return md5.hexdigest()
+
+# The buffer re-used by each worker process of md5sum_many.
+_BUFFER = None
+
+def _md5sum_worker(file_path):
+   """ Compute the checksum of a file in a worker process of md5sum_many, re-using the worker's buffer. 
+   Returns a tuple (file_path, md5, stat), where 'stat' is a tuple (st, time) of the file's os.stat result and the time at which it was taken,
+   just before the file was read. """
+   global _BUFFER
+   if(_BUFFER is None):
+      _BUFFER = bytearray(CHUNK_SIZE)
+   stat = (os.stat(file_path), time.time())
+   return file_path, md5sum(file_path, buffer=_BUFFER), stat
+
+def md5sum_many(files, processes=None, stats=None):
+   """ Return a dictionary of the MD5 checksums of the files whose paths are in the list 'files', keyed by file path.
+   The files are shared out between a pool of 'processes' worker processes (by default, one per CPU core).
+   If 'processes' is 1, or there is only one file, the checksums are computed in the current process.
+   If a dictionary is passed in via 'stats', it is populated with the stat information of each file when it was read (see ChecksumIndex.update). """
+   if(processes is None):
+      processes = multiprocessing.cpu_count()
+   processes = min(processes, len(files))
+   
+   if(processes <= 1):
+      results = (_md5sum_worker(f) for f in files)
+      pool = None
+   else:
+      pool = multiprocessing.Pool(processes)
+      # Hand out several files at a time when there are many small files, to reduce the communication overhead.
+      chunksize = max(1, len(files)//(4*processes))
+      results = pool.imap_unordered(_md5sum_worker, files, chunksize)
+   checksums = {}
+   try:
+      for f, md5, stat in results:
+         checksums[f] = md5
+         if(stats is not None):
+            stats[f] = stat
+   finally:
+      if(pool is not None):
+         pool.close()
+         pool.join()
+   return checksums
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's checksum module. """
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.file_path = os.path.join(self.directory, "test_file.txt")
+      f = open(self.file_path, "w")
+      f.write("Hello World! This is a file for the MD5 functionality test.")
+      f.close()
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def test_md5sum(self):
+      md5_known = "29586140472f40eec4031eb2e0d352e1"
+      md5 = md5sum(self.file_path)
+      _LOG.debug("Known MD5 hash of file: %s" % md5_known)
+      _LOG.debug("Computed MD5 hash of file: %s" % md5)
+      assert(md5 == md5_known)
+
+   def test_md5sum_small_chunks(self):
+      # The checksum should not depend on how the file is split into chunks.
+      assert(md5sum(self.file_path, chunk_size=7) == md5sum(self.file_path))
+
+   def test_md5sum_many(self):
+      second_file_path = os.path.join(self.directory, "test_file_2.txt")
+      f = open(second_file_path, "w")
+      f.write("This is a second file for the MD5 functionality test.")
+      f.close()
+      
+      files = [self.file_path, second_file_path]
+      checksums = md5sum_many(files, processes=2)
+      _LOG.debug("Computed MD5 hashes of files: %s" % (checksums,))
+      assert(checksums == dict((f, md5sum(f)) for f in files))
+
+if(__name__ == '__main__'):
+   unittest.main()
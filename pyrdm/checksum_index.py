@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import errno
+import sqlite3
+import time
+import unittest
+import tempfile
+import shutil
+
+from pyrdm.checksum import md5sum_many
+
+_LOG = logging.getLogger(__name__)
+
+# The location of the user's checksum index. Files are recorded by their absolute paths, so a single index holds the checksums
+# of all the user's datasets, and a file's record does not move when the set of files in its dataset changes.
+INDEX_PATH = "~/.cache/pyrdm/checksums.db"
+
+# Files modified less than this many seconds before their checksum was recorded could have been modified again
+# without their modification time changing, so their stat information alone is not trusted.
+RACY_INTERVAL = 2.0
+
+class ChecksumIndex:
+   """ A persistent index of the MD5 checksums of published data files, stored in a single SQLite database.
+   Each checksum is recorded along with the size, modification time and inode of the file at the time it was published,
+   so that files whose stat information has not changed since then can be skipped without being read. """
+
+   def __init__(self, path):
+      """ Open (or create) the checksum index stored in the file with path 'path'. """
+      self.path = path
+      # Several processes may publish data at the same time, so wait for any of them which is writing to the index.
+      self.connection = sqlite3.connect(path, timeout=60)
+      self.connection.execute("""CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, md5 TEXT, recorded REAL)""")
+      self.connection.commit()
+      return
+
+   @staticmethod
+   def open(path=None):
+      """ Open the checksum index stored in the file with path 'path' (by default, the user's index in INDEX_PATH), creating its directory if necessary.
+      If the index cannot be opened, an empty index is returned instead (which is kept in memory), so all files are treated as modified. """
+      if(path is None):
+         path = os.path.expanduser(INDEX_PATH)
+      try:
+         try:
+            os.makedirs(os.path.dirname(path))
+         except OSError as e:
+            if(e.errno != errno.EEXIST): # Another process may have just created it.
+               raise
+         return ChecksumIndex(path)
+      except (OSError, sqlite3.Error) as e:
+         _LOG.warning("Could not open the checksum index %s (%s), so all files will be treated as modified." % (path, e))
+         return ChecksumIndex(":memory:")
+
+   def get(self, f):
+      """ Return the MD5 checksum recorded for the file with path 'f', or None if there is no record of it. """
+      row = self.connection.execute("SELECT md5 FROM checksums WHERE path = ?", (os.path.abspath(f),)).fetchone()
+      if(row is None):
+         return None
+      return str(row[0])
+
+   def is_unchanged(self, f, st=None):
+      """ Return True if the stat information (size, modification time and inode) of the file with path 'f' matches
+      the stat information recorded along with its checksum. The file itself is not read.
+      The result of os.stat can be passed in via 'st' if it is already available. """
+      if(st is None):
+         st = os.stat(f)
+      row = self.connection.execute("SELECT size, mtime, inode, recorded FROM checksums WHERE path = ?", (os.path.abspath(f),)).fetchone()
+      if(row is None):
+         return False
+      size, mtime, inode, recorded = row
+      if(st.st_mtime > recorded - RACY_INTERVAL):
+         return False
+      return (size == st.st_size and mtime == st.st_mtime and inode == st.st_ino)
+
+   def update(self, checksums, stats=None):
+      """ Record the MD5 checksums in the dictionary 'checksums' (keyed by file path), along with the stat information of each file. 
+      The stat information of the files when their checksums were computed should be passed in via 'stats' (as populated by md5sum_many):
+      a file which has been modified since then (e.g. while it was being uploaded) must not be recorded with its new stat information but its old checksum.
+      Otherwise, the current stat information of each file is recorded. All records are written in a single transaction. """
+      rows = []
+      for f, md5 in checksums.items():
+         if(stats is not None and f in stats):
+            st, recorded = stats[f]
+         else:
+            st, recorded = os.stat(f), time.time()
+         rows.append((os.path.abspath(f), st.st_size, st.st_mtime, st.st_ino, md5, recorded))
+      with self.connection:
+         self.connection.executemany("INSERT OR REPLACE INTO checksums (path, size, mtime, inode, md5, recorded) VALUES (?, ?, ?, ?, ?, ?)", rows)
+      return
+
+   def close(self):
+      """ Close the connection to the index. """
+      self.connection.close()
+      return
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's checksum index module. """
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.file_path = os.path.join(self.directory, "test_file.txt")
+      f = open(self.file_path, "w")
+      f.write("Hello World! This is a file for the checksum index test.")
+      f.close()
+      self.index = ChecksumIndex.open(os.path.join(self.directory, "index", "checksums.db"))
+      return
+
+   def tearDown(self):
+      self.index.close()
+      shutil.rmtree(self.directory)
+      return
+
+   def test_index_location(self):
+      assert(self.index.path == os.path.join(self.directory, "index", "checksums.db"))
+      # An index which cannot be created (here, because its directory would be inside a file) is replaced by an empty one.
+      index = ChecksumIndex.open(os.path.join(self.file_path, "index", "checksums.db"))
+      assert(index.path == ":memory:")
+      index.update({self.file_path: "abc"})
+      assert(index.get(self.file_path) == "abc")
+      index.close()
+
+   def test_index_update(self):
+      assert(self.index.get(self.file_path) is None)
+      assert(not self.index.is_unchanged(self.file_path))
+
+      self.index.update({self.file_path: "abc"})
+      assert(self.index.get(self.file_path) == "abc")
+
+      # The file has only just been written, so its stat information cannot be trusted yet.
+      assert(not self.index.is_unchanged(self.file_path))
+
+      # Pretend that the file was last modified some time ago.
+      then = time.time() - 60
+      os.utime(self.file_path, (then, then))
+      self.index.update({self.file_path: "abc"})
+      assert(self.index.is_unchanged(self.file_path))
+
+      # Modify the file.
+      f = open(self.file_path, "a")
+      f.write("This is another line.")
+      f.close()
+      assert(not self.index.is_unchanged(self.file_path))
+
+   def test_index_update_stats(self):
+      # The checksum is computed (along with the stat information) some time before it is recorded, e.g. after a long upload.
+      then = time.time() - 60
+      os.utime(self.file_path, (then, then))
+      stats = {}
+      checksums = md5sum_many([self.file_path], stats=stats)
+      # The file is modified in the meantime.
+      f = open(self.file_path, "a")
+      f.write("This is another line.")
+      f.close()
+      os.utime(self.file_path, (then + 1, then + 1))
+      self.index.update(checksums, stats=stats)
+      assert(not self.index.is_unchanged(self.file_path))
+
+if(__name__ == '__main__'):
+   unittest.main()
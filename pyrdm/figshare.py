@@ -20,42 +20,125 @@
 import logging
 import sys, os
 import unittest
-import hashlib
 
 import requests
-from restkit import Resource, request
 import json
+import threading
+import hashlib
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from pyrdm.checksum import md5sum, CHUNK_SIZE
+from pyrdm.transport import Transport
+from pyrdm.rate_limit import RateLimiter
+from pyrdm.journal import UploadJournal
+from pyrdm.auth_cache import AuthCache, AuthenticationError
+from pyrdm.pagination import paginate
 
 _LOG = logging.getLogger(__name__)
 
-class Figshare(Resource):
+class Figshare:
    """ A Python interface to Figshare via version 2 of the Figshare API. """
 
-   def __init__(self, token):
+   def __init__(self, token, workers=4, transport=None, journal=None, auth_cache=None, base_url="https://api.figshare.com/v2"):
+      """ Set up the interface using the Figshare OAuth2 authentication token 'token'. All requests are sent through the
+      connection pool 'transport' (a pyrdm.transport.Transport object), which can be shared with other services. 
+      The progress of each file upload is recorded in 'journal' (a pyrdm.journal.UploadJournal object) so that interrupted uploads can be resumed. 
+      The API is accessed at 'base_url', which only needs changing to use a different Figshare instance (or a stand-in server). """
    
-      self.base_url = "https://api.figshare.com/v2"
+      self.base_url = base_url.rstrip("/")
       
       # The Figshare OAuth2 authentication token.
       self.token = token
+
+      # The number of parts of a file that are uploaded concurrently.
+      self.workers = workers
       
-      super(Figshare, self).__init__(self.base_url)
+      if(transport is None):
+         transport = Transport(pool_size=workers, rate_limiter=RateLimiter())
+      self.transport = transport
 
-      # Before doing any creating/uploading on Figshare, try something simple like listing the user's articles
-      # to check that the authentication is successful.
-      _LOG.info("Testing Figshare authentication...")
-      try:
-         response = self.get('/account/articles', params_dict={"limit":10}, headers=self.get_headers(token=self.token))
-         _LOG.debug("Server returned response %d" % response.status_int)
-         if(response.status_int != requests.codes.ok): # If the status is not "OK", then exit here.
-            raise Exception("Could not authenticate with the Figshare server.")
-         else:
-            _LOG.info("Authentication test successful.\n")
-      except Exception as e:
-         _LOG.error("Could not authenticate with the Figshare server. Check Internet connection? Check Figshare authentication keys in ~/.config/pyrdm.ini ?")
-         sys.exit(1)
+      if(journal is None):
+         journal = UploadJournal(os.path.expanduser("~/.cache/pyrdm/figshare_uploads.json"))
+      self.journal = journal
 
+      # The IDs of the categories, keyed by name. This is built when it is first needed.
+      self.category_ids = None
+
+      # The authentication token is tested just before the first request is made, rather than here, so that setting up the interface is free.
+      # A record of recently-validated tokens is kept in 'auth_cache' (a pyrdm.auth_cache.AuthCache object) so that the test is not repeated on every run.
+      if(auth_cache is None):
+         auth_cache = AuthCache(os.path.expanduser("~/.cache/pyrdm/auth.json"))
+      self.auth_cache = auth_cache
+      self.authenticated = False
+      self.auth_lock = threading.Lock()
+
+      return
+
+   def authenticate(self):
+      """ Check that the authentication token is accepted by the Figshare server, unless this has already been done recently. 
+      An AuthenticationError is raised if it is not. """
+      if(self.authenticated):
+         return
+      with self.auth_lock:
+         if(self.authenticated):
+            return
+         if(self.auth_cache.is_valid("figshare", self.token)):
+            _LOG.debug("Figshare authentication token was validated recently.")
+            self.authenticated = True
+            return
+
+         # Before doing any creating/uploading on Figshare, try something simple like listing the user's articles
+         # to check that the authentication is successful.
+         _LOG.info("Testing Figshare authentication...")
+         try:
+            response = self.transport.get(self.base_url + '/account/articles', params={"limit":10}, headers=self.get_headers(token=self.token))
+            _LOG.debug("Server returned response %d" % response.status_code)
+            if(response.status_code != requests.codes.ok): # If the status is not "OK", then exit here.
+               raise Exception("Could not authenticate with the Figshare server.")
+            else:
+               _LOG.info("Authentication test successful.\n")
+         except Exception as e:
+            raise AuthenticationError("Could not authenticate with the Figshare server. Check Internet connection? Check Figshare authentication keys in ~/.config/pyrdm.ini ?")
+
+         self.auth_cache.record("figshare", self.token)
+         self.authenticated = True
       return
 
+   def request(self, method, path, cache_ttl=None, **kwargs):
+      """ Send an HTTP request to the Figshare API and return the response. The 'path' is relative to the API's base URL,
+      unless it is a full URL. The keyword arguments are the same as those of requests.request. 
+      If 'cache_ttl' is given, the response to a GET request is cached, and the cached copy is re-used without contacting the server
+      for 'cache_ttl' seconds (and after that, for as long as the server confirms that it has not changed).
+      A requests.HTTPError is raised if the server returns an error, or an AuthenticationError if the token is no longer accepted. """
+      self.authenticate()
+      if(path.startswith("http://") or path.startswith("https://")):
+         url = path
+      else:
+         url = self.base_url + path
+      if(method == "GET" and cache_ttl is not None):
+         response = self.transport.cached_get(url, ttl=cache_ttl, **kwargs)
+      else:
+         response = self.transport.request(method, url, **kwargs)
+      if(response.status_code == requests.codes.unauthorized):
+         # The token has been revoked (or has expired) since it was validated.
+         self.auth_cache.forget("figshare", self.token)
+         raise AuthenticationError("Could not authenticate with the Figshare server. Check Figshare authentication keys in ~/.config/pyrdm.ini ?")
+      response.raise_for_status()
+      return response
+
+   def get(self, path, **kwargs):
+      return self.request("GET", path, **kwargs)
+
+   def post(self, path, **kwargs):
+      return self.request("POST", path, **kwargs)
+
+   def put(self, path, **kwargs):
+      return self.request("PUT", path, **kwargs)
+
+   def delete(self, path, **kwargs):
+      return self.request("DELETE", path, **kwargs)
+
    def get_headers(self, token=None):
       """ HTTP header information. """
       
@@ -74,9 +157,9 @@ class Figshare(Resource):
       # The data that will be sent via HTTP POST.
       body = {'title':title, 'description':description, 'defined_type':defined_type, "categories":categories, "tags":tags}
       headers = {'content-type':'application/json'}
-      response = self.post("/account/articles", payload=json.dumps(body), headers=self.get_headers(token=self.token))
+      response = self.post("/account/articles", data=json.dumps(body), headers=self.get_headers(token=self.token))
       
-      response = json.loads(response.body_string())
+      response = json.loads(response.content)
       
       if not "error" in response.keys():
          article_id = int(response["location"].split("/")[-1])
@@ -101,7 +184,7 @@ class Figshare(Resource):
       if(categories is not None):
          body['categories'] = categories
 
-      response = self.put('/account/articles/%s' % str(article_id), payload=json.dumps(body), headers=self.get_headers(token=self.token))
+      response = self.put('/account/articles/%s' % str(article_id), data=json.dumps(body), headers=self.get_headers(token=self.token))
       response = json.loads(response.content)
       return response
 
@@ -122,19 +205,38 @@ class Figshare(Resource):
       else:
          url = '/articles/%s' % str(article_id)
          
-      response = self.get(url, headers=self.get_headers(token=self.token))
-      details = json.loads(response.body_string())
+      response = self.get(url, headers=self.get_headers(token=self.token), cache_ttl=0)
+      details = json.loads(response.content)
       return details
       
-   def search(self, keyword, private=False, institution=None, group=None, published_since=None, modified_since=None):
-      """ Searches public and private articles using a keyword. """
+   def list_articles(self, page=None, page_size=100):
+      """ List the articles (both public and private) associated with the user's account. If a page number (counting from 1) is given, 
+      only that page of 'page_size' articles is returned. Otherwise, all the articles are returned (see iter_articles). """
+      if(page is None):
+         return list(self.iter_articles(page_size=page_size))
+      response = self.get('/account/articles', params={"page": page, "page_size": page_size}, headers=self.get_headers(token=self.token))
+      results = json.loads(response.content)
+      return results
+
+   def iter_articles(self, page_size=100, prefetch=False):
+      """ Iterate over the articles associated with the user's account, fetching 'page_size' articles at a time as they are needed.
+      If 'prefetch' is True, the next page is fetched in the background. See pyrdm.pagination.paginate. """
+      return paginate(lambda page, page_size: self.list_articles(page=page, page_size=page_size), page_size=page_size, prefetch=prefetch)
+
+   def search(self, keyword, private=False, institution=None, group=None, published_since=None, modified_since=None, page=None, page_size=100):
+      """ Searches public and private articles using a keyword. If a page number (counting from 1) is given, only that page of 'page_size' results 
+      is returned. Otherwise, all the results are returned (see iter_search). """
+
+      if(page is None):
+         return list(self.iter_search(keyword, private=private, institution=institution, group=group, published_since=published_since, 
+                                      modified_since=modified_since, page_size=page_size))
 
       if private:
          url = "/account/articles/search"
       else:
          url = "/articles/search"
 
-      parameters = {"search_for":"%s" % keyword}
+      parameters = {"search_for":"%s" % keyword, "page": page, "page_size": page_size}
 
       # Optional filters
       if institution:
@@ -146,10 +248,17 @@ class Figshare(Resource):
       if modified_since:
          parameters["modified_since"] = modified_since
       
-      response = self.post(url, payload=json.dumps(parameters), headers=self.get_headers(token=self.token))
-      results = json.loads(response.body_string())
+      response = self.post(url, data=json.dumps(parameters), headers=self.get_headers(token=self.token))
+      results = json.loads(response.content)
       return results
 
+   def iter_search(self, keyword, private=False, page_size=100, prefetch=False, **filters):
+      """ Iterate over the results of a search (see search, whose optional filters can also be given), fetching 'page_size' results at a time
+      as they are needed. If 'prefetch' is True, the next page is fetched in the background. See pyrdm.pagination.paginate. """
+      def fetch_page(page, page_size):
+         return self.search(keyword, private=private, page=page, page_size=page_size, **filters)
+      return paginate(fetch_page, page_size=page_size, prefetch=prefetch)
+
    def add_category(self, article_id, category):
       """ For an article with a given article_id, add a category. Note that this is the name of the category in string form, not the integer ID of the category. """
 
@@ -160,27 +269,27 @@ class Figshare(Resource):
       else:
          try:
             body = {'categories':[category_id]}
-            response = self.post('/account/articles/%s/categories' % str(article_id), payload=json.dumps(body), headers=self.get_headers(token=self.token))
+            response = self.post('/account/articles/%s/categories' % str(article_id), data=json.dumps(body), headers=self.get_headers(token=self.token))
             return {"success": True}
          except:
             return {"success": False}
 
    def get_category_id(self, category):
       """ Return the integer ID of a given category. If not found, return None. """
-      categories_list = self.get_categories()
-      category_id = None
-      for c in categories_list:
-         if(c["title"] == category):
-            category_id = c["id"]
-            break
-      return category_id
+      if(self.category_ids is None):
+         # Index the categories by name.
+         self.category_ids = {}
+         for c in self.get_categories():
+            self.category_ids.setdefault(c["title"], c["id"])
+      return self.category_ids.get(category)
 
    def get_categories(self):
-      """ Get the full list of available categories. No authentication is required. """
+      """ Get the full list of available categories. No authentication is required. 
+      The list rarely changes, so it is cached for a day. """
       
       headers = {'content-type':'application/json'}
-      response = self.get('/categories', headers=self.get_headers())
-      categories = json.loads(response.body_string())
+      response = self.get('/categories', headers=self.get_headers(), cache_ttl=24*60*60)
+      categories = json.loads(response.content)
       return categories
 
    def add_authors(self, article_id, author_ids):
@@ -191,73 +300,203 @@ class Figshare(Resource):
          author_ids = [{'id':author_ids}]
          
       payload = json.dumps({'authors':author_ids})
-      response = self.put('/account/articles/%s/authors' % str(article_id), payload=payload, headers=self.get_headers(token=self.token))
+      response = self.put('/account/articles/%s/authors' % str(article_id), data=payload, headers=self.get_headers(token=self.token))
       return response
     
-   def add_file(self, article_id, file_path):
+   def add_file(self, article_id, file_path, workers=None, md5=None):
       """ Upload a file with path 'file_path' to an article with a given article_id. Return the ID of the file.
+      Up to 'workers' parts of the file are uploaded concurrently (by default, the number given when this object was created).
+      If the file's MD5 checksum has already been computed, it can be passed in via 'md5' to avoid reading the file again.
       This code is based on the example from the Figshare API documentation: https://docs.figshare.com/api/upload_example/"""
       
-      file_name = os.path.basename(file_path)
+      if(md5 is None):
+         md5 = md5sum(file_path)
+
+      # Each part is read from its own byte range of the file, so the parts can be read in parallel.
+      def read_part(offset, size):
+         with open(file_path, 'rb') as file_input:
+            file_input.seek(offset)
+            return file_input.read(size)
+
+      # If an earlier upload of this file was interrupted, it is resumed.
+      key = self.journal.get_key(article_id, file_path, md5)
+      return self.upload_file(article_id, os.path.basename(file_path), os.path.getsize(file_path), md5, read_part, workers=workers, key=key)
+
+   def add_file_from_stream(self, article_id, name, stream, workers=None, spool_size=64*1024*1024):
+      """ Upload the data read from the file-like object 'stream' to an article with a given article_id, as a file called 'name'. 
+      Return a tuple (file_id, md5) containing the ID and MD5 checksum of the file.
+      Figshare needs the size and MD5 checksum of a file before any of it is uploaded, so the data is first read into a spool,
+      which is kept in memory up to 'spool_size' bytes and only moved to a temporary file beyond that. """
+
+      spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+      try:
+         checksum = hashlib.md5()
+         while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if(not chunk):
+               break
+            checksum.update(chunk)
+            spool.write(chunk)
+         size = spool.tell()
+         md5 = checksum.hexdigest()
+
+         # The spool is shared by all the upload threads, so only one part is read from it at a time.
+         lock = threading.Lock()
+         def read_part(offset, size):
+            with lock:
+               spool.seek(offset)
+               return spool.read(size)
+
+         # The data cannot be read again once the spool is closed, so an interrupted upload is not recorded in the journal.
+         file_id = self.upload_file(article_id, name, size, md5, read_part, workers=workers)
+      finally:
+         spool.close()
+      return file_id, md5
+
+   def upload_file(self, article_id, name, size, md5, read_part, workers=None, key=None):
+      """ Upload a file called 'name' (of 'size' bytes, with MD5 checksum 'md5') to an article with a given article_id. Return the ID of the file.
+      The data is read a part at a time by calling read_part(offset, size). If the upload is recorded in the journal under 'key'
+      (see UploadJournal.get_key), an interrupted upload can be resumed by calling this method again with the same key. """
+
+      if(workers is None):
+         workers = self.workers
       
       # Get file info
       file_info = {}
-      hash = hashlib.md5()
-      with open(file_path, "rb") as f:
-         for chunk in iter(lambda: f.read(4096), b""):
-             hash.update(chunk)
-      file_info['md5'] = hash.hexdigest()
-      file_info['name'] = file_name
-      file_info['size'] = os.path.getsize(file_path)
-
-      # Create file object
-      payload = json.dumps(file_info)
-      response = self.post('/account/articles/{}/files'.format(article_id), headers=self.get_headers(token=self.token), payload=payload)
-      response = json.loads(response.body_string())
-      file_location = response["location"]
-      
-      # Get the file info, in particular the upload URL
-      response = request(file_location, headers=self.get_headers(token=self.token))
-      upload_url = json.loads(response.body_string())["upload_url"]
-      
-      # Upload the file
-      response = request(upload_url, headers=self.get_headers(token=self.token))
-      response = json.loads(response.body_string())
-      parts = response["parts"]
-
-      with open(file_path, 'rb') as file_input:
-         for part in parts:
-             size = part['endOffset'] - part['startOffset'] + 1
-             response = request('{0}/{1}'.format(upload_url, part["partNo"]), method='PUT', body=file_input.read(size))
-
-      response = request(file_location, method='POST', headers=self.get_headers(token=self.token))
+      file_info['md5'] = md5
+      file_info['name'] = name
+      file_info['size'] = size
+
+      # If an earlier upload of this file was interrupted, try to resume it. Otherwise, create a new file object.
+      parts = None
+      if(key is not None):
+         parts = self.get_resumable_parts(key)
+      if(parts is not None):
+         entry = self.journal.get(key)
+         file_location = entry["file_location"]
+         upload_url = entry["upload_url"]
+         _LOG.info("Resuming the upload of %s (%d part(s) remaining)..." % (name, len(parts)))
+      else:
+         # Create file object
+         payload = json.dumps(file_info)
+         response = self.post('/account/articles/{}/files'.format(article_id), headers=self.get_headers(token=self.token), data=payload)
+         response = json.loads(response.content)
+         file_location = response["location"]
+         
+         # Get the file info, in particular the upload URL
+         response = self.get(file_location, headers=self.get_headers(token=self.token))
+         upload_url = json.loads(response.content)["upload_url"]
+         if(key is not None):
+            self.journal.start(key, file_location, upload_url)
+         
+         # Upload the file
+         response = self.get(upload_url, headers=self.get_headers(token=self.token))
+         response = json.loads(response.content)
+         parts = response["parts"]
+
+      # Completed parts are recorded in the journal as they finish, so that the upload can be resumed if it is interrupted.
+      # If any part fails, the exception is re-raised here and the upload is not marked as complete.
+      def upload(part):
+         self.upload_part(upload_url, part, read_part)
+         if(key is not None):
+            self.journal.complete_part(key, part["partNo"])
+         
+      try:
+         if(len(parts) <= 1):
+            # Not worth starting a pool of threads for (joining the pool alone takes up to 0.1 seconds).
+            for part in parts:
+               upload(part)
+         else:
+            pool = ThreadPool(min(workers, len(parts)))
+            try:
+               pool.map(upload, parts)
+            finally:
+               pool.close()
+               pool.join()
+      finally:
+         # The journal only writes completed parts in batches, so make sure they are all recorded before giving up on an upload.
+         if(key is not None):
+            self.journal.flush()
+
+      # All parts have been uploaded successfully, so complete the upload.
+      response = self.post(file_location, headers=self.get_headers(token=self.token))
+      if(key is not None):
+         self.journal.remove(key)
       
       file_id = int(file_location.split("/")[-1])
       return file_id
 
-   def list_files(self, article_id):
-      """ List all the files associated with a given article. """
-      response = self.get('/account/articles/%s/files' % str(article_id), headers=self.get_headers(token=self.token))
-      files = json.loads(response.body_string())
+   def get_resumable_parts(self, key):
+      """ If the upload with a given key (see UploadJournal.get_key) was interrupted and can be resumed, return the list of parts
+      which still need to be uploaded. Otherwise, return None. Parts are only skipped if the upload service reports them as complete. """
+      entry = self.journal.get(key)
+      if(entry is None):
+         return None
+      try:
+         response = self.get(entry["upload_url"], headers=self.get_headers(token=self.token))
+         parts = json.loads(response.content)["parts"]
+      except AuthenticationError:
+         raise
+      except Exception as e:
+         # The upload has probably expired or been deleted, so start again. The incomplete file is deleted first,
+         # otherwise it would be left on the server next to the new file with the same name.
+         _LOG.debug("Could not resume upload %s: %s" % (key, e))
+         try:
+            self.delete(entry["file_location"], headers=self.get_headers(token=self.token))
+         except AuthenticationError:
+            raise
+         except Exception as e:
+            _LOG.debug("Could not delete the incomplete file %s: %s" % (entry["file_location"], e))
+         self.journal.remove(key)
+         return None
+      return [part for part in parts if part.get("status") != "COMPLETE"]
+
+   def has_pending_upload(self, article_id, file_path, md5):
+      """ Return True if an interrupted upload of a file (with path 'file_path' and MD5 checksum 'md5') to an article with a given article_id
+      has been recorded in the journal, in which case it will be resumed by add_file. """
+      return self.journal.get(self.journal.get_key(article_id, file_path, md5)) is not None
+
+   def upload_part(self, upload_url, part, read_part):
+      """ Upload a single part of a file, as described by the 'part' dictionary returned by the upload service. 
+      Only the part's byte range (from 'startOffset' to 'endOffset', inclusive) is read, by calling read_part(offset, size). """
+      
+      size = part['endOffset'] - part['startOffset'] + 1
+      data = read_part(part['startOffset'], size)
+         
+      response = self.put('{0}/{1}'.format(upload_url, part["partNo"]), data=data)
+      return part["partNo"]
+
+   def list_files(self, article_id, page=None, page_size=100):
+      """ List the files associated with a given article. If a page number (counting from 1) is given, only that page of 'page_size' files
+      is returned. Otherwise, all the files are returned (see iter_files). """
+      if(page is None):
+         return list(self.iter_files(article_id, page_size=page_size))
+      response = self.get('/account/articles/%s/files' % str(article_id), params={"page": page, "page_size": page_size}, headers=self.get_headers(token=self.token), cache_ttl=0)
+      files = json.loads(response.content)
       return files
+
+   def iter_files(self, article_id, page_size=100, prefetch=False):
+      """ Iterate over the files associated with a given article, fetching 'page_size' files at a time as they are needed.
+      If 'prefetch' is True, the next page is fetched in the background. See pyrdm.pagination.paginate. """
+      return paginate(lambda page, page_size: self.list_files(article_id, page=page, page_size=page_size), page_size=page_size, prefetch=prefetch)
       
    def delete_file(self, article_id, file_id):
       """ Delete a file associated with a given article. """
-      response = self.delete('/articles/%s/files/%s' % (str(article_id), str(file_id)), headers=self.get_headers(token=self.token))
-      response = json.loads(response.body_string())
-      return response
+      # NOTE: The server responds with '204 No Content', so there is nothing to return.
+      self.delete('/account/articles/%s/files/%s' % (str(article_id), str(file_id)), headers=self.get_headers(token=self.token))
+      return
 
    def get_file_details(self, article_id, file_id):
       """ Get the details about a file associated with a given article. """
       response = self.get('/account/articles/%s/files/%s' % (str(article_id), str(file_id)), headers=self.get_headers(token=self.token))
-      response = json.loads(response.body_string())
+      response = json.loads(response.content)
       return response
 
    def reserve_doi(self, article_id):
       """ Reserve a DOI for the article. """
       response = self.post('/account/articles/%s/reserve_doi' % str(article_id), headers=self.get_headers(token=self.token))
       
-      response = json.loads(response.body_string())
+      response = json.loads(response.content)
       
       if not "error" in response.keys():
          doi = str(response["doi"])
@@ -269,7 +508,7 @@ class Figshare(Resource):
    def publish(self, article_id):
       """ Publish the article and make it public. """
       response = self.post('/account/articles/%s/publish' % str(article_id), headers=self.get_headers(token=self.token))
-      response = json.loads(response.body_string())
+      response = json.loads(response.content)
       return response
 
 
@@ -19,11 +19,159 @@
 
 import sys, os
 import logging
+import unittest
+import tempfile
+import tarfile
+import zipfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import shutil
+import hashlib
+import time
+import subprocess
+import multiprocessing
+from distutils.spawn import find_executable
 import git
-from urllib2 import urlopen
+import requests
+
+from pyrdm.checksum import CHUNK_SIZE
 
 _LOG = logging.getLogger(__name__)
 
+# The supported archive formats, and the extension of their file names.
+ARCHIVE_FORMATS = {"zip": ".zip", "tar.gz": ".tar.gz", "tar.zst": ".tar.zst"}
+# The range of compression levels accepted by the compressor used for each archive format.
+COMPRESSION_LEVELS = {"zip": (0, 9), "tar.gz": (1, 9), "tar.zst": (1, 22)}
+
+def get_compressor(archive_format, level=None, threads=None):
+   """ Return the command which compresses the output of 'git archive --format=tar' into an archive of a given format (or None if 
+   'git archive' creates the format itself). Where possible, the command uses 'threads' threads (by default, one per CPU core). """
+   if(threads is None):
+      threads = multiprocessing.cpu_count()
+   if(archive_format in COMPRESSION_LEVELS and level is not None):
+      lowest, highest = COMPRESSION_LEVELS[archive_format]
+      if(level < lowest or level > highest):
+         raise ValueError("The compression level for %s archives must be between %d and %d (not %d)." % (archive_format, lowest, highest, level))
+   if(archive_format == "zip"):
+      return None
+   elif(archive_format == "tar.gz"):
+      # pigz writes the same format as gzip, but compresses blocks of the archive in parallel.
+      if(find_executable("pigz")):
+         command = ["pigz", "-p", str(threads)]
+      else:
+         _LOG.debug("pigz could not be found, so the archive will be compressed by gzip using a single thread.")
+         command = ["gzip"]
+      command += ["-c", "-n"]
+   elif(archive_format == "tar.zst"):
+      if(not find_executable("zstd")):
+         raise OSError("zstd must be installed to create .tar.zst archives.")
+      command = ["zstd", "-c", "-q", "-T%d" % threads]
+      if(level is not None and level > 19):
+         command.append("--ultra")
+   else:
+      raise ValueError("Unknown archive format '%s'. The supported formats are: %s." % (archive_format, ", ".join(sorted(ARCHIVE_FORMATS))))
+   if(level is not None):
+      command.append("-%d" % level)
+   return command
+
+def download(url, path, attempts=5, timeout=60, delay=1.0):
+   """ Download the file at 'url' to 'path' a block at a time (so that the memory used does not depend on the size of the file), 
+   and return its MD5 checksum, which is computed as the file is downloaded. Return None if the file could not be downloaded.
+   The data is written to 'path' + '.part' until the download is complete. If the download is interrupted, it is resumed from the end of 
+   the partial file using an HTTP Range request, both when it is retried (up to 'attempts' times, waiting 'delay' seconds before the first retry
+   and twice as long before each subsequent one) and the next time the same file is downloaded. """
+   partial_path = path + ".part"
+   etag_path = partial_path + ".etag"
+   for attempt in range(attempts):
+      if(attempt > 0):
+         time.sleep(min(delay*2**(attempt-1), 30))
+
+      # Hash the data that has already been downloaded (if any), and ask for the rest.
+      checksum = hashlib.md5()
+      offset = 0
+      # NOTE: The data must not be compressed in transit, since byte ranges refer to the data as it is sent.
+      headers = {"Accept-Encoding": "identity"}
+      if(os.path.exists(partial_path)):
+         with open(partial_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+               checksum.update(chunk)
+               offset += len(chunk)
+      if(offset > 0):
+         headers["Range"] = "bytes=%d-" % offset
+         # Only accept the rest of the file if it has not changed since the partial file was downloaded. Otherwise, the whole file is sent.
+         if(os.path.exists(etag_path)):
+            with open(etag_path, "r") as f:
+               headers["If-Range"] = f.read()
+
+      try:
+         response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+         if(offset > 0 and response.status_code == requests.codes.requested_range_not_satisfiable):
+            # The partial file cannot be continued, so start again.
+            os.remove(partial_path)
+            continue
+         response.raise_for_status()
+         if(response.status_code != requests.codes.partial_content):
+            # The whole file is being sent (because the server does not support ranges, or the file has changed).
+            checksum = hashlib.md5()
+            offset = 0
+         
+         etag = response.headers.get("ETag")
+         if(etag is not None and not etag.startswith("W/")): # Weak ETags cannot be used in If-Range headers.
+            with open(etag_path, "w") as f:
+               f.write(etag)
+         elif(os.path.exists(etag_path)):
+            os.remove(etag_path)
+
+         expected_size = None
+         if("Content-Length" in response.headers):
+            expected_size = offset + int(response.headers["Content-Length"])
+
+         with open(partial_path, "ab" if offset > 0 else "wb") as f:
+            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+               f.write(chunk)
+               checksum.update(chunk)
+               offset += len(chunk)
+         if(expected_size is not None and offset != expected_size):
+            raise IOError("Only %d of %d bytes were received." % (offset, expected_size))
+      except requests.exceptions.HTTPError as e:
+         if(e.response.status_code < 500 and e.response.status_code not in (requests.codes.request_timeout, requests.codes.too_many_requests)):
+            # Trying again will not help (e.g. the file does not exist).
+            _LOG.error("Could not download %s (%s)." % (url, e))
+            return None
+         _LOG.warning("The download of %s failed (%s)." % (url, e))
+         continue
+      except (requests.exceptions.RequestException, IOError) as e:
+         _LOG.warning("The download of %s was interrupted (%s)." % (url, e))
+         continue
+
+      os.rename(partial_path, path)
+      if(os.path.exists(etag_path)):
+         os.remove(etag_path)
+      return checksum.hexdigest()
+   return None
+
+class ArchiveStream:
+   """ A file-like object from which an archive is read as it is written by a 'git archive' process (and any compressor that its output is piped through), without saving it to disk. 
+   Once the end of the archive is reached, an exception is raised if any of the processes failed, so that a truncated archive is never mistaken for a complete one. """
+
+   def __init__(self, processes):
+      self.processes = processes
+      return
+
+   def read(self, size=-1):
+      data = self.processes[-1].stdout.read(size)
+      if(not data):
+         for process in self.processes:
+            # NOTE: The 'git archive' process raises git.GitCommandError itself if it failed.
+            status = process.wait()
+            if(status != 0):
+               raise IOError("The archive could not be created (a process exited with status %d)." % status)
+      return data
+
+   def close(self):
+      self.processes[-1].stdout.close()
+      return
+
 class GitHandler:
 
    def __init__(self, repository_location):
@@ -34,46 +182,199 @@ class GitHandler:
          sys.exit(1)
       return
       
-   def archive(self, sha, archive_path):
-      """ Create a .zip archive of the git repository for a given SHA-1 hash. Saves the archive to 'archive_path'. """
+   def archive(self, sha, archive_path, archive_format="zip", level=None, threads=None):
+      """ Create an archive of the git repository for a given SHA-1 hash, in one of the ARCHIVE_FORMATS. Saves the archive to 'archive_path'
+      and returns its MD5 checksum, which is computed as the archive is written (or None if the archive could not be created). 
+      The compression level can be given in 'level' (by default, that of the compressor is used). See archive_stream. 
+      The archive is only downloaded from GitHub instead if the commit is not in the local repository. """
+      if(self.get_tree_sha(sha) is None):
+         # Perhaps the local version of the software is out-of-date. Let's try and download the archive from GitHub instead...
+         _LOG.debug("The commit %s is not in the local repository." % sha)
+         return self.get_archive_from_server(sha, archive_path, archive_format=archive_format)
+
       try:
-         tree = self.repo.tree(sha)
-         f = open(archive_path, "wb")
-         self.repo.archive(f, treeish=tree, format="zip")
-         f.close()
-      except:
-         # Perhaps the local version of the software is out-of-date, or corrupted.
-         # Let's try and download the .zip file from GitHub instead...
-         success = self.get_archive_from_server(sha, archive_path)
-         return success
-      return True
-
-   def get_archive_from_server(self, sha, archive_path):
-      """ Download a GitHub .zip archive. """
+         get_compressor(archive_format, level=level, threads=threads)
+      except (ValueError, OSError) as e:
+         # The archive format is not supported on this system.
+         _LOG.error(str(e))
+         return None
+
+      try:
+         stream = self.archive_stream(sha, archive_format=archive_format, level=level, threads=threads)
+         checksum = hashlib.md5()
+         # The archive is written to a temporary file and then renamed, so an existing file at 'archive_path' is replaced rather than overwritten.
+         # This matters because that file may be a hard link to an archive in the archive cache.
+         temporary_path = "%s.%d.%d.tmp" % (archive_path, os.getpid(), threading.current_thread().ident)
+         try:
+            with open(temporary_path, "wb") as f:
+               for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                  checksum.update(chunk)
+                  f.write(chunk)
+            os.rename(temporary_path, archive_path)
+         finally:
+            stream.close()
+            if(os.path.exists(temporary_path)):
+               os.remove(temporary_path)
+      except Exception as e:
+         # NOTE: GitHub's archive has different contents (and would be cached under the local tree's key), so it is not used as a fallback here.
+         _LOG.error("Could not archive the local repository: %s" % e)
+         return None
+      return checksum.hexdigest()
+
+   def archive_stream(self, sha, archive_format="zip", level=None, threads=None):
+      """ Return an ArchiveStream from which an archive of the git repository for a given SHA-1 hash is read as it is created. 
+      The .tar.gz and .tar.zst formats are compressed using 'threads' threads (by default, one per CPU core) if pigz or zstd is available. """
+      tree = self.repo.tree(sha)
+      compressor = get_compressor(archive_format, level=level, threads=threads)
+      if(compressor is None):
+         options = [] if level is None else ["-%d" % level]
+         process = self.repo.git.archive(*(options + [tree.hexsha]), format=archive_format, as_process=True)
+         return ArchiveStream([process])
+
+      process = self.repo.git.archive(tree.hexsha, format="tar", as_process=True)
+      try:
+         compress = subprocess.Popen(compressor, stdin=process.stdout, stdout=subprocess.PIPE)
+      finally:
+         # The compressor now holds the only copy of the pipe, so it is closed when the compressor exits.
+         process.stdout.close()
+      return ArchiveStream([process, compress])
+
+   def get_archive_from_server(self, sha, archive_path, archive_format="zip"):
+      """ Download a GitHub .zip or .tar.gz archive to 'archive_path', and return its MD5 checksum (or None if it could not be downloaded). 
+      The archive is streamed to disk, and an interrupted download is resumed (see download). """
       
-      # Obtain the origin's URL and get the repository name from that.
+      if(archive_format not in ("zip", "tar.gz")):
+         _LOG.error("GitHub does not provide archives in the %s format." % archive_format)
+         return None
+
+      remote_url = "%s/archive/%s%s" % (self.get_origin_url(), sha, ARCHIVE_FORMATS[archive_format])
+   
+      _LOG.info("Downloading software from GitHub (URL: %s)..." % remote_url)
+      md5 = download(remote_url, archive_path)
+      if(md5 is None):
+         _LOG.error("Could not obtain archive from the GitHub server.")
+         return None
+
+      _LOG.info("Download successful.")
+      return md5
+
+   def get_origin_url(self):
+      """ Return the web address of the 'origin' remote repository (e.g. https://github.com/user/repository). """
       origin_url = self.repo.remotes.origin.url
+      if(origin_url.startswith("git@")):
+         # Convert an SSH address of the form git@github.com:user/repository.git
+         origin_url = "https://" + origin_url[len("git@"):].replace(":", "/", 1)
       if(origin_url.endswith(".git")):
-         origin_url = origin_url.replace(".git", "")
-      repository_name = os.path.basename(origin_url)
-      
-      remote_url = "%s/archive/%s.zip" % (origin_url, sha)
-   
-      _LOG.info("Downloading software from GitHub (URL: %s)..." % origin_url)
-      f = urlopen(origin_url)
+         origin_url = origin_url[:-len(".git")]
+      return origin_url
+
+   def get_tree_sha(self, sha):
+      """ Return the SHA-1 hash of the tree of the commit with a given SHA-1 hash, or None if the commit is not in the local repository. """
       try:
-         local_file = open(archive_path, "wb")
-         local_file.write(f.read())
+         return self.repo.tree(sha).hexsha
       except:
-         _LOG.error("Could not obtain archive from the GitHub server.")
-         return False
+         return None
 
-      _LOG.info("Download successful.")
-      return True
-      
    def get_head_version(self):
       return self.repo.head.commit.hexsha
 
    def get_working_directory(self):
       return self.repo.working_dir
 
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's GitHandler module. """
+
+   def setUp(self):
+      self.git_handler = GitHandler(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+      self.version = self.git_handler.get_head_version()
+      self.directory = tempfile.mkdtemp()
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def test_archive_formats(self):
+      path = os.path.join(self.directory, "archive.zip")
+      assert(self.git_handler.archive(self.version, path))
+      assert("pyrdm/git_handler.py" in zipfile.ZipFile(path).namelist())
+
+      path = os.path.join(self.directory, "archive.tar.gz")
+      assert(self.git_handler.archive(self.version, path, archive_format="tar.gz", level=1, threads=2))
+      assert("pyrdm/git_handler.py" in tarfile.open(path, "r:gz").getnames())
+
+      if(find_executable("zstd")):
+         path = os.path.join(self.directory, "archive.tar.zst")
+         assert(self.git_handler.archive(self.version, path, archive_format="tar.zst", level=3, threads=2))
+         assert(open(path, "rb").read(4) == b"\x28\xb5\x2f\xfd") # The zstd frame's magic number.
+
+      assert(not self.git_handler.archive(self.version, os.path.join(self.directory, "archive.rar"), archive_format="rar"))
+
+   def test_archive_level(self):
+      self.assertRaises(ValueError, get_compressor, "zip", level=12)
+      self.assertRaises(ValueError, get_compressor, "tar.zst", level=0)
+      # A bad compression level must not fall back to downloading GitHub's archive, since the commit is in the local repository.
+      def get_archive_from_server(*args, **kwargs):
+         raise AssertionError("The archive should not be downloaded.")
+      self.git_handler.get_archive_from_server = get_archive_from_server
+      assert(self.git_handler.archive(self.version, os.path.join(self.directory, "archive.zip"), level=12) is None)
+      assert(os.listdir(self.directory) == [])
+
+   def test_archive_replaces_file(self):
+      # An existing archive is replaced rather than overwritten, so a hard link to it (e.g. in the archive cache) keeps its contents.
+      path = os.path.join(self.directory, "archive.tar.gz")
+      md5 = self.git_handler.archive(self.version, path, archive_format="tar.gz", level=1)
+      os.link(path, os.path.join(self.directory, "cached.tar.gz"))
+      assert(self.git_handler.archive(self.version, path, archive_format="tar.gz", level=9) is not None)
+      with open(os.path.join(self.directory, "cached.tar.gz"), "rb") as f:
+         assert(hashlib.md5(f.read()).hexdigest() == md5)
+      assert(sorted(os.listdir(self.directory)) == ["archive.tar.gz", "cached.tar.gz"])
+
+   def test_download_resume(self):
+      data = os.urandom(300*1024)
+      requests_received = []
+      class Handler(BaseHTTPRequestHandler):
+         """ Serves 'data', but breaks off the first response half-way through. """
+         def do_GET(self):
+            requests_received.append(self.headers.get("Range"))
+            offset = 0
+            if(self.headers.get("Range") is not None and self.headers.get("If-Range") == '"v1"'):
+               offset = int(self.headers["Range"].split("=")[1].rstrip("-"))
+               self.send_response(206)
+               self.send_header("Content-Range", "bytes %d-%d/%d" % (offset, len(data)-1, len(data)))
+            else:
+               self.send_response(200)
+            self.send_header("Content-Length", str(len(data) - offset))
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            if(len(requests_received) == 1):
+               self.wfile.write(data[:len(data)//2])
+            else:
+               self.wfile.write(data[offset:])
+         def log_message(self, *args):
+            pass
+      server = HTTPServer(("127.0.0.1", 0), Handler)
+      thread = threading.Thread(target=server.serve_forever)
+      thread.daemon = True
+      thread.start()
+      try:
+         path = os.path.join(self.directory, "download.zip")
+         md5 = download("http://127.0.0.1:%d/archive.zip" % server.server_address[1], path, delay=0)
+      finally:
+         server.shutdown()
+         server.server_close()
+      assert(requests_received == [None, "bytes=%d-" % (len(data)//2)])
+      assert(md5 == hashlib.md5(data).hexdigest())
+      assert(open(path, "rb").read() == data)
+      assert(os.listdir(self.directory) == ["download.zip"]) # The partial file has been removed.
+
+   def test_archive_stream_failure(self):
+      stream = self.git_handler.archive_stream(self.version, archive_format="tar.gz")
+      stream.processes[0].kill() # Simulate 'git archive' failing part-way through.
+      def read_all():
+         while stream.read(4096):
+            pass
+      self.assertRaises(Exception, read_all)
+
+if(__name__ == '__main__'):
+   unittest.main()
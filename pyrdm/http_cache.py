@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+import errno
+import json
+import time
+import hashlib
+import unittest
+import tempfile
+import shutil
+
+_LOG = logging.getLogger(__name__)
+
+class HTTPCache:
+   """ An on-disk cache of the responses to HTTP GET requests. Each response is stored along with its ETag and Last-Modified headers,
+   so that it can be revalidated with a conditional request, and the time at which it was stored, so that it can be re-used without
+   contacting the server at all for a given length of time. """
+
+   def __init__(self, directory):
+      """ Open (or create) the cache stored in the directory with path 'directory'. """
+      self.directory = directory
+      # The cached responses may contain private details of the user's account.
+      try:
+         os.makedirs(directory, 0o700)
+      except OSError as e:
+         if(e.errno != errno.EEXIST): # Another process may have just created it.
+            raise
+      return
+
+   @staticmethod
+   def get_key(url, params=None, headers=None):
+      """ Return the key of the response to a GET request for a given URL, with the query parameters 'params' and the request headers 'headers'.
+      Requests made with different authorisation headers are cached separately. """
+      key = hashlib.sha1()
+      key.update(url.encode("utf-8"))
+      for name, value in sorted((params or {}).items()):
+         key.update(("&%s=%s" % (name, value)).encode("utf-8"))
+      for name, value in (headers or {}).items():
+         if(name.lower() == "authorization"):
+            key.update(("|%s" % value).encode("utf-8"))
+      return key.hexdigest()
+
+   def get(self, key):
+      """ Return the cached response with a given key as a tuple (metadata, content), where 'metadata' is a dictionary containing the
+      response's 'etag' and 'last_modified' headers (either of which may be None) and the time it was 'stored'. Return None if there is no such response. """
+      try:
+         with open(os.path.join(self.directory, key + ".json"), "r") as f:
+            metadata = json.load(f)
+         with open(os.path.join(self.directory, key + ".body"), "rb") as f:
+            content = f.read()
+      except (IOError, ValueError):
+         return None
+      return metadata, content
+
+   def put(self, key, content, etag=None, last_modified=None):
+      """ Store the content of a response, along with its ETag and Last-Modified headers. """
+      self._write(key + ".body", content, "wb")
+      self._write(key + ".json", json.dumps({"etag": etag, "last_modified": last_modified, "stored": time.time()}), "w")
+      return
+
+   def touch(self, key):
+      """ Record that the cached response with a given key has just been revalidated by the server. """
+      entry = self.get(key)
+      if(entry is not None):
+         metadata, content = entry
+         self._write(key + ".json", json.dumps({"etag": metadata["etag"], "last_modified": metadata["last_modified"], "stored": time.time()}), "w")
+      return
+
+   def _write(self, name, data, mode):
+      # Write to a temporary file first, so that other threads and processes never see a partially-written file.
+      path = os.path.join(self.directory, name)
+      temporary_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+      with open(temporary_path, mode) as f:
+         f.write(data)
+      os.rename(temporary_path, path)
+      return
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's HTTP cache module. """
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.cache = HTTPCache(os.path.join(self.directory, "http"))
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def test_http_cache_key(self):
+      url = "https://api.figshare.com/v2/categories"
+      assert(HTTPCache.get_key(url) == HTTPCache.get_key(url, headers={"Content-Type": "application/json"}))
+      assert(HTTPCache.get_key(url) != HTTPCache.get_key(url, params={"page": 2}))
+      assert(HTTPCache.get_key(url) != HTTPCache.get_key(url, headers={"Authorization": "token abc"}))
+
+   def test_http_cache(self):
+      key = HTTPCache.get_key("https://api.figshare.com/v2/categories")
+      assert(self.cache.get(key) is None)
+      self.cache.put(key, b'[{"id": 1, "title": "Computer Software"}]', etag='"abc"')
+      metadata, content = self.cache.get(key)
+      assert(metadata["etag"] == '"abc"')
+      assert(metadata["last_modified"] is None)
+      assert(json.loads(content.decode("utf-8"))[0]["id"] == 1)
+
+   def test_http_cache_threads(self):
+      # Several threads (e.g. the upload workers of a Publisher) may store the same response at once.
+      key = HTTPCache.get_key("https://api.figshare.com/v2/categories")
+      errors = []
+      def put():
+         try:
+            for i in range(50):
+               self.cache.put(key, b"[]")
+         except Exception as e:
+            errors.append(e)
+      threads = [threading.Thread(target=put) for i in range(4)]
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join()
+      assert(errors == [])
+      assert(self.cache.get(key)[1] == b"[]")
+      # The cache's directory may also be created by several processes at once.
+      HTTPCache(self.cache.directory)
+
+if(__name__ == '__main__'):
+   unittest.main()
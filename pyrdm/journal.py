@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import errno
+import json
+import fcntl
+import threading
+import unittest
+import tempfile
+import shutil
+
+_LOG = logging.getLogger(__name__)
+
+class UploadJournal:
+   """ A record, kept on the local file system, of the multi-part uploads that are in progress and of the parts of each upload that have been completed.
+   This allows an interrupted upload to be resumed by sending only the missing parts. The journal is stored as a JSON file,
+   and can safely be shared between threads and between processes. """
+
+   def __init__(self, path, batch_size=16):
+      """ Open (or create) the journal stored in the file with path 'path'.
+      Completed parts are written to the file in batches of up to 'batch_size' parts (see complete_part), rather than one at a time. """
+      self.path = path
+      self.batch_size = batch_size
+      self.pending = {} # The completed parts of each upload which have not yet been written to the file.
+      directory = os.path.dirname(path)
+      if(directory != ""):
+         try:
+            os.makedirs(directory)
+         except OSError as e:
+            if(e.errno != errno.EEXIST): # Another process may have just created it.
+               raise
+      self.lock = threading.Lock()
+      return
+
+   @staticmethod
+   def get_key(article_id, file_path, md5):
+      """ Return the key identifying the upload of a file (with path 'file_path' and MD5 checksum 'md5') to an article with a given article_id. """
+      return "%s:%s:%s" % (str(article_id), os.path.abspath(file_path), md5)
+
+   def _load(self):
+      try:
+         with open(self.path, "r") as f:
+            return json.load(f)
+      except (IOError, ValueError):
+         return {}
+
+   def _merge_pending(self, entries):
+      """ Add the completed parts which have not yet been written to the file to the journal's entries. Must be called while holding the thread lock. """
+      for key, part_numbers in self.pending.items():
+         if(key in entries):
+            parts = set(entries[key]["parts"])
+            parts.update(part_numbers)
+            entries[key]["parts"] = sorted(parts)
+      self.pending = {}
+      return
+
+   def _update(self, modify):
+      """ Apply the function 'modify' to the journal's entries and write them back, while holding both the thread lock and an exclusive lock on the journal file. """
+      with self.lock:
+         with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+               entries = self._load()
+               self._merge_pending(entries)
+               modify(entries)
+               temporary_path = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.current_thread().ident)
+               with open(temporary_path, "w") as f:
+                  json.dump(entries, f)
+               os.rename(temporary_path, self.path)
+            finally:
+               fcntl.flock(lock_file, fcntl.LOCK_UN)
+      return
+
+   def get(self, key):
+      """ Return the journal entry for the upload with a given key (a dictionary containing the 'file_location', the 'upload_url' and the list of completed 'parts'),
+      or None if the upload is not in progress. """
+      with self.lock:
+         entries = self._load()
+         entry = entries.get(key)
+         if(entry is not None and key in self.pending):
+            entry["parts"] = sorted(set(entry["parts"]) | self.pending[key])
+         return entry
+
+   def start(self, key, file_location, upload_url):
+      """ Record the start of a new upload with a given key, which will be sent to the URL 'upload_url'. """
+      def modify(entries):
+         entries[key] = {"file_location": file_location, "upload_url": upload_url, "parts": []}
+      self._update(modify)
+      return
+
+   def complete_part(self, key, part_number):
+      """ Record that the part with a given part_number of the upload with a given key has been uploaded.
+      Rewriting the whole journal for every part would take time proportional to the square of the number of parts, so the part is
+      only written to the file once 'batch_size' parts are waiting (or when flush is called). If the process is killed before then,
+      those parts are simply uploaded again when the upload is resumed. """
+      with self.lock:
+         self.pending.setdefault(key, set()).add(part_number)
+         waiting = sum(len(part_numbers) for part_numbers in self.pending.values())
+      if(waiting >= self.batch_size):
+         self.flush()
+      return
+
+   def flush(self):
+      """ Write any completed parts which are still waiting to the journal file. """
+      with self.lock:
+         if(len(self.pending) == 0):
+            return
+      self._update(lambda entries: None)
+      return
+
+   def remove(self, key):
+      """ Remove the upload with a given key from the journal, once it has been completed (or abandoned). """
+      def modify(entries):
+         entries.pop(key, None)
+      with self.lock:
+         self.pending.pop(key, None)
+      self._update(modify)
+      return
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's upload journal module. """
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.journal = UploadJournal(os.path.join(self.directory, "uploads", "journal.json"))
+      self.key = UploadJournal.get_key(1234, "test_file.txt", "e6bee908f14f172a54c920e06b5e9db0")
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def test_journal(self):
+      assert(self.journal.get(self.key) is None)
+      self.journal.start(self.key, "https://api.figshare.com/v2/account/articles/1234/files/5678", "https://fup.figshare.com/upload/abc")
+      self.journal.complete_part(self.key, 1)
+      self.journal.complete_part(self.key, 3)
+      self.journal.complete_part(self.key, 3)
+      self.journal.flush()
+
+      # Re-open the journal, as if the upload had been interrupted.
+      journal = UploadJournal(self.journal.path)
+      entry = journal.get(self.key)
+      _LOG.debug("Journal entry: %s" % (entry,))
+      assert(entry["upload_url"] == "https://fup.figshare.com/upload/abc")
+      assert(sorted(entry["parts"]) == [1, 3])
+
+      journal.remove(self.key)
+      assert(self.journal.get(self.key) is None)
+
+   def test_journal_batch(self):
+      journal = UploadJournal(self.journal.path, batch_size=3)
+      journal.start(self.key, "https://api.figshare.com/v2/account/articles/1234/files/5678", "https://fup.figshare.com/upload/abc")
+      journal.complete_part(self.key, 1)
+      journal.complete_part(self.key, 2)
+      # The parts are visible through this journal, but have not been written to the file yet.
+      assert(journal.get(self.key)["parts"] == [1, 2])
+      assert(UploadJournal(journal.path).get(self.key)["parts"] == [])
+      journal.complete_part(self.key, 3)
+      assert(UploadJournal(journal.path).get(self.key)["parts"] == [1, 2, 3])
+      journal.complete_part(self.key, 4)
+      journal.flush()
+      assert(UploadJournal(journal.path).get(self.key)["parts"] == [1, 2, 3, 4])
+
+if(__name__ == '__main__'):
+   unittest.main()
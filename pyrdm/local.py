@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import errno
+import json
+import time
+import fcntl
+import hashlib
+import shutil
+import threading
+import unittest
+import tempfile
+
+from pyrdm.checksum import CHUNK_SIZE
+
+_LOG = logging.getLogger(__name__)
+
+# The DOI prefix reserved by DataCite for testing. DOIs with this prefix never resolve.
+DOI_PREFIX = "10.5072"
+
+class Local:
+   """ A publishing service which stores its publications in a directory on the local file system, rather than on a server.
+   Its interface (and the publications' details) follow those of the Figshare interface: each publication is an 'article' 
+   with a reserved DOI and a list of files, which stays private until it is published. No network access is needed, so it can be used
+   as a staging area, or to measure the overhead of PyRDM itself. """
+
+   def __init__(self, path):
+      """ Store the publications in the directory with path 'path', creating it if necessary. """
+      self.path = path
+      self.articles_path = os.path.join(path, "articles")
+      try:
+         os.makedirs(self.articles_path)
+      except OSError as e:
+         if(e.errno != errno.EEXIST): # Another process may have just created it.
+            raise
+      self.lock = threading.Lock()
+      return
+
+   def _article_path(self, article_id):
+      return os.path.join(self.articles_path, str(article_id))
+
+   def _load(self, article_id):
+      try:
+         with open(os.path.join(self._article_path(article_id), "article.json"), "r") as f:
+            return json.load(f)
+      except (IOError, ValueError):
+         return None
+
+   def _save(self, article):
+      path = os.path.join(self._article_path(article["id"]), "article.json")
+      temporary_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+      with open(temporary_path, "w") as f:
+         json.dump(article, f)
+      os.rename(temporary_path, path)
+      return
+
+   def _update(self, modify, article_id=None):
+      """ Apply the function 'modify' to the details of the article with a given article_id (or, if article_id is None, to the store's counter of IDs),
+      and write them back, while holding both the thread lock and an exclusive lock on the store. Return the result of 'modify'. """
+      with self.lock:
+         with open(os.path.join(self.path, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+               if(article_id is None):
+                  return modify(None)
+               article = self._load(article_id)
+               if(article is None):
+                  raise KeyError("Article %s does not exist." % str(article_id))
+               result = modify(article)
+               article["modified_date"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+               self._save(article)
+               return result
+            finally:
+               fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+   def _next_id(self, counter):
+      """ Return the next unused ID from the counter stored in the file called 'counter'. Must be called from within _update. """
+      path = os.path.join(self.path, counter)
+      try:
+         with open(path, "r") as f:
+            next_id = int(f.read())
+      except (IOError, ValueError):
+         next_id = 1
+      with open(path, "w") as f:
+         f.write(str(next_id + 1))
+      return next_id
+
+   def create_article(self, title, description, defined_type, tags, categories):
+      """ Creates a new (private) article. Returns the ID of the article. """
+      if isinstance(categories, int):
+         categories = [categories]
+      def create(unused):
+         article_id = self._next_id("next_article_id")
+         os.makedirs(os.path.join(self._article_path(article_id), "files"))
+         self._save({"id": article_id, "title": title, "description": description, "defined_type": defined_type, "tags": list(tags), 
+                     "categories": list(categories), "authors": [], "doi": "", "is_public": False, "version": 0, "files": []})
+         return article_id
+      return self._update(create)
+
+   def delete_article(self, article_id):
+      """ Delete a private article with a given article_id. Public articles cannot be deleted. """
+      article = self._load(article_id)
+      if(article is None or article["is_public"]):
+         return {"success": False}
+      shutil.rmtree(self._article_path(article_id))
+      return {"success": True}
+
+   def get_article_details(self, article_id, private=False):
+      """ Return the details of an article with a given article ID, or None if it does not exist. Private articles are only returned if 'private' is True. """
+      article = self._load(article_id)
+      if(article is None or (not private and not article["is_public"])):
+         return None
+      return article
+
+   def list_articles(self):
+      """ Return the details of all the articles (both public and private). """
+      articles = [self._load(article_id) for article_id in sorted(os.listdir(self.articles_path))]
+      return [article for article in articles if article is not None]
+
+   def search(self, keyword, private=False):
+      """ Return the details of the articles whose title or tags contain the keyword. Private articles are only searched if 'private' is True. """
+      results = []
+      for article_id in sorted(os.listdir(self.articles_path)):
+         article = self._load(article_id)
+         if(article is None or (not private and not article["is_public"])):
+            continue
+         if(keyword.lower() in article["title"].lower() or keyword in article["tags"]):
+            results.append(article)
+      return results
+
+   def add_category(self, article_id, category):
+      """ For an article with a given article_id, add a category (given by its name). """
+      def modify(article):
+         if(category not in article["categories"]):
+            article["categories"].append(category)
+      self._update(modify, article_id)
+      return {"success": True}
+
+   def add_authors(self, article_id, authors):
+      """ Associate author(s) with this article. """
+      if(not isinstance(authors, list)):
+         authors = [authors]
+      def modify(article):
+         article["authors"] += authors
+      self._update(modify, article_id)
+      return
+
+   def add_file(self, article_id, file_path, md5=None):
+      """ Copies a file with path 'file_path' into the article with a given article_id, and returns the ID of the file. 
+      If the file's MD5 checksum is given in 'md5', it is compared against the checksum of the stored copy. """
+      with open(file_path, "rb") as source:
+         file_id, computed_md5 = self.add_file_from_stream(article_id, os.path.basename(file_path), source, md5=md5)
+      return file_id
+
+   def add_file_from_stream(self, article_id, name, stream, md5=None):
+      """ Copies the data read from the file-like object 'stream' into the article with a given article_id, as a file called 'name'.
+      Returns a tuple (file_id, md5) containing the ID and MD5 checksum of the stored file.
+      If the data's MD5 checksum is given in 'md5', it is compared against the checksum of the stored copy. """
+      file_id = self._update(lambda unused: self._next_id("next_file_id"))
+      directory = os.path.join(self._article_path(article_id), "files", str(file_id))
+      os.makedirs(directory)
+      
+      # Compute the checksum of the copy as it is written.
+      checksum = hashlib.md5()
+      size = 0
+      try:
+         with open(os.path.join(directory, name), "wb") as destination:
+            while True:
+               chunk = stream.read(CHUNK_SIZE)
+               if(not chunk):
+                  break
+               checksum.update(chunk)
+               destination.write(chunk)
+               size += len(chunk)
+      except:
+         shutil.rmtree(directory)
+         raise
+      computed_md5 = checksum.hexdigest()
+      if(md5 is not None and computed_md5 != md5):
+         shutil.rmtree(directory)
+         raise Exception("The checksum of the stored file %s (%s) does not match the local checksum (%s)." % (name, computed_md5, md5))
+      
+      def modify(article):
+         article["files"].append({"id": file_id, "name": name, "size": size, "computed_md5": computed_md5, "supplied_md5": md5 or ""})
+      self._update(modify, article_id)
+      return file_id, computed_md5
+
+   def has_pending_upload(self, article_id, file_path, md5):
+      """ Files are copied in one go, so there are never any interrupted uploads to resume. """
+      return False
+
+   def list_files(self, article_id):
+      """ List all the files associated with a given article. """
+      article = self._load(article_id)
+      if(article is None):
+         raise KeyError("Article %s does not exist." % str(article_id))
+      return article["files"]
+
+   def get_file_details(self, article_id, file_id):
+      """ Get the details about a file associated with a given article, or None if there is no such file. """
+      for f in self.list_files(article_id):
+         if(f["id"] == file_id):
+            return f
+      return None
+
+   def delete_file(self, article_id, file_id):
+      """ Delete a file associated with a given article. """
+      def modify(article):
+         article["files"] = [f for f in article["files"] if f["id"] != file_id]
+      self._update(modify, article_id)
+      shutil.rmtree(os.path.join(self._article_path(article_id), "files", str(file_id)), ignore_errors=True)
+      return
+
+   def get_file_path(self, article_id, file_id):
+      """ Return the path to the stored copy of a file associated with a given article. """
+      f = self.get_file_details(article_id, file_id)
+      return os.path.join(self._article_path(article_id), "files", str(file_id), f["name"])
+
+   def reserve_doi(self, article_id):
+      """ Reserve a (test) DOI for the article. """
+      def modify(article):
+         if(article["doi"] == ""):
+            article["doi"] = "%s/pyrdm.local.%d" % (DOI_PREFIX, article["id"])
+         return str(article["doi"])
+      return self._update(modify, article_id)
+
+   def publish(self, article_id):
+      """ Publish the article and make it public. Each time an article is published, its version number is incremented. """
+      def modify(article):
+         article["is_public"] = True
+         article["version"] += 1
+         return {"location": article["doi"]}
+      return self._update(modify, article_id)
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's local publishing service module. """
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.local = Local(os.path.join(self.directory, "store"))
+      self.article_id = self.local.create_article(title="PyRDM Test", description="PyRDM Test Article", tags=["test", "article"], defined_type="code", categories=[])
+      self.file_path = os.path.join(self.directory, "test_file.txt")
+      f = open(self.file_path, "w")
+      f.write("This is a test file for PyRDM's Figshare module unit tests")
+      f.close()
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def test_local_add_file(self):
+      file_id = self.local.add_file(self.article_id, self.file_path, md5="e6bee908f14f172a54c920e06b5e9db0")
+      details = self.local.get_file_details(self.article_id, file_id)
+      assert(details["name"] == "test_file.txt")
+      assert(details["computed_md5"] == "e6bee908f14f172a54c920e06b5e9db0")
+      assert(open(self.local.get_file_path(self.article_id, file_id)).read() == open(self.file_path).read())
+
+      self.local.delete_file(self.article_id, file_id)
+      assert(self.local.list_files(self.article_id) == [])
+      self.assertRaises(Exception, self.local.add_file, self.article_id, self.file_path, md5="0"*32)
+
+   def test_local_add_file_from_stream(self):
+      with open(self.file_path, "rb") as stream:
+         file_id, md5 = self.local.add_file_from_stream(self.article_id, "streamed.txt", stream)
+      assert(md5 == "e6bee908f14f172a54c920e06b5e9db0")
+      details = self.local.get_file_details(self.article_id, file_id)
+      assert(details["name"] == "streamed.txt" and details["size"] == os.path.getsize(self.file_path))
+
+   def test_local_publish(self):
+      doi = self.local.reserve_doi(self.article_id)
+      assert(doi == "10.5072/pyrdm.local.%d" % self.article_id)
+      assert(self.local.get_article_details(self.article_id) is None) # Private articles are only visible to their owner.
+      assert(self.local.search("PyRDM Test") == [])
+
+      self.local.publish(self.article_id)
+      details = self.local.get_article_details(self.article_id)
+      assert(details["is_public"] and details["version"] == 1 and details["doi"] == doi)
+      assert(len(self.local.search("article")) == 1)
+      assert(not self.local.delete_article(self.article_id)["success"])
+
+if(__name__ == '__main__'):
+   unittest.main()
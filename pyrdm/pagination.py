@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+import unittest
+
+_LOG = logging.getLogger(__name__)
+
+class _Prefetch(threading.Thread):
+   """ Fetches a page in the background, so that it is ready by the time the caller has finished with the previous page. """
+
+   def __init__(self, fetch_page, page, page_size):
+      threading.Thread.__init__(self)
+      self.daemon = True # Do not keep the program running if the caller stops iterating before the page arrives.
+      self.fetch_page = fetch_page
+      self.page = page
+      self.page_size = page_size
+      self.result = None
+      self.error = None
+      self.start()
+      return
+
+   def run(self):
+      try:
+         self.result = self.fetch_page(self.page, self.page_size)
+      except BaseException as e:
+         # Anything raised here (including a SystemExit) must reach the caller. Otherwise, the page would look empty, and the listing would end early.
+         self.error = e
+      return
+
+   def get(self):
+      """ Wait for the page to arrive, and return it (or re-raise the exception raised while fetching it). """
+      self.join()
+      if(self.error is not None):
+         raise self.error
+      return self.result
+
+def paginate(fetch_page, page_size=100, prefetch=False, first_page=1):
+   """ Iterate over the items in a paginated listing, fetching each page only once the items in the previous page have been used.
+   The function fetch_page(page, page_size) must return the list of items in a given page (numbered from 'first_page'). The listing ends with the first
+   page that holds fewer than 'page_size' items. Only one or two pages are held in memory at a time, and the caller can stop at any point
+   without the remaining pages being fetched. If 'prefetch' is True, the next page is fetched in the background while the items in the current one 
+   are being used. If the server ignores the page number (and sends the same page again), the listing ends rather than repeating forever. """
+   page = first_page
+   previous = None
+   pending = None
+   while True:
+      if(pending is not None):
+         items = pending.get()
+         pending = None
+      else:
+         items = fetch_page(page, page_size)
+      if(not items):
+         return
+      if(items == previous):
+         _LOG.warning("Page %d of the listing is the same as the previous page, so the server probably does not support pagination. Stopping here." % page)
+         return
+      last_page = (len(items) < page_size)
+      if(prefetch and not last_page):
+         pending = _Prefetch(fetch_page, page + 1, page_size)
+      for item in items:
+         yield item
+      if(last_page):
+         return
+      previous = items
+      page += 1
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's pagination module. """
+
+   def setUp(self):
+      self.items = list(range(25))
+      self.fetched = []
+      return
+
+   def fetch_page(self, page, page_size):
+      self.fetched.append(page)
+      return self.items[(page-1)*page_size:page*page_size]
+
+   def test_paginate(self):
+      assert(list(paginate(self.fetch_page, page_size=10)) == self.items)
+      assert(self.fetched == [1, 2, 3])
+      
+      # A listing which fills its last page exactly needs an extra (empty) page to be fetched.
+      self.fetched = []
+      assert(list(paginate(self.fetch_page, page_size=5)) == self.items)
+      assert(self.fetched == [1, 2, 3, 4, 5, 6])
+
+   def test_paginate_early_exit(self):
+      for item in paginate(self.fetch_page, page_size=10):
+         if(item == 3):
+            break
+      assert(self.fetched == [1])
+
+   def test_paginate_prefetch(self):
+      def slow_fetch_page(page, page_size):
+         time.sleep(0.1)
+         return self.fetch_page(page, page_size)
+      start = time.time()
+      for item in paginate(slow_fetch_page, page_size=5, prefetch=True):
+         time.sleep(0.02) # Use each item for a while.
+      assert(sorted(self.fetched) == [1, 2, 3, 4, 5, 6])
+      # Without prefetching, this would take 0.6 + 25*0.02 = 1.1 seconds.
+      assert(time.time() - start < 0.9)
+
+   def test_paginate_repeated_page(self):
+      # A server which ignores the page number.
+      items = list(paginate(lambda page, page_size: self.items[:10], page_size=10))
+      assert(items == self.items[:10])
+
+   def test_paginate_prefetch_error(self):
+      def fetch_page(page, page_size):
+         if(page == 2):
+            raise SystemExit(1)
+         return self.fetch_page(page, page_size)
+      items = paginate(fetch_page, page_size=10, prefetch=True)
+      assert([next(items) for i in range(10)] == self.items[:10])
+      # The failure to fetch the second page is raised, rather than ending the listing as if it were complete.
+      self.assertRaises(SystemExit, next, items)
+
+if(__name__ == '__main__'):
+   unittest.main()
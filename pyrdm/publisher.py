@@ -22,40 +22,125 @@ import logging
 import sys, os
 import unittest
 import re
+import importlib
+import subprocess
+import threading
+import tempfile
+import shutil
 
 import hashlib # For MD5 checksums
-from urllib2 import urlopen
+from multiprocessing.pool import ThreadPool
 
-from pyrdm.figshare import Figshare
-from pyrdm.zenodo import Zenodo
-from pyrdm.dspace import DSpace
-from pyrdm.git_handler import GitHandler
+from pyrdm.checksum import md5sum, md5sum_many
+from pyrdm.checksum_index import ChecksumIndex
+from pyrdm.http_cache import HTTPCache
+from pyrdm.remote_index import RemoteFileIndex
+from pyrdm.archive_cache import ArchiveCache
+from pyrdm.registry import PublicationRegistry
+from pyrdm.auth_cache import AuthenticationError
+from pyrdm.rate_limit import RateLimiter
 
 _LOG = logging.getLogger(__name__)
 
+# The module and class providing the interface to each supported service. A backend (and the libraries it depends on,
+# e.g. requests or sword2) is only imported when a Publisher for that service is created, so that importing this module stays cheap.
+BACKENDS = {"figshare": ("pyrdm.figshare", "Figshare"),
+            "zenodo": ("pyrdm.zenodo", "Zenodo"),
+            "dspace": ("pyrdm.dspace", "DSpace"),
+            "local": ("pyrdm.local", "Local")}
+
+# The services whose publications can be listed, so that the registry of published software can be synchronised with them (see Publisher.sync_registry).
+LISTABLE_SERVICES = ("figshare", "zenodo", "local")
+
+def get_backend(service):
+   """ Return the class providing the interface to a given service, importing its module if necessary. Return None if the service is not supported. """
+   if(service not in BACKENDS):
+      return None
+   module_name, class_name = BACKENDS[service]
+   return getattr(importlib.import_module(module_name), class_name)
+
+# A lock for each version of some software being published (keyed by service, server, name and version), shared by all the Publishers in the process.
+_SOFTWARE_LOCKS = {}
+_SOFTWARE_LOCKS_LOCK = threading.Lock()
+
+def get_software_lock(service, server, name, version):
+   """ Return the lock which must be held while finding (and, if necessary, publishing) a given version of some software. """
+   key = (service, server, name, version)
+   with _SOFTWARE_LOCKS_LOCK:
+      if(key not in _SOFTWARE_LOCKS):
+         _SOFTWARE_LOCKS[key] = threading.Lock()
+      return _SOFTWARE_LOCKS[key]
+
+class PublicationError(Exception):
+   """ Raised by a non-interactive Publisher when some software or data cannot be published. """
+   pass
+
 class Publisher:
    """ A Python module for publishing scientific software and data on Figshare or Zenodo. """
 
-   def __init__(self, service):
-      """ Load the PyRDM configuration file and set up the interface object for the desired publishing service. """
+   def __init__(self, service, processes=None, workers=4, interactive=True, part_workers=None):
+      """ Load the PyRDM configuration file and set up the interface object for the desired publishing service.
+      The MD5 checksums of data files are computed using a pool of 'processes' worker processes (by default, one per CPU core),
+      and up to 'workers' data files are uploaded concurrently. With Figshare, which receives each file in parts, up to 'part_workers' parts
+      of each file are uploaded concurrently (by default, the value of the 'part_workers' option in the 'figshare' section of the configuration file, or 4).
+      An interactive Publisher asks the user what to do when the upload
+      of some files could not be verified, and exits the program if publishing fails. Otherwise, a PublicationError is raised instead. """
       
       self.service = service
+      self.processes = processes
+      self.workers = workers
+      self.interactive = interactive
    
       # Read in the authentication tokens, etc from the configuration file.
       self.config = self.load_config(os.path.expanduser("~/.config/pyrdm.ini"))
+
+      if(part_workers is None):
+         part_workers = self.config.getint("figshare", "part_workers") if self.config.has_option("figshare", "part_workers") else 4
+      self.part_workers = part_workers
+
+      backend = get_backend(service)
+      if(backend is None):
+         _LOG.error("Unsupported service: %s" % service)
+         sys.exit(1)
+
+      # All requests to the service share one pool of persistent connections, which is large enough for every upload worker
+      # (and, with Figshare, every part being uploaded by each worker) to have its own connection. Only the services with an HTTP API need one.
+      if(service == "figshare"):
+         self.transport = self.get_transport(pool_size=self.workers*self.part_workers)
+      elif(service == "zenodo"):
+         self.transport = self.get_transport(pool_size=self.workers)
+      else:
+         self.transport = None
+
+      # The cache of software archives and the registry of published software are only opened when some software is published.
+      self.archive_cache = None
+      self.registry = None
       
+      # The address of the service's API can optionally be given in the configuration file (e.g. to use the Zenodo sandbox).
       if(service == "figshare"):
-         self.figshare = Figshare(token = self.config.get("figshare", "token"))
+         kwargs = {"base_url": self.config.get("figshare", "base_url")} if self.config.has_option("figshare", "base_url") else {}
+         self.figshare = backend(token = self.config.get("figshare", "token"), workers=self.part_workers, transport=self.transport, **kwargs)
       elif(service == "zenodo"):
-         self.zenodo = Zenodo(access_token = self.config.get("zenodo", "access_token"))
+         kwargs = {"api_url": self.config.get("zenodo", "api_url")} if self.config.has_option("zenodo", "api_url") else {}
+         self.zenodo = backend(access_token = self.config.get("zenodo", "access_token"), transport=self.transport, **kwargs)
       elif(service == "dspace"):
-         self.dspace = DSpace(service_document_url = self.config.get("dspace", "service_document_url"), user_name = self.config.get("dspace", "user_name"), user_pass = self.config.get("dspace", "user_pass"))
-      else:
-         _LOG.error("Unsupported service: %s" % service)
-         sys.exit(1)
+         self.dspace = backend(service_document_url = self.config.get("dspace", "service_document_url"), user_name = self.config.get("dspace", "user_name"), user_pass = self.config.get("dspace", "user_pass"))
+      elif(service == "local"):
+         path = "~/.local/share/pyrdm"
+         if(self.config.has_option("local", "path")):
+            path = self.config.get("local", "path")
+         self.local = backend(path = os.path.expanduser(path))
 
       return
       
+   def abort(self, message):
+      """ Give up publishing after an error, described by 'message'. An interactive Publisher exits the program (as the command-line scripts expect),
+      whereas a non-interactive one raises a PublicationError, so that the caller can handle it (e.g. an AsyncPublisher, whose worker threads cannot exit the program). """
+      _LOG.error(message)
+      if(self.interactive):
+         sys.exit(1)
+      raise PublicationError(message)
+
    def load_config(self, config_file_path):
       """ Load the configuration file and return a dictionary containing the OAuth keys. """
 
@@ -66,127 +151,334 @@ class Publisher:
          sys.exit(1)
       return config
 
-   def publish_software(self, name, local_repo_location, version=None, private=False):
-      """ Publishes the software in the current repository. """
+   def get_transport(self, pool_size):
+      """ Return a new connection pool of size 'pool_size', which caches the responses to read-only requests in ~/.cache/pyrdm/http. The request timeout (in seconds) and the number of times a failed request
+      is retried can be set using the 'timeout' and 'retries' options in the 'transport' section of the configuration file. 
+      The requests sent to each service are scheduled by a rate limiter shared by all the processes on this computer, which follows the rate limit headers
+      returned by the service. A rate (in requests per second) and burst size can also be set using the 'rate' and 'burst' options. """
+      timeout = 60.0
+      retries = 3
+      rate = None
+      burst = None
+      if(self.config.has_option("transport", "timeout")):
+         timeout = self.config.getfloat("transport", "timeout")
+      if(self.config.has_option("transport", "retries")):
+         retries = self.config.getint("transport", "retries")
+      if(self.config.has_option("transport", "rate")):
+         rate = self.config.getfloat("transport", "rate")
+      if(self.config.has_option("transport", "burst")):
+         burst = self.config.getint("transport", "burst")
+      from pyrdm.transport import Transport # Imported here, since the requests library is not needed by all the services.
+      cache = HTTPCache(os.path.expanduser("~/.cache/pyrdm/http"))
+      return Transport(pool_size=pool_size, timeout=timeout, retries=retries, cache=cache, rate_limiter=RateLimiter(rate=rate, burst=burst))
+
+   def get_archive_cache(self):
+      """ Return the cache of software archives, which is stored in ~/.cache/pyrdm/archives. Its maximum size (in MiB) can be set using
+      the 'cache_size' option in the 'archive' section of the configuration file. """
+      if(self.archive_cache is None):
+         max_size = 1024
+         if(self.config.has_option("archive", "cache_size")):
+            max_size = self.config.getint("archive", "cache_size")
+         self.archive_cache = ArchiveCache(os.path.expanduser("~/.cache/pyrdm/archives"), max_size=max_size*1024*1024)
+      return self.archive_cache
+
+   def get_registry(self):
+      """ Return the registry of published software, which is stored in ~/.config/pyrdm_registry.db. """
+      if(self.registry is None):
+         self.registry = PublicationRegistry(os.path.expanduser("~/.config/pyrdm_registry.db"))
+      return self.registry
+
+   def get_server(self):
+      """ Return the address of the service's server (or, for the local service, its directory), which identifies where the software was published. """
+      if(self.service == "figshare"):
+         return self.figshare.base_url
+      elif(self.service == "zenodo"):
+         return self.zenodo.api_url
+      elif(self.service == "local"):
+         return self.local.path
+      elif(self.service == "dspace"):
+         return self.config.get("dspace", "service_document_url")
+
+   def sync_registry(self, page_size=100):
+      """ Replace the registry's records of the software published to the service with those in the listing of the account's publications,
+      so that software published from other computers is found (and deleted publications are forgotten). Return the number of publications found,
+      or None if the service's publications cannot be listed. """
+      publications = []
+      if(self.service == "figshare"):
+         for article in self.figshare.iter_articles(page_size=page_size):
+            name, version = PublicationRegistry.parse_title(article["title"])
+            if(name is None):
+               continue
+            # A draft without any uploaded files (e.g. because the upload of the archive was interrupted) does not count.
+            # Only drafts need to be checked, since an article cannot be published without any files.
+            if(article.get("published_date") is None and not any(f.get("status", "available") == "available" for f in self.figshare.list_files(article["id"]))):
+               continue
+            publications.append((name, version, article["id"], article.get("doi") or None))
+      elif(self.service == "zenodo"):
+         for deposition in self.zenodo.iter_depositions(size=page_size):
+            metadata = deposition.get("metadata", {})
+            name, version = PublicationRegistry.parse_title(deposition.get("title", metadata.get("title")))
+            # A deposition without any files (e.g. because the upload of the archive was interrupted) does not count.
+            if(name is not None and metadata.get("upload_type", "software") == "software" and deposition.get("files")):
+               doi = deposition.get("doi") or metadata.get("prereserve_doi", {}).get("doi")
+               publications.append((name, version, deposition["id"], doi or None))
+      elif(self.service == "local"):
+         for article in self.local.list_articles():
+            name, version = PublicationRegistry.parse_title(article["title"])
+            if(name is not None and article["defined_type"] == "code"):
+               publications.append((name, version, article["id"], article["doi"] or None))
+      else:
+         # NOTE: find_software does not try to synchronise the registry with these services.
+         _LOG.warning("The publications on the %s service cannot be listed, so only software published from this computer will be found." % self.service)
+         return None
+
+      self.get_registry().replace(self.service, self.get_server(), publications)
+      _LOG.debug("Found %d software publication(s) on the %s service." % (len(publications), self.service))
+      return len(publications)
+
+   def get_archive_threads(self):
+      """ Return the number of threads used to compress archives, which can be set using the 'threads' option in the 'archive' section 
+      of the configuration file (by default, one thread per CPU core is used). """
+      if(self.config.has_option("archive", "threads")):
+         return self.config.getint("archive", "threads")
+      return None
+
+   def get_archive(self, git_handler, version, archive_path, archive_format="zip", level=None):
+      """ Save an archive of the software at a given version to 'archive_path' in a given format (see GitHandler.archive), 
+      and return its MD5 checksum (or None if the archive could not be created). Archives are cached by the SHA-1 hash of the version's tree
+      (along with the format and compression level), so if the same tree has been archived before, the cached archive is re-used instantly. 
+      If the version is not in the local repository, the archive is downloaded from the server instead, and cached by the version's SHA-1 hash. """
+      tree_sha = git_handler.get_tree_sha(version)
+      if(tree_sha is not None):
+         key = ArchiveCache.get_key(tree_sha, archive_format, level)
+      elif(re.match("^[0-9a-f]{40}$", version)):
+         key = ArchiveCache.get_key("commit-" + version, archive_format)
+      else:
+         key = None # Only the archive of a specific commit can be cached.
+      if(key is not None):
+         md5 = self.get_archive_cache().get(key, archive_path)
+         if(md5 is not None):
+            _LOG.info("Re-using the cached archive of version %s." % version)
+            return md5
+
+      md5 = git_handler.archive(version, archive_path, archive_format=archive_format, level=level, threads=self.get_archive_threads())
+      if(md5 is not None and key is not None):
+         self.get_archive_cache().put(key, archive_path, md5)
+      return md5
+
+   def publish_software(self, name, local_repo_location, version=None, private=False, stream=None, archive_format=None, compression_level=None):
+      """ Publishes the software in the current repository. If 'stream' is True, the archive of the software is uploaded as it is created,
+      rather than first being saved in the current working directory. The archive is created in the format 'archive_format' (one of 'zip', 'tar.gz'
+      or 'tar.zst'), using a given compression level. By default, these are set by the 'stream', 'format' and 'compression_level' options 
+      in the 'archive' section of the configuration file (by default, a .zip archive is saved before it is uploaded). """
       
-      git_handler = GitHandler(local_repo_location)
+      from pyrdm.git_handler import GitHandler, ARCHIVE_FORMATS, get_compressor # Imported here, since GitPython is only needed when publishing software.
+      try:
+         git_handler = GitHandler(local_repo_location)
+      except SystemExit:
+         # GitHandler exits if the location is not in a Git repository.
+         self.abort("Could not open the Git repository at %s." % local_repo_location)
+
+      if(archive_format is None):
+         archive_format = self.config.get("archive", "format") if self.config.has_option("archive", "format") else "zip"
+      if(archive_format not in ARCHIVE_FORMATS):
+         self.abort("Unknown archive format '%s'. The supported formats are: %s." % (archive_format, ", ".join(sorted(ARCHIVE_FORMATS))))
+      if(compression_level is None and self.config.has_option("archive", "compression_level")):
+         compression_level = self.config.getint("archive", "compression_level")
+      try:
+         get_compressor(archive_format, level=compression_level)
+      except (ValueError, OSError) as e:
+         # The compressor is not installed, or the compression level is out of range.
+         self.abort(str(e))
 
       # If no software version is given, use the version of the local repository's HEAD.
       if(version is None):
          version = git_handler.get_head_version()
          _LOG.info("No version information provided. Using the local repository's HEAD as the version to publish (%s)." % version)
 
-      # Search for the software, in case it has already been published.
-      pid, doi = self.find_software(name, version)
-      if(pid is not None):
-         _LOG.info("Version %s of the software has already been published. Re-using the publication ID (%d) and DOI (%s)..." % (version, pid, doi))
-         return pid, doi
+      # Several threads (e.g. those of fluidity-publish -P, or of an AsyncPublisher) may publish the same version at once. Only one of them at a time
+      # may search for the software and publish it, so that the others find its publication rather than each creating another one.
+      lock = get_software_lock(self.service, self.get_server(), name, version)
+      with lock:
+         # Search for the software, in case it has already been published.
+         pid, doi = self.find_software(name, version)
+         if(pid is not None):
+            _LOG.info("Version %s of the software has already been published. Re-using the publication ID (%d) and DOI (%s)..." % (version, pid, doi))
+            return pid, doi
 
-      # The desired path to the archive file.
-      archive_path = name + "-" + str(version) + ".zip"
+         # The desired path to the archive file.
+         archive_path = name + "-" + str(version) + ARCHIVE_FORMATS[archive_format]
       
-      # Create the archive. First archive the local repository...
-      success = git_handler.archive(version, archive_path)
-      if(not success):
-         _LOG.error("Could not obtain an archive of the software at the specified version.")
-         sys.exit(1)
+         if(stream is None):
+            stream = self.config.has_option("archive", "stream") and self.config.getboolean("archive", "stream")
+         if(stream and self.service == "dspace"):
+            _LOG.warning("Archives cannot be streamed to DSpace, so the archive will be saved to %s first." % archive_path)
+            stream = False
+
+         if(stream and git_handler.get_tree_sha(version) is None):
+            _LOG.warning("Version %s is not in the local repository, so its archive will be downloaded to %s first." % (version, archive_path))
+            stream = False
+
+         if(stream):
+            # The archive is created while it is being uploaded.
+            checksums = {}
+         else:
+            # Create the archive. First archive the local repository...
+            md5 = self.get_archive(git_handler, version, archive_path, archive_format=archive_format, level=compression_level)
+            if(md5 is None):
+               self.abort("Could not obtain an archive of the software at the specified version.")
+            checksums = {archive_path: md5}
       
-      # ...then upload it to the citable repository service.
-      _LOG.info("Creating code repository for software...")
-      title='%s (%s)' % (name, version)
-      description='%s (Version %s)' % (name, version)
+         # ...then upload it to the citable repository service.
+         _LOG.info("Creating code repository for software...")
+         title='%s (%s)' % (name, version)
+         description='%s (Version %s)' % (name, version)
 
-      if(self.service == "figshare"):
-         pid = self.figshare.create_article(title=title, description=description, defined_type="code", tags=[version], categories=[])
-         doi = self.figshare.reserve_doi(pid)
-         _LOG.info("Code repository created with ID: %d and DOI: %s" % (pid, doi))
+         if(self.service == "figshare"):
+            pid = self.figshare.create_article(title=title, description=description, defined_type="code", tags=[version], categories=[])
+            doi = self.figshare.reserve_doi(pid)
+            _LOG.info("Code repository created with ID: %d and DOI: %s" % (pid, doi))
 
-         _LOG.info("Adding category...")
-         self.figshare.add_category(article_id=pid, category="Computer Software")
-         _LOG.info("Category added.")
+            _LOG.info("Adding category...")
+            self.figshare.add_category(article_id=pid, category="Computer Software")
+            _LOG.info("Category added.")
          
-         _LOG.info("Uploading software...")
-         self.figshare.add_file(article_id=pid, file_path=archive_path)
-         self.verify_upload(pid=pid, files=[archive_path])
-
-         _LOG.info("Adding all authors (with author IDs) to the code...")
-         author_ids = self.get_authors_list(git_handler.get_working_directory())
-         _LOG.debug("List of author IDs: %s" % (author_ids,))
-         if(author_ids is not None):
-            # Convert to a list of dictionaries with ('id':id) pairs.
-            author_ids = [{'id':author_id} for author_id in author_ids]
-            self.figshare.add_authors(pid, author_ids)
-         _LOG.info("All authors (with author IDs) added.")
-
-         # If we are not keeping the code private, then make it public.
-         if(not private):
-            _LOG.info("Making the code public...")
-            self.figshare.publish(article_id=pid)
-            _LOG.info("The code has been made public.")
+            _LOG.info("Uploading software...")
+            self.upload_software(pid, git_handler, version, archive_path, checksums, archive_format=archive_format, level=compression_level)
+            self.verify_upload(pid=pid, files=[archive_path], checksums=checksums)
 
-      elif(self.service == "zenodo"):
+            _LOG.info("Adding all authors (with author IDs) to the code...")
+            author_ids = self.get_authors_list(git_handler.get_working_directory())
+            _LOG.debug("List of author IDs: %s" % (author_ids,))
+            if(author_ids is not None):
+               # Convert to a list of dictionaries with ('id':id) pairs.
+               author_ids = [{'id':author_id} for author_id in author_ids]
+               self.figshare.add_authors(pid, author_ids)
+            _LOG.info("All authors (with author IDs) added.")
+
+            # If we are not keeping the code private, then make it public.
+            if(not private):
+               _LOG.info("Making the code public...")
+               self.figshare.publish(article_id=pid)
+               _LOG.info("The code has been made public.")
+
+         elif(self.service == "zenodo"):
 
-         # With Zenodo we have to obtain the authors list and tags *before* creating the deposition.
-         _LOG.info("Obtaining author names and affiliations...")
-         authors = self.get_authors_list(git_handler.get_working_directory())
+            # With Zenodo we have to obtain the authors list and tags *before* creating the deposition.
+            _LOG.info("Obtaining author names and affiliations...")
+            authors = self.get_authors_list(git_handler.get_working_directory())
 
-         if(authors is None or authors == []):
-            _LOG.warning("""Could not obtain author information from an AUTHORS file. 
-            Zenodo requires at least one author to be present in the author's list. 
-            Using the name and affiliation given in the PyRDM configuration file.""")
-            authors = [{"name": self.config.get("general", "name"), "affiliation": self.config.get("general", "affiliation")}]
-         _LOG.debug("List of authors and affiliations: %s" % (authors,))
+            if(authors is None or authors == []):
+               _LOG.warning("""Could not obtain author information from an AUTHORS file. 
+               Zenodo requires at least one author to be present in the author's list. 
+               Using the name and affiliation given in the PyRDM configuration file.""")
+               authors = [{"name": self.config.get("general", "name"), "affiliation": self.config.get("general", "affiliation")}]
+            _LOG.debug("List of authors and affiliations: %s" % (authors,))
          
-         publication_details = self.zenodo.create_deposition(title=title, description=description, upload_type="software", 
-                                                             creators=authors, keywords=[version], prereserve_doi=True)
-         pid = publication_details["id"]
-         doi = str(publication_details["metadata"]["prereserve_doi"]["doi"])
-         _LOG.info("Code repository created with ID: %d and DOI: %s" % (pid, doi))
-
-         _LOG.info("Uploading software...")
-         self.zenodo.create_file(deposition_id=pid, file_path=archive_path)
-         self.verify_upload(pid=pid, files=[archive_path])
-
-         # If we are not keeping the code private, then make it public.
-         if(not private):
-            _LOG.info("Making the code public...")
-            self.zenodo.publish_deposition(deposition_id=pid)
-            _LOG.info("The code has been made public.")
+            publication_details = self.zenodo.create_deposition(title=title, description=description, upload_type="software", 
+                                                                creators=authors, keywords=[version], prereserve_doi=True)
+            pid = publication_details["id"]
+            doi = str(publication_details["metadata"]["prereserve_doi"]["doi"])
+            _LOG.info("Code repository created with ID: %d and DOI: %s" % (pid, doi))
+
+            _LOG.info("Uploading software...")
+            self.upload_software(pid, git_handler, version, archive_path, checksums, archive_format=archive_format, level=compression_level)
+            self.verify_upload(pid=pid, files=[archive_path], checksums=checksums)
+
+            # If we are not keeping the code private, then make it public.
+            if(not private):
+               _LOG.info("Making the code public...")
+               self.zenodo.publish_deposition(deposition_id=pid)
+               _LOG.info("The code has been made public.")
+
+         elif(self.service == "local"):
+            pid = self.local.create_article(title=title, description=description, defined_type="code", tags=[version], categories=["Computer Software"])
+            doi = self.local.reserve_doi(pid)
+            _LOG.info("Code repository created with ID: %d and DOI: %s" % (pid, doi))
+
+            _LOG.info("Uploading software...")
+            self.upload_software(pid, git_handler, version, archive_path, checksums, archive_format=archive_format, level=compression_level)
+            self.verify_upload(pid=pid, files=[archive_path], checksums=checksums)
+
+            authors = self.get_authors_list(git_handler.get_working_directory())
+            if(authors is not None):
+               self.local.add_authors(pid, authors)
+
+            # If we are not keeping the code private, then make it public.
+            if(not private):
+               _LOG.info("Making the code public...")
+               self.local.publish(article_id=pid)
+               _LOG.info("The code has been made public.")
             
-      elif(self.service == "dspace"):
-         collection = self.dspace.get_collection_by_title(self.config.get("dspace", "collection_title"))
-         deposit_receipt = self.dspace.create_deposit_from_file(collection=collection, file_path=archive_path)
-         pid = deposit_receipt.id
-         doi = deposit_receipt.alternate # NOTE: This may be a Handle, rather than a DOI.
+         elif(self.service == "dspace"):
+            collection = self.dspace.get_collection_by_title(self.config.get("dspace", "collection_title"))
+            deposit_receipt = self.dspace.create_deposit_from_file(collection=collection, file_path=archive_path)
+            pid = deposit_receipt.id
+            doi = deposit_receipt.alternate # NOTE: This may be a Handle, rather than a DOI.
          
-         _LOG.info("Code repository created with ID: %s and DOI: %s" % (pid, doi))
+            _LOG.info("Code repository created with ID: %s and DOI: %s" % (pid, doi))
          
-         # Add the metadata.
-         _LOG.info("Adding metadata to the deposit...")
-         authors = self.get_authors_list(git_handler.get_working_directory())
-         deposit_receipt = self.dspace.replace_deposit_metadata(deposit_receipt, dcterms_title=title,
-                                              dcterms_type="Software", dcterms_contributor=", ".join(authors))
-         doi = deposit_receipt.alternate # Once the deposit has been completed, the DOI may have been updated.
+            # Add the metadata.
+            _LOG.info("Adding metadata to the deposit...")
+            authors = self.get_authors_list(git_handler.get_working_directory())
+            deposit_receipt = self.dspace.replace_deposit_metadata(deposit_receipt, dcterms_title=title,
+                                                 dcterms_type="Software", dcterms_contributor=", ".join(authors))
+            doi = deposit_receipt.alternate # Once the deposit has been completed, the DOI may have been updated.
          
-         # Complete the deposit.
-         _LOG.info("Completing the deposit...")
-         try:
-            self.dspace.complete_deposit(deposit_receipt)
-         except:
-            _LOG.error("A server error occurred when trying to 'complete' the deposit. This might be because the deposit is already complete, but check the deposit just in case.")
-            pass
+            # Complete the deposit.
+            _LOG.info("Completing the deposit...")
+            try:
+               self.dspace.complete_deposit(deposit_receipt)
+            except:
+               _LOG.error("A server error occurred when trying to 'complete' the deposit. This might be because the deposit is already complete, but check the deposit just in case.")
+               pass
             
-         deposit_receipt = self.dspace.connection.get_deposit_receipt(pid)
-         doi = deposit_receipt.alternate # Once the deposit has been completed, the DOI may have been updated.
+            deposit_receipt = self.dspace.connection.get_deposit_receipt(pid)
+            doi = deposit_receipt.alternate # Once the deposit has been completed, the DOI may have been updated.
             
-      return pid, doi
+         self.get_registry().record(self.service, self.get_server(), name, version, pid, doi)
+         return pid, doi
       
       
+   def upload_software(self, pid, git_handler, version, archive_path, checksums, archive_format="zip", level=None):
+      """ Upload the archive of the software at a given version to the publication with ID 'pid'. If the archive has been saved to 'archive_path'
+      (in which case its MD5 checksum is in the 'checksums' dictionary), it is uploaded from there. Otherwise, the output of 'git archive' is 
+      uploaded as it is created, and the MD5 checksum of the archive is added to 'checksums'. """
+      if(archive_path in checksums):
+         if(self.service == "figshare"):
+            self.figshare.add_file(article_id=pid, file_path=archive_path, md5=checksums[archive_path])
+         elif(self.service == "zenodo"):
+            self.zenodo.create_file(deposition_id=pid, file_path=archive_path, md5=checksums[archive_path], stream=True)
+         elif(self.service == "local"):
+            self.local.add_file(article_id=pid, file_path=archive_path, md5=checksums[archive_path])
+         return
+
+      archive_name = os.path.basename(archive_path)
+      archive = git_handler.archive_stream(version, archive_format=archive_format, level=level, threads=self.get_archive_threads())
+      try:
+         if(self.service == "figshare"):
+            file_id, md5 = self.figshare.add_file_from_stream(article_id=pid, name=archive_name, stream=archive)
+         elif(self.service == "zenodo"):
+            results = self.zenodo.create_file_from_stream(deposition_id=pid, name=archive_name, stream=archive)
+            md5 = results["checksum"].split(":")[-1]
+         elif(self.service == "local"):
+            file_id, md5 = self.local.add_file_from_stream(article_id=pid, name=archive_name, stream=archive)
+      finally:
+         archive.close()
+      checksums[archive_path] = md5
+      return
+
    def publish_data(self, parameters, pid=None, private=False):
       """ Create a new dataset on the online, citable repository's server. 
       Returns a dictionary of details about the new dataset once created. """
          
       _LOG.info("Publishing data...")
+      
+      # The MD5 checksum of each file is computed at most once, and then shared by the upload, the checksum index and the verification.
+      checksums = {}
+      stats = {} # The stat information of each file when its checksum was computed, which is recorded in the checksum index along with the checksum.
+      index = ChecksumIndex.open()
+      deposit_receipt = None # Only used by DSpace.
   
       if(pid is None):
          _LOG.info("Creating new fileset...")
@@ -206,6 +498,11 @@ class Publisher:
                                                                 keywords=parameters["tag_name"], prereserve_doi=True)
             pid = publication_details["id"]
             doi = str(publication_details["metadata"]["prereserve_doi"]["doi"])
+
+         elif(self.service == "local"):
+            pid = self.local.create_article(title=parameters["title"], description=parameters["description"], defined_type="fileset", tags=parameters["tag_name"], 
+                                            categories=([parameters["category"]] if parameters["category"] is not None else []))
+            doi = self.local.reserve_doi(pid)
             
          elif(self.service == "dspace"):
             collection = self.dspace.get_collection_by_title(self.config.get("dspace", "collection_title"))
@@ -218,71 +515,73 @@ class Publisher:
 
          # This is a new article, so upload ALL the files!
          modified_files = parameters["files"]
-         existing_files = []
+         remote_index = RemoteFileIndex([], key=("filename" if self.service == "zenodo" else "name"))
       else:
          publication_details = None
          doi = None # FIXME: We could try to look up the DOI associated with a given PID in the future.
          # This is an existing publication, so check whether any files have been modified since they were last published.
-         modified_files = self.find_modified(parameters["files"])
-         if(self.service == "figshare"):
-            existing_files = self.figshare.list_files(pid)
-         elif(self.service == "zenodo"):
-            existing_files = self.zenodo.list_files(pid)
-         elif(self.service == "dspace"):
+         modified_files = self.find_modified(parameters["files"], checksums=checksums, index=index, stats=stats)
+         if(self.service == "dspace"):
             raise NotImplementedError("It is not yet possible to modify a deposit that has been 'completed'.")
+         # Fetch the list of files on the server once. The index is kept up-to-date as files are uploaded.
+         remote_index = self.get_remote_index(pid)
 
       _LOG.debug("The following files have been marked for uploading: %s" % modified_files)
-      uploaded_files = []
-      
+      local_files = []
       for f in modified_files:
          # Check whether the file actually exists locally.
-         if(os.path.exists(f)):
-            _LOG.info("Uploading %s..." % f)
-            
-            # Check whether the file already exists on the server. If so, over-write the version on the server.
-            exists = False
-            
-            if(self.service == "figshare"):
-               for e in existing_files:
-                  if(e["name"] == os.path.basename(f)):
-                     _LOG.info("File already exists on the server. Over-writing...")
-                     exists = True
-                     # FIXME: It is currently not possible to over-write an existing file via the Figshare API.
-                     # We have to delete the file and then add it again.
-                     self.figshare.delete_file(article_id=pid, file_id=e["id"])
-                     self.figshare.add_file(article_id=pid, file_path=f)
-                     break
-               if(not exists):
-                  self.figshare.add_file(article_id=pid, file_path=f)
-                  
-            elif(self.service == "zenodo"):
-               for e in existing_files:
-                  if(e["filename"] == os.path.basename(f)):
-                     _LOG.info("File already exists on the server. Over-writing...")
-                     exists = True
-                     # FIXME: It is currently not possible to over-write an existing file via the Zenodo API.
-                     # We have to delete the file and then add it again.
-                     self.zenodo.delete_file(deposition_id=pid, file_id=e["id"])
-                     self.zenodo.create_file(deposition_id=pid, file_path=f)
-                     break
-               if(not exists):
-                  self.zenodo.create_file(deposition_id=pid, file_path=f)
-
-            elif(self.service == "dspace"):
-               #FIXME: With DSpace, we currently have to assume that the file does not exist.
-               exists = False
-               if(not exists):
-                  r = self.dspace.add_file(file_path=f, receipt=deposit_receipt)
-
-            # Write out the .md5 checksum file
-            self.write_checksum(f)
-            # Record the upload.
-            uploaded_files.append(f)
+         if(os.path.isfile(f)):
+            local_files.append(f)
          else:
             _LOG.warning("File %s not present on the local system. Skipping..." % f)
-            continue
+      checksums.update(md5sum_many([f for f in local_files if f not in checksums], processes=self.processes, stats=stats))
+
+      # Skip any files which are identical to the copy already on the server (e.g. when publishing from a fresh copy of the data, with no checksum index).
+      identical_files = [f for f in local_files if self.get_remote_checksum(remote_index, f) == checksums[f]]
+      for f in identical_files:
+         _LOG.info("File %s is identical to the copy on the server. Skipping..." % f)
+      local_files = [f for f in local_files if f not in identical_files]
+
+      # Upload the files concurrently. Each file's upload succeeds or fails independently of the others.
+
+      def upload(f):
+         try:
+            self.upload_file(pid, f, remote_index, checksums, deposit_receipt=deposit_receipt)
+            return f, None
+         except Exception as e:
+            return f, e
+            
+      # NOTE: DSpace deposits are modified through a single SWORD2 connection, so the files are uploaded one at a time.
+      workers = 1 if self.service == "dspace" else self.workers
+      if(workers == 1 or len(local_files) <= 1):
+         # Not worth starting a pool of threads for (joining the pool alone takes up to 0.1 seconds).
+         results = [upload(f) for f in local_files]
+      else:
+         pool = ThreadPool(min(workers, len(local_files)))
+         try:
+            results = pool.map(upload, local_files)
+         finally:
+            pool.close()
+            pool.join()
+
+      uploaded_files = [f for f, error in results if error is None] + identical_files
+      failed_files = [f for f, error in results if error is not None]
+      for f, error in results:
+         if(error is not None):
+            _LOG.error("Could not upload file %s: %s" % (f, error))
+
+      # Record the checksums of all the uploaded files in one go, so that only the files which failed are uploaded again next time.
+      self.write_checksums(dict((f, checksums[f]) for f in uploaded_files), index=index, stats=stats)
+      index.close()
+
+      # The publication must not be verified or made public with some of its files missing (a published Zenodo deposition cannot accept more files).
+      if(len(failed_files) > 0):
+         self.abort("%d file(s) could not be uploaded to the publication with ID %s: %s. Publish the data again (with this ID) to upload them." % (len(failed_files), pid, ", ".join(failed_files)))
 
-      self.verify_upload(pid=pid, files=uploaded_files)
+      # NOTE: The list of files is fetched from the server again, so that the checksums reported by the server (rather than those recorded in the index as the files were uploaded) are verified.
+      # If no files were uploaded, the only files are those already found to be identical to the copies on the server, so there is nothing more to verify.
+      if(len(results) > 0):
+         self.verify_upload(pid=pid, files=uploaded_files, checksums=checksums)
       
       # If we are not keeping the data private, then make it public.
       if(not private and self.service != "dspace"):
@@ -291,6 +590,8 @@ class Publisher:
             self.figshare.publish(article_id=pid)
          elif(self.service == "zenodo"):
             self.zenodo.publish_deposition(deposition_id=pid)
+         elif(self.service == "local"):
+            self.local.publish(article_id=pid)
          _LOG.info("The data has been made public.")
          
       # Finalise the deposit in DSpace (if applicable).
@@ -307,71 +608,172 @@ class Publisher:
             
       return pid, doi
       
-   def write_checksum(self, f):
-      """ For a given file with path 'f', write a corresponding MD5 checksum file. """
-      md5 = hashlib.md5(open(f).read()).hexdigest()
-      checksum_file = open(f + ".md5", "w")
-      checksum_file.write(md5)
-      checksum_file.close()
+   def upload_file(self, pid, f, remote_index, checksums, deposit_receipt=None):
+      """ Upload a data file with path 'f' to the publication with ID 'pid'. If a file with the same name is in 'remote_index'
+      (the RemoteFileIndex of the publication's files on the server), then the version on the server is over-written, and the index is updated. 
+      The MD5 checksum of the file must be in the dictionary 'checksums'. For DSpace, the deposit's receipt must be given in 'deposit_receipt'. """
+      _LOG.info("Uploading %s..." % f)
+      name = os.path.basename(f)
+      
+      if(self.service == "figshare"):
+         # Check whether the file already exists on the server. If so, over-write the version on the server.
+         e = remote_index.get(name)
+         if(e is not None and not self.figshare.has_pending_upload(article_id=pid, file_path=f, md5=checksums[f])):
+            # NOTE: A pending upload means that this is the incomplete file from an interrupted upload, which add_file will resume.
+            _LOG.info("File %s already exists on the server. Over-writing..." % f)
+            # FIXME: It is currently not possible to over-write an existing file via the Figshare API.
+            # We have to delete the file and then add it again.
+            self.figshare.delete_file(article_id=pid, file_id=e["id"])
+            remote_index.remove(name)
+         file_id = self.figshare.add_file(article_id=pid, file_path=f, md5=checksums[f])
+         # NOTE: Figshare only reports the computed MD5 checksum once it has finished processing the file.
+         remote_index.add({"name": name, "id": file_id, "computed_md5": ""})
+            
+      elif(self.service == "zenodo"):
+         e = remote_index.get(name)
+         if(e is not None and e.get("id") is None):
+            # The file was streamed into the deposition's file bucket during this publication, and the bucket does not report the ID of the file
+            # in the deposition, so look it up in the listing of the deposition's files.
+            e = self.get_remote_index(pid).get(name)
+         if(e is not None):
+            _LOG.info("File %s already exists on the server. Over-writing..." % f)
+            # FIXME: It is currently not possible to over-write an existing file via the Zenodo API.
+            # We have to delete the file and then add it again.
+            self.zenodo.delete_file(deposition_id=pid, file_id=e["id"])
+            remote_index.remove(name)
+         results = self.zenodo.create_file(deposition_id=pid, file_path=f, md5=checksums[f], stream=True)
+         # The file bucket reports checksums in the form "md5:<checksum>". Its response has no "id" (its version_id is not the ID of the deposition's file).
+         remote_index.add({"filename": name, "id": results.get("id"), "checksum": results.get("checksum", "").split(":")[-1]})
+
+      elif(self.service == "local"):
+         e = remote_index.get(name)
+         if(e is not None):
+            _LOG.info("File %s already exists in the local store. Over-writing..." % f)
+            self.local.delete_file(article_id=pid, file_id=e["id"])
+            remote_index.remove(name)
+         file_id = self.local.add_file(article_id=pid, file_path=f, md5=checksums[f])
+         remote_index.add({"name": name, "id": file_id, "computed_md5": checksums[f]})
+
+      elif(self.service == "dspace"):
+         #FIXME: With DSpace, we currently have to assume that the file does not exist.
+         r = self.dspace.add_file(file_path=f, receipt=deposit_receipt)
+      return
+
+   def write_checksum(self, f, md5=None):
+      """ For a given file with path 'f', record its MD5 checksum in the user's checksum index.
+      If the file's MD5 checksum has already been computed, it can be passed in via 'md5' to avoid reading the file again. """
+      if(md5 is None):
+         md5 = md5sum(f)
+      self.write_checksums({f: md5})
+      return
+
+   def write_checksums(self, checksums, index=None, stats=None):
+      """ Record the MD5 checksums in the dictionary 'checksums' (keyed by file path) in the user's checksum index,
+      which can be passed in via 'index', along with the files' stat information when the checksums were computed ('stats', see ChecksumIndex.update). 
+      All the checksums are written in a single transaction. """
+      if(index is None):
+         index = ChecksumIndex.open()
+         index.update(checksums, stats=stats)
+         index.close()
+      else:
+         index.update(checksums, stats=stats)
       return
 
-   def find_modified(self, files):
+   def find_modified(self, files, checksums=None, index=None, stats=None):
       """ Return a list of files (whose paths are in the argument 'files') which have been modified.
-      This is based on MD5 checksums. """
-      modified = []
+      This is based on MD5 checksums. Files whose size, modification time and inode are the same as when their checksum 
+      was recorded in the user's checksum index (which can be passed in via 'index') are not read at all.
+      If a dictionary is passed in via 'checksums', then it is populated with the MD5 checksum of each file that was read,
+      keyed by the file's path, and likewise 'stats' with the file's stat information when it was read (see md5sum_many). """
+      if(stats is None):
+         stats = {}
+      if(index is None):
+         index = ChecksumIndex.open()
+         close_index = True
+      else:
+         close_index = False
+
+      new = set() # Files that are new, missing, or have no recorded checksum.
+      originals = {} # The recorded checksums of the files that need to be read.
       for f in files:
-         if(os.path.isfile(f + ".md5")):
+         if(not os.path.isfile(f)):
+            # The file will be reported as missing when it is uploaded.
+            new.add(f)
+            continue
+            
+         if(index.is_unchanged(f)):
+            continue
+            
+         md5_original = index.get(f)
+         if(md5_original is None and os.path.isfile(f + ".md5")):
+            # Fall back to any checksum file written by an older version of PyRDM.
             checksum_file = open(f + ".md5", "r")
             md5_original = checksum_file.readline()
-            md5 = hashlib.md5(open(f).read()).hexdigest()
+            checksum_file.close()
             
-            if(md5 != md5_original):
-               modified.append(f)
+         if(md5_original is None):
+            # No checksum recorded - assume new or modified.
+            new.add(f)
          else:
-            # No checksum file present - assume new or modified.
-            modified.append(f)
-            
+            originals[f] = md5_original
+
+      # Compute the checksums of the remaining files in parallel.
+      computed = md5sum_many(list(originals.keys()), processes=self.processes, stats=stats)
+      if(checksums is not None):
+         checksums.update(computed)
+      unmodified = dict((f, md5) for f, md5 in computed.items() if md5 == originals[f]) # Unmodified files whose stat information has changed (e.g. they have been touched or copied).
+      modified = [f for f in files if f in new or (f in computed and f not in unmodified)]
+      
+      # Refresh the stat information of the unmodified files, so that they will not need to be read next time.
+      if(len(unmodified) > 0):
+         index.update(unmodified, stats=stats)
+      if(close_index):
+         index.close()
       return modified
 
    def find_software(self, name, version):
-      """ Checks if the software has already been published. If so, it returns the DOI.
-      Otherwise it returns None. """
+      """ Checks if the software has already been published, using the registry of published software. If so, it returns the publication ID and DOI.
+      Otherwise it returns (None, None). The first time the registry is used with a service's server, it is synchronised with the account's
+      listing of publications (see sync_registry), if the service's publications can be listed. A publication found in the registry is confirmed with the server, and forgotten if it has since been deleted. """
       
-      keyword = "%s" % (name) # We always include the software's name in the title, so use it as the keyword
-      
-      if(self.service == "figshare"):
-         results = self.figshare.search(keyword) # We always tag the software with its version (the SHA-1 hash for Git repositories).
+      registry = self.get_registry()
+      if(self.service in LISTABLE_SERVICES and registry.last_synced(self.service, self.get_server()) is None):
+         self.sync_registry()
 
-         for article in results:
-            try:
-               if str(version) in article.tags:
-                  _LOG.info("Software %s has already been published (with version %s).\n" % (name, version))
-                  pid = article["id"]
-
-                  # Try to find the DOI as well.
-                  # This try-except block might not be necessary if we are always searching public articles.
-                  try:
-                     doi = article["doi"]
-                     if doi == "":
-                        raise ValueError()
-                     _LOG.info("Software DOI: %s" % doi)
-                  except:
-                     _LOG.info("DOI not found.")
-                     doi = None
-                  return pid, doi
-            except AttributeError:
-               pass
-              
-         return None, None
-            
-      elif(self.service == "zenodo"):
-         # FIXME: There is currently no way of easily searching for a Zenodo deposit based on its keywords via the API.
-         # Therefore, assume for now that the software has not been published.
+      pid, doi = registry.get(self.service, self.get_server(), name, version)
+      if(pid is not None and self.publication_deleted(pid)):
+         _LOG.info("Publication %s (version %s of software %s) has been deleted from the server, so it will be published again." % (str(pid), version, name))
+         registry.forget(self.service, self.get_server(), name, version)
+         pid, doi = None, None
+      if(pid is None and self.service == "zenodo"):
+         # The software may have been published from another computer since the registry was last synchronised. 
+         # The version is always one of the deposition's keywords, so ask Zenodo for the depositions with that keyword.
+         pid, doi = self.find_zenodo_deposition(name, version)
+         if(pid is not None):
+            registry.record(self.service, self.get_server(), name, version, pid, doi)
+      if(pid is None):
          return None, None
-         
-      elif(self.service == "dspace"):
-         # FIXME: Assume for now that the software has not been published.
-         return None, None   
+
+      _LOG.info("Software %s has already been published (with version %s).\n" % (name, version))
+      if(doi is None):
+         _LOG.info("DOI not found.")
+      else:
+         _LOG.info("Software DOI: %s" % doi)
+      return pid, doi
+
+   def find_zenodo_deposition(self, name, version):
+      """ Search the user's Zenodo depositions for a given version of some software, and return its publication ID and DOI (or (None, None) if it was not found).
+      A deposition without any files (e.g. because the upload of the archive was interrupted) does not count. """
+      for deposition in self.zenodo.iter_depositions(size=10, query='keywords:"%s"' % version):
+         metadata = deposition.get("metadata", {})
+         if(PublicationRegistry.parse_title(deposition.get("title", metadata.get("title"))) != (name, str(version)) or str(version) not in metadata.get("keywords", [])):
+            continue
+         if(not deposition.get("files")):
+            _LOG.info("Deposition %d holds version %s of the software, but no files, so it will not be re-used." % (deposition["id"], version))
+            continue
+         doi = deposition.get("doi") or metadata.get("prereserve_doi", {}).get("doi")
+         return deposition["id"], doi or None
+      return None, None
 
    def get_authors_list(self, wd):
       """ If an AUTHORS file exists in a given repository's base directory, then read it and
@@ -396,6 +798,11 @@ class Publisher:
                   author_id = {'name':s[0], 'affiliation':s[1]}
                   author_ids.append(author_id)
                   
+            elif(self.service == "local"):
+               m = re.search("<%s:(.+)>" % self.service, line)
+               if(m is not None):
+                  author_ids.append(m.group(1))
+                  
             elif(self.service == "dspace"):
                #TODO: This currently uses the author's DSpace username. Is there a better identifier? 
                m = re.search("<%s:(.+)>" % self.service, line)
@@ -408,45 +815,66 @@ class Publisher:
          _LOG.warning("Could not open AUTHORS file. Does it exist? Check read permissions?")
          return None
 
-   def is_uploaded(self, pid, files):
-      """ Return True if the files in the list 'files' are all present on the server. Otherwise, return False. """
+   def get_remote_index(self, pid):
+      """ Fetch the list of files in the publication with ID 'pid' from the server, and return it as a RemoteFileIndex keyed by file name. """
       if(self.service == "figshare"):
-         files_on_server = self.figshare.list_files(pid)
-         key = "name"
+         return RemoteFileIndex(self.figshare.list_files(pid), key="name")
       elif(self.service == "zenodo"):
-         files_on_server = self.zenodo.list_files(pid)
-         key = "filename"
-      elif(self.service == "dspace"):
+         return RemoteFileIndex(self.zenodo.list_files(pid), key="filename")
+      elif(self.service == "local"):
+         return RemoteFileIndex(self.local.list_files(pid), key="name")
+      else:
+         raise NotImplementedError("Remote file indices are not supported for the %s service." % self.service)
+
+   def get_remote_checksum(self, remote_index, f):
+      """ Return the MD5 checksum reported by the server for the file with path 'f', using the index of the publication's files 'remote_index'.
+      Return None if the file is not on the server, or if the server does not provide (or has not yet computed) its checksum. """
+      s = remote_index.get(os.path.basename(f))
+      if(s is None):
+         return None
+      if(self.service == "zenodo"):
+         checksum = s.get("checksum")
+      else:
+         checksum = s.get("computed_md5") # NOTE: With Figshare, this is empty until the server has finished processing the file.
+      if(not checksum):
+         return None
+      return checksum.split(":")[-1] # Zenodo's file buckets report checksums in the form "md5:<checksum>".
+
+   def is_uploaded(self, pid, files, checksums=None):
+      """ Return True if the files in the list 'files' are all present on the server. Otherwise, return False.
+      If a dictionary of local MD5 checksums (keyed by file path) is given in 'checksums', then the checksums
+      reported by the server are also compared against them, where the server provides one. The list of files is always fetched from the server. """
+      if(self.service == "dspace"):
          deposit_receipt = self.dspace.connection.get_deposit_receipt(pid)
          try:
             files_on_server = self.dspace.list_files(deposit_receipt.edit_media_feed, self.config.get("dspace", "user_name"), self.config.get("dspace", "user_pass"))
          except:
             return True # This will fail if the deposit has not yet been 'completed'. Assume all files have been uploaded successfully (if they haven't, the DSpace library should tell us anyway).
+         remote_index = RemoteFileIndex([{"name": s} for s in files_on_server], key="name")
+      else:
+         remote_index = self.get_remote_index(pid)
          
       for f in files:
-         exists = False
-         for s in files_on_server:
-            if(isinstance(s, dict)): # Figshare and Zenodo file objects are dictionaries.
-               if(s[key] == os.path.basename(f)):
-                  exists = True
-                  break
-            else:
-               if(s == os.path.basename(f)):
-                  exists = True
-                  break
-         if(exists):
-            continue
-         else:
+         s = remote_index.get(os.path.basename(f))
+         if(s is None):
             _LOG.warning("Could not find file %s on the server." % f)
             return False
+         remote_checksum = self.get_remote_checksum(remote_index, f)
+         if(checksums is not None and f in checksums and remote_checksum is not None and remote_checksum != checksums[f]):
+            _LOG.warning("The checksum of file %s on the server (%s) does not match the local checksum (%s)." % (f, remote_checksum, checksums[f]))
+            return False
       return True
 
-   def verify_upload(self, pid, files):
-      """ Verify that all files in the list 'files' have been uploaded. """
-      if(self.is_uploaded(pid=pid, files=files)):
+   def verify_upload(self, pid, files, checksums=None):
+      """ Verify that all files in the list 'files' have been uploaded (and, if 'checksums' is given, that they are intact, according to the server). 
+      If they have not, an interactive Publisher asks the user whether to continue, or to delete the publication (if it is still a draft) and exit.
+      A non-interactive Publisher raises a PublicationError instead, leaving the publication as it is. """
+      if(self.is_uploaded(pid=pid, files=files, checksums=checksums)):
          _LOG.info("All files successfully uploaded.")
       else:
          _LOG.warning("Not all files were successfully uploaded. Perhaps you ran out of space on the server?")
+         if(not self.interactive):
+            raise PublicationError("Not all files were successfully uploaded to publication %s." % str(pid))
          while True:
             response = raw_input("Are you sure you want to continue? (Y/N)\n")
             if(response == "y" or response == "Y"):
@@ -458,14 +886,44 @@ class Publisher:
                   self.figshare.delete_article(article_id=pid)
                elif(self.service == "zenodo"):
                   self.zenodo.delete_deposition(deposition_id=pid)
+               elif(self.service == "local"):
+                  self.local.delete_article(article_id=pid)
                sys.exit(1)
             else:
                continue
       return
 
+   def publication_deleted(self, pid):
+      """ Return True if the server confirms that the publication with ID 'pid' does not exist (e.g. it has been deleted since it was recorded in the registry).
+      If the publication could not be looked up for any other reason (e.g. the server could not be reached), False is returned, so that the software is not
+      published again by mistake. Deposits on DSpace cannot be looked up, so they are assumed to exist. """
+      if(self.service == "figshare"):
+         try:
+            self.figshare.get_article_details(pid, private=True)
+         except AuthenticationError:
+            raise
+         except Exception as e:
+            response = getattr(e, "response", None) # Set for a requests.HTTPError.
+            return response is not None and response.status_code in (404, 410)
+         return False
+      elif(self.service == "zenodo"):
+         try:
+            results = self.zenodo.retrieve_deposition(pid)
+         except AuthenticationError:
+            raise
+         except Exception:
+            return False
+         return results.get("status") in (404, 410) # The error responses of the Zenodo API contain the response's status.
+      elif(self.service == "local"):
+         return self.local.get_article_details(pid, private=True) is None
+      return False
+
    def publication_exists(self, pid):
       if(self.service == "figshare"):
-         results = self.figshare.get_article_details(pid)
+         try:
+            results = self.figshare.get_article_details(pid)
+         except:
+            return False # The article could not be found.
          if("error" in results.keys()):
             return False
          else:
@@ -476,6 +934,8 @@ class Publisher:
          except:
             return False
          return True
+      elif(self.service == "local"):
+         return self.local.get_article_details(pid, private=True) is not None
       elif(self.service == "dspace"):
          #FIXME: Assume that the publication does not exist for now.
          return False
@@ -486,48 +946,93 @@ class TestLog(unittest.TestCase):
    def setUp(self):
       self.publisher = Publisher(service="figshare")
             
-      f = open("test_file.txt", "w")
+      # The test file is kept out of the current directory. Once the Publisher has read its configuration file, the home directory
+      # is changed too, so that the test's checksums are recorded in a checksum index of their own rather than in the user's.
+      self.directory = tempfile.mkdtemp()
+      self.file_path = os.path.join(self.directory, "test_file.txt")
+      f = open(self.file_path, "w")
       f.write("Hello World! This is a file for the MD5 functionality test.")
       f.close()
+      self.home = os.environ.get("HOME")
+      os.environ["HOME"] = self.directory
       return
 
    def tearDown(self):
+      if(self.home is None):
+         del os.environ["HOME"]
+      else:
+         os.environ["HOME"] = self.home
+      shutil.rmtree(self.directory)
       return
 
    def test_md5_write_checksum(self):
-      self.publisher.write_checksum("test_file.txt")
+      self.publisher.write_checksum(self.file_path)
       
-      f = open("test_file.txt.md5", "r")
+      index = ChecksumIndex.open()
+      assert(index.path == os.path.join(self.directory, ".cache", "pyrdm", "checksums.db"))
       md5_known = "29586140472f40eec4031eb2e0d352e1"
-      md5 = hashlib.md5(open("test_file.txt").read()).hexdigest()
+      md5 = index.get(self.file_path)
+      index.close()
       _LOG.debug("Known MD5 hash of file: %s" % md5_known)
       _LOG.debug("Computed MD5 hash of file: %s" % md5)
       assert(md5 == md5_known)
       
    def test_md5_find_modified(self):
-      self.publisher.write_checksum("test_file.txt")
+      self.publisher.write_checksum(self.file_path)
       
-      modified = self.publisher.find_modified(["test_file.txt"])
+      modified = self.publisher.find_modified([self.file_path])
       _LOG.debug("Modified files: ", modified)
       assert(modified == [])
       
       # Modify the file.      
-      f = open("test_file.txt", "a")
+      f = open(self.file_path, "a")
       f.write("This is another line.")
       f.close()
       
       # Check that the MD5 checksums are not the same
       md5_before = "29586140472f40eec4031eb2e0d352e1"
-      md5_after = hashlib.md5(open("test_file.txt").read()).hexdigest()
+      md5_after = hashlib.md5(open(self.file_path).read()).hexdigest()
       _LOG.debug("MD5 hash before modification: %s" % md5_before)
       _LOG.debug("MD5 hash after modification: %s" % md5_after)
       assert(md5_before != md5_after)
       
-      modified = self.publisher.find_modified(["test_file.txt"])
+      modified = self.publisher.find_modified([self.file_path])
       _LOG.debug("Modified files: ", modified)
-      assert(modified == ["test_file.txt"])
+      assert(modified == [self.file_path])
+
+   def test_lazy_import(self):
+      # Importing the publisher module must not import any of the service backends, or the libraries they depend on.
+      backends = ["pyrdm.figshare", "pyrdm.zenodo", "pyrdm.dspace", "pyrdm.git_handler", "requests", "sword2", "git"]
+      code = "import sys, time; start = time.time(); import pyrdm.publisher; sys.stdout.write('%%f\\n' %% (time.time() - start)); sys.stdout.write(' '.join(m for m in %s if m in sys.modules))" % backends
+      output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).decode("utf-8").split("\n")
+      _LOG.debug("Time taken to import the publisher module: %s seconds" % output[0])
+      _LOG.debug("Backends imported: %s" % output[1])
+      assert(output[1] == "")
+
+      # A Publisher for the local service must not import the HTTP transport (or the requests library) either.
+      home = tempfile.mkdtemp()
+      try:
+         os.makedirs(os.path.join(home, ".config"))
+         with open(os.path.join(home, ".config", "pyrdm.ini"), "w") as f:
+            f.write("[general]\nname = Test\naffiliation = PyRDM\n\n[local]\npath = %s\n" % os.path.join(home, "local"))
+         modules = ["pyrdm.transport", "pyrdm.figshare", "pyrdm.zenodo", "requests"]
+         code = "import sys; from pyrdm.publisher import Publisher; Publisher(service='local'); sys.stdout.write(' '.join(m for m in %s if m in sys.modules))" % modules
+         env = dict(os.environ, HOME=home)
+         output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env).decode("utf-8")
+         _LOG.debug("Modules imported by a local Publisher: %s" % output)
+         assert(output == "")
+      finally:
+         shutil.rmtree(home)
+
+   def test_software_lock(self):
+      # Every Publisher must use the same lock for the same version of some software, and a different lock for a different version.
+      lock = get_software_lock("figshare", "https://api.figshare.com/v2", "PyRDM", "abc")
+      assert(get_software_lock("figshare", "https://api.figshare.com/v2", "PyRDM", "abc") is lock)
+      assert(get_software_lock("figshare", "https://api.figshare.com/v2", "PyRDM", "def") is not lock)
 
    def test_get_authors_list(self):
+      import git
+      from pyrdm.git_handler import GitHandler
       try:
          git_handler = GitHandler(".") # Assume that the unittests are being run from the PyRDM base directory
       except git.InvalidGitRepositoryError:
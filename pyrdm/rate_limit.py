@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import logging
+import json
+import time
+import fcntl
+import threading
+import unittest
+import tempfile
+from urlparse import urlparse
+from email.utils import parsedate_tz, mktime_tz
+
+_LOG = logging.getLogger(__name__)
+
+# The number of seconds to wait after a 429 (Too Many Requests) response which does not say how long to wait for.
+DEFAULT_RETRY_AFTER = 1.0
+
+# The buckets of services which have not been used for this many seconds (and are not waiting for their rate limits to be reset) are forgotten.
+BUCKET_EXPIRY = 3600
+
+class RateLimiter:
+   """ Schedules the requests sent to each service (identified by the host name in the request's URL), so that the service's rate limits are not exceeded.
+   Each service has a token bucket, and a request may only be sent once it has taken a token from the bucket. The state of the buckets is
+   kept in a file (guarded by a lock on the file), so that it is shared by all the threads and processes on a computer which use the same file.
+   The buckets are adjusted using the rate limit headers returned by the services: Retry-After (sent with a 429 response), which stops all
+   requests to the service for the given time, and X-RateLimit-Remaining and X-RateLimit-Reset, which give the number of requests that may be sent
+   before the service's rate limit window is reset. """
+
+   def __init__(self, path=None, rate=None, burst=None):
+      """ Keep the state of the buckets in the file at 'path' (by default, ~/.cache/pyrdm/rate_limits.json, so that it is shared by all of the user's processes
+      on this computer). If 'rate' is given, no more than 'rate' requests per second (on average) are sent to each service, in bursts of up to
+      'burst' requests (by default, 'rate' requests). Otherwise, the requests are only limited by the rate limit headers returned by the services. """
+      if(path is None):
+         path = os.path.expanduser("~/.cache/pyrdm/rate_limits.json")
+      self.path = path
+      directory = os.path.dirname(path)
+      if(directory != ""):
+         try:
+            os.makedirs(directory, 0o700)
+         except OSError as e:
+            if(e.errno != errno.EEXIST): # Another process may have just created it.
+               raise
+      self.rate = rate
+      if(rate is not None and burst is None):
+         burst = max(rate, 1)
+      self.burst = burst
+      self.lock = threading.Lock() # Guards the file against the other threads in this process, in addition to the lock on the file.
+      return
+
+   def _update(self, host, modify):
+      """ Call 'modify' with the bucket of 'host' (a dictionary) and the current time, while holding the lock on the buckets' file, and save the modified bucket.
+      Returns the return value of 'modify'. """
+      with self.lock:
+         fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+         with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+               try:
+                  buckets = json.loads(f.read() or "{}")
+               except ValueError:
+                  _LOG.warning("The rate limiter's state in %s could not be read. Starting afresh..." % self.path)
+                  buckets = {}
+
+               now = time.time()
+               bucket = buckets.get(host)
+               if(bucket is None):
+                  bucket = {"tokens": self.burst, "updated": now, "blocked_until": 0, "remaining": None, "reset": None}
+               if(self.rate is not None):
+                  # Refill the bucket for the time since it was last updated.
+                  tokens = bucket["tokens"] if bucket["tokens"] is not None else self.burst
+                  bucket["tokens"] = min(self.burst, tokens + (now - bucket["updated"])*self.rate)
+               bucket["updated"] = now
+               if(bucket["reset"] is not None and now >= bucket["reset"]):
+                  # The service's rate limit window has been reset, so the number of remaining requests is no longer known.
+                  bucket["remaining"] = None
+                  bucket["reset"] = None
+
+               result = modify(bucket, now)
+
+               buckets[host] = bucket
+               for h in list(buckets.keys()):
+                  b = buckets[h]
+                  if(now - b["updated"] > BUCKET_EXPIRY and b["blocked_until"] < now and (b["reset"] is None or b["reset"] < now)):
+                     del buckets[h]
+               f.seek(0)
+               f.truncate()
+               f.write(json.dumps(buckets))
+               f.flush() # Before the lock is released.
+               return result
+            finally:
+               fcntl.flock(f, fcntl.LOCK_UN)
+
+   def acquire(self, url):
+      """ Wait until a request may be sent to the service at 'url'. """
+      host = urlparse(url).netloc
+
+      def take(bucket, now):
+         """ Take a token from the bucket, or return the time to wait for before trying again. """
+         wait = bucket["blocked_until"] - now
+         if(bucket["remaining"] is not None and bucket["remaining"] < 1):
+            wait = max(wait, bucket["reset"] - now)
+         if(self.rate is not None and bucket["tokens"] < 1):
+            wait = max(wait, (1 - bucket["tokens"])/self.rate)
+         if(wait > 0):
+            return wait
+         if(bucket["remaining"] is not None):
+            bucket["remaining"] -= 1
+         if(self.rate is not None):
+            bucket["tokens"] -= 1
+         return 0
+
+      while True:
+         wait = self._update(host, take)
+         if(wait <= 0):
+            return
+         _LOG.debug("Waiting %.2f seconds before sending a request to %s..." % (wait, host))
+         time.sleep(wait)
+
+   def update(self, url, response):
+      """ Adjust the bucket of the service at 'url' using the rate limit headers of 'response' (a requests.Response object). """
+      retry_after = parse_retry_after(response.headers.get("Retry-After"))
+      remaining = response.headers.get("X-RateLimit-Remaining")
+      reset = response.headers.get("X-RateLimit-Reset")
+      if(response.status_code != 429 and retry_after is None and (remaining is None or reset is None)):
+         return # Nothing to learn from this response.
+      host = urlparse(url).netloc
+
+      def adjust(bucket, now):
+         reset_time = None
+         if(remaining is not None and reset is not None):
+            try:
+               reset_time = float(reset)
+               # Some services give the number of seconds until the window is reset, rather than the time at which it is reset.
+               if(reset_time < 1e9):
+                  reset_time += now
+               if(bucket["reset"] == reset_time and bucket["remaining"] is not None):
+                  # Responses to requests made in the same window may arrive out of order, and other requests may have been sent since, so never count upwards.
+                  bucket["remaining"] = min(bucket["remaining"], int(remaining))
+               else:
+                  bucket["remaining"] = int(remaining)
+                  bucket["reset"] = reset_time
+            except ValueError:
+               _LOG.warning("Ignoring the invalid rate limit headers returned by %s." % host)
+               reset_time = None
+         if(response.status_code == 429 or retry_after is not None):
+            if(retry_after is not None):
+               until = now + retry_after
+            elif(reset_time is not None and reset_time > now):
+               until = reset_time
+            else:
+               until = now + DEFAULT_RETRY_AFTER
+            bucket["blocked_until"] = max(bucket["blocked_until"], until)
+            if(self.rate is not None):
+               bucket["tokens"] = 0
+         return
+
+      self._update(host, adjust)
+      if(response.status_code == 429):
+         _LOG.warning("The rate limit of %s has been reached. Slowing down..." % host)
+      return
+
+def parse_retry_after(value):
+   """ Return the number of seconds given by the value of a Retry-After header (either a number of seconds, or an HTTP date), or None if there is no valid value. """
+   if(value is None):
+      return None
+   try:
+      return max(0.0, float(value))
+   except ValueError:
+      date = parsedate_tz(value)
+      if(date is None):
+         return None
+      return max(0.0, mktime_tz(date) - time.time())
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's rate limiting module. """
+
+   class DummyResponse:
+      """ Stands in for a requests.Response object. """
+      def __init__(self, status_code, headers):
+         self.status_code = status_code
+         self.headers = headers
+
+   def setUp(self):
+      self.path = tempfile.mktemp(suffix=".json")
+      return
+
+   def tearDown(self):
+      if(os.path.exists(self.path)):
+         os.remove(self.path)
+      return
+
+   def test_rate_limit_bucket(self):
+      limiter = RateLimiter(self.path, rate=20, burst=5)
+      start = time.time()
+      for i in range(15):
+         limiter.acquire("https://api.figshare.com/v2/account/articles")
+      # The first 5 requests are sent at once, and the next 10 at 20 requests per second.
+      assert(0.4 < time.time() - start < 1.0)
+      # Each service has its own bucket.
+      start = time.time()
+      limiter.acquire("https://zenodo.org/api/deposit/depositions")
+      assert(time.time() - start < 0.1)
+
+   def test_rate_limit_retry_after(self):
+      limiter = RateLimiter(self.path)
+      limiter.update("https://zenodo.org/api/deposit/depositions", TestLog.DummyResponse(429, {"Retry-After": "0.5"}))
+      # Another limiter using the same file (e.g. in another process) must also wait.
+      other = RateLimiter(self.path)
+      start = time.time()
+      other.acquire("https://zenodo.org/api/records")
+      assert(0.4 < time.time() - start < 1.0)
+      start = time.time()
+      other.acquire("https://api.figshare.com/v2/articles")
+      assert(time.time() - start < 0.1)
+
+   def test_rate_limit_remaining(self):
+      limiter = RateLimiter(self.path)
+      limiter.update("https://zenodo.org/api/records", TestLog.DummyResponse(200, {"X-RateLimit-Limit": "100", "X-RateLimit-Remaining": "2", "X-RateLimit-Reset": "0.5"}))
+      start = time.time()
+      limiter.acquire("https://zenodo.org/api/records")
+      limiter.acquire("https://zenodo.org/api/records")
+      assert(time.time() - start < 0.1)
+      # The third request must wait for the window to be reset.
+      limiter.acquire("https://zenodo.org/api/records")
+      assert(0.4 < time.time() - start < 1.0)
+
+   def test_parse_retry_after(self):
+      assert(parse_retry_after("120") == 120)
+      assert(parse_retry_after(None) is None)
+      assert(parse_retry_after("soon") is None)
+      date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 60))
+      assert(55 < parse_retry_after(date) <= 60)
+
+if(__name__ == '__main__'):
+   unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import errno
+import re
+import sqlite3
+import threading
+import time
+import unittest
+import tempfile
+import shutil
+
+_LOG = logging.getLogger(__name__)
+
+# Software is always published with a title of the form "<name> (<version>)".
+TITLE_PATTERN = re.compile(r"^(?P<name>.*) \((?P<version>[^()]+)\)$")
+
+class PublicationRegistry:
+   """ A persistent record of the software that has been published, stored in a single SQLite database. Each publication is identified by the
+   service and server it was published to, and the software's name and version (the SHA-1 hash for Git repositories), so that checking whether
+   a version has already been published is a single lookup rather than a search of the service. The database can be shared by many processes. """
+
+   def __init__(self, path):
+      """ Open (or create) the registry stored in the file with path 'path'. """
+      self.path = path
+      directory = os.path.dirname(path)
+      if(directory):
+         try:
+            os.makedirs(directory)
+         except OSError as e:
+            if(e.errno != errno.EEXIST): # Another process may have just created it.
+               raise
+      # The connection is shared by all the threads of a Publisher, so it is only used by one of them at a time.
+      self.lock = threading.Lock()
+      self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+      with self.lock:
+         with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS publications (service TEXT, server TEXT, name TEXT, version TEXT, pid, doi TEXT, recorded REAL,
+                                       PRIMARY KEY (service, server, name, version))""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS syncs (service TEXT, server TEXT, synced REAL, PRIMARY KEY (service, server))""")
+      return
+
+   @staticmethod
+   def parse_title(title):
+      """ Return the name and version of the software published with a given title, or (None, None) if it was not published by PyRDM. """
+      match = TITLE_PATTERN.match(title or "")
+      if(match is None):
+         return None, None
+      return match.group("name"), match.group("version")
+
+   def get(self, service, server, name, version):
+      """ Return the publication ID and DOI of a given version of some software published to a service's server, or (None, None) if there is no record of it. """
+      with self.lock:
+         row = self.connection.execute("SELECT pid, doi FROM publications WHERE service = ? AND server = ? AND name = ? AND version = ?", (service, server, name, str(version))).fetchone()
+      if(row is None):
+         return None, None
+      return row[0], row[1]
+
+   def record(self, service, server, name, version, pid, doi):
+      """ Record that a given version of some software has been published to a service's server with a given publication ID and DOI. """
+      with self.lock:
+         with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO publications (service, server, name, version, pid, doi, recorded) VALUES (?, ?, ?, ?, ?, ?, ?)", 
+                                    (service, server, name, str(version), pid, doi, time.time()))
+      return
+
+   def forget(self, service, server, name, version):
+      """ Remove the record of a given version of some software (e.g. because the publication has been deleted). """
+      with self.lock:
+         with self.connection:
+            self.connection.execute("DELETE FROM publications WHERE service = ? AND server = ? AND name = ? AND version = ?", (service, server, name, str(version)))
+      return
+
+   def replace(self, service, server, publications):
+      """ Replace all the records of a service's server with those in the list 'publications' of (name, version, pid, doi) tuples, 
+      and note the time of this synchronisation. All the records are written in a single transaction. """
+      now = time.time()
+      rows = [(service, server, name, str(version), pid, doi, now) for name, version, pid, doi in publications]
+      with self.lock:
+         with self.connection:
+            self.connection.execute("DELETE FROM publications WHERE service = ? AND server = ?", (service, server))
+            self.connection.executemany("INSERT OR REPLACE INTO publications (service, server, name, version, pid, doi, recorded) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO syncs (service, server, synced) VALUES (?, ?, ?)", (service, server, now))
+      return
+
+   def last_synced(self, service, server):
+      """ Return the time at which the records of a service's server were last synchronised with the server, or None if they never have been. """
+      with self.lock:
+         row = self.connection.execute("SELECT synced FROM syncs WHERE service = ? AND server = ?", (service, server)).fetchone()
+      if(row is None):
+         return None
+      return row[0]
+
+   def close(self):
+      """ Close the connection to the registry. """
+      self.connection.close()
+      return
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's publication registry module. """
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.registry = PublicationRegistry(os.path.join(self.directory, "config", "pyrdm_registry.db"))
+      return
+
+   def tearDown(self):
+      self.registry.close()
+      shutil.rmtree(self.directory)
+      return
+
+   def test_registry_record(self):
+      assert(self.registry.get("figshare", "https://api.figshare.com/v2", "PyRDM", "abc123") == (None, None))
+      self.registry.record("figshare", "https://api.figshare.com/v2", "PyRDM", "abc123", 42, "10.6084/m9.figshare.42")
+      assert(self.registry.get("figshare", "https://api.figshare.com/v2", "PyRDM", "abc123") == (42, "10.6084/m9.figshare.42"))
+      # Publications on other servers (e.g. the Zenodo sandbox) are kept apart.
+      assert(self.registry.get("figshare", "http://localhost:8000", "PyRDM", "abc123") == (None, None))
+
+      self.registry.forget("figshare", "https://api.figshare.com/v2", "PyRDM", "abc123")
+      assert(self.registry.get("figshare", "https://api.figshare.com/v2", "PyRDM", "abc123") == (None, None))
+
+   def test_registry_replace(self):
+      self.registry.record("zenodo", "https://zenodo.org/api/", "PyRDM", "deleted", 1, None)
+      assert(self.registry.last_synced("zenodo", "https://zenodo.org/api/") is None)
+      self.registry.replace("zenodo", "https://zenodo.org/api/", [("PyRDM", "abc123", 2, "10.5281/zenodo.2")])
+      assert(self.registry.get("zenodo", "https://zenodo.org/api/", "PyRDM", "deleted") == (None, None))
+      assert(self.registry.get("zenodo", "https://zenodo.org/api/", "PyRDM", "abc123") == (2, "10.5281/zenodo.2"))
+      assert(self.registry.last_synced("zenodo", "https://zenodo.org/api/") is not None)
+
+   def test_registry_parse_title(self):
+      assert(PublicationRegistry.parse_title("Fluidity (0123abcd)") == ("Fluidity", "0123abcd"))
+      assert(PublicationRegistry.parse_title("Some dataset") == (None, None))
+
+if(__name__ == '__main__'):
+   unittest.main()
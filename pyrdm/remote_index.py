@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import unittest
+
+_LOG = logging.getLogger(__name__)
+
+class RemoteFileIndex:
+   """ An index of the files in a publication on the server, keyed by file name. The index is built from a single listing of the
+   publication's files, and is then kept up-to-date as files are added and deleted, so that it never needs to be fetched again. """
+
+   def __init__(self, files, key):
+      """ Build the index from the list 'files' of file objects (dictionaries) returned by the service.
+      The file name is stored under 'key' in each file object (e.g. 'name' for Figshare, or 'filename' for Zenodo). """
+      self.key = key
+      self.lock = threading.Lock()
+      self.files = dict((f[key], f) for f in files)
+      return
+
+   def get(self, name):
+      """ Return the file object of the file called 'name', or None if there is no such file on the server. """
+      with self.lock:
+         return self.files.get(name)
+
+   def add(self, f):
+      """ Add (or replace) a file object, e.g. after the file has been uploaded. """
+      with self.lock:
+         self.files[f[self.key]] = f
+      return
+
+   def remove(self, name):
+      """ Remove the file called 'name', e.g. after it has been deleted from the server. """
+      with self.lock:
+         self.files.pop(name, None)
+      return
+
+   def __contains__(self, name):
+      with self.lock:
+         return name in self.files
+
+   def __len__(self):
+      with self.lock:
+         return len(self.files)
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's remote file index module. """
+
+   def setUp(self):
+      self.index = RemoteFileIndex([{"name": "a.txt", "id": 1}, {"name": "b.txt", "id": 2}], key="name")
+      return
+
+   def tearDown(self):
+      return
+
+   def test_remote_index(self):
+      assert(len(self.index) == 2)
+      assert(self.index.get("a.txt")["id"] == 1)
+      assert("c.txt" not in self.index)
+
+      self.index.remove("a.txt")
+      self.index.add({"name": "a.txt", "id": 3})
+      self.index.add({"name": "c.txt", "id": 4})
+      assert(self.index.get("a.txt")["id"] == 3)
+      assert("c.txt" in self.index)
+      assert(len(self.index) == 3)
+
+if(__name__ == '__main__'):
+   unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2014 Christian T. Jacobs, Alexandros Avdis, Gerard J. Gorman, Matthew D. Piggott.
+
+#    This file is part of PyRDM.
+
+#    PyRDM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    PyRDM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with PyRDM.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import unittest
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+_LOG = logging.getLogger(__name__)
+
+class Transport:
+   """ A pool of persistent (keep-alive) HTTP connections, shared by all requests made to the publishing services. """
+
+   def __init__(self, pool_size=10, timeout=60, retries=3, backoff_factor=0.5, cache=None, rate_limiter=None):
+      """ Set up a connection pool which keeps up to 'pool_size' connections open to each host.
+      Requests time out after 'timeout' seconds without a response from the server. Requests which fail to connect,
+      and idempotent requests (e.g. GET, PUT and DELETE) which fail with a server error, are retried up to 'retries' times,
+      waiting for an exponentially increasing multiple of 'backoff_factor' seconds between attempts. 
+      The responses to GET requests made with cached_get are stored in 'cache' (a pyrdm.http_cache.HTTPCache object), if given.
+      If a 'rate_limiter' (a pyrdm.rate_limit.RateLimiter object) is given, each request waits for its turn to be sent, and requests which are
+      refused because a service's rate limit has been reached (with a 429 response) are retried up to 'retries' times once the service allows it. """
+
+      self.timeout = timeout
+      self.retries = retries
+      self.cache = cache
+      self.rate_limiter = rate_limiter
+
+      # NOTE: Non-idempotent requests (e.g. POST, which is used to create articles) are only retried if the connection could not be made,
+      # since otherwise the request may have reached the server.
+      retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor, status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+      adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+      self.session = requests.Session()
+      self.session.mount("http://", adapter)
+      self.session.mount("https://", adapter)
+      return
+
+   def request(self, method, url, **kwargs):
+      """ Send an HTTP request using one of the pooled connections, and return the response (a requests.Response object).
+      The keyword arguments are the same as those of requests.request. """
+      kwargs.setdefault("timeout", self.timeout)
+      attempts = 0
+      while True:
+         if(self.rate_limiter is not None):
+            self.rate_limiter.acquire(url)
+         response = self.session.request(method, url, **kwargs)
+         _LOG.debug("%s %s returned response %d" % (method, url.split("?")[0], response.status_code))
+         if(self.rate_limiter is None):
+            return response
+         self.rate_limiter.update(url, response)
+         # A request refused with a 429 response has not been processed by the server, so it is safe to send it again (even if it is not idempotent),
+         # unless its body has already been read from a stream or file.
+         if(response.status_code != 429 or attempts >= self.retries or not is_replayable(kwargs)):
+            return response
+         attempts += 1
+
+   def get(self, url, **kwargs):
+      """ Send an HTTP GET request. """
+      return self.request("GET", url, **kwargs)
+
+   def cached_get(self, url, ttl=0, **kwargs):
+      """ Send an HTTP GET request, re-using a cached copy of the response where possible. A cached response which is less than 'ttl' seconds old
+      is returned without contacting the server. An older one is revalidated with a conditional request (using its ETag or Last-Modified header),
+      and is only downloaded again if it has changed. If this Transport has no cache, this is the same as get. """
+      if(self.cache is None):
+         return self.get(url, **kwargs)
+
+      key = self.cache.get_key(url, params=kwargs.get("params"), headers=kwargs.get("headers"))
+      entry = self.cache.get(key)
+      if(entry is not None):
+         metadata, content = entry
+         if(time.time() - metadata["stored"] < ttl):
+            return self._cached_response(url, content)
+         
+         # Ask the server to only send the response if it has changed.
+         headers = dict(kwargs.get("headers") or {})
+         if(metadata["etag"] is not None):
+            headers["If-None-Match"] = metadata["etag"]
+         if(metadata["last_modified"] is not None):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+         kwargs["headers"] = headers
+
+      response = self.get(url, **kwargs)
+      if(entry is not None and response.status_code == requests.codes.not_modified):
+         self.cache.touch(key)
+         return self._cached_response(url, content)
+      
+      if(response.status_code == requests.codes.ok):
+         etag = response.headers.get("ETag")
+         last_modified = response.headers.get("Last-Modified")
+         if(ttl > 0 or etag is not None or last_modified is not None):
+            self.cache.put(key, response.content, etag=etag, last_modified=last_modified)
+      return response
+
+   def _cached_response(self, url, content):
+      """ Return a requests.Response object containing a cached response. """
+      response = requests.Response()
+      response.status_code = requests.codes.ok
+      response.url = url
+      response._content = content
+      return response
+
+   def post(self, url, **kwargs):
+      """ Send an HTTP POST request. """
+      return self.request("POST", url, **kwargs)
+
+   def put(self, url, **kwargs):
+      """ Send an HTTP PUT request. """
+      return self.request("PUT", url, **kwargs)
+
+   def delete(self, url, **kwargs):
+      """ Send an HTTP DELETE request. """
+      return self.request("DELETE", url, **kwargs)
+
+   def close(self):
+      """ Close all the pooled connections. """
+      self.session.close()
+      return
+
+def is_replayable(kwargs):
+   """ Return True if the request with the keyword arguments 'kwargs' can be sent again, i.e. its body is not read from a stream or file. """
+   if(kwargs.get("files") is not None):
+      return False
+   data = kwargs.get("data")
+   return data is None or isinstance(data, (str, bytes, unicode, dict, list, tuple))
+
+class TestLog(unittest.TestCase):
+   """ Unit test suite for PyRDM's transport module. """
+
+   def setUp(self):
+      self.transport = Transport(pool_size=4, timeout=5, retries=2)
+      return
+
+   def tearDown(self):
+      self.transport.close()
+      return
+
+   def test_transport_pool(self):
+      # The same adapter (and therefore the same connection pool) is used for all requests.
+      adapter = self.transport.session.get_adapter("https://api.figshare.com/v2")
+      assert(adapter is self.transport.session.get_adapter("https://zenodo.org/api/"))
+      assert(adapter._pool_maxsize == 4)
+      assert(adapter.max_retries.total == 2)
+
+   def test_transport_rate_limit(self):
+      import os, tempfile, threading, BaseHTTPServer
+      from pyrdm.rate_limit import RateLimiter
+
+      class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+         """ Refuses the first request with a 429 response, and accepts the rest. """
+         requests = []
+         def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            Handler.requests.append(time.time())
+            status = 429 if len(Handler.requests) == 1 else 201
+            self.send_response(status)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+         def log_message(self, format, *args):
+            return
+
+      server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+      thread = threading.Thread(target=server.serve_forever)
+      thread.daemon = True
+      thread.start()
+      path = tempfile.mktemp(suffix=".json")
+      try:
+         transport = Transport(pool_size=1, timeout=5, retries=2, rate_limiter=RateLimiter(path))
+         response = transport.post("http://127.0.0.1:%d/articles" % server.server_port, data="{}")
+         # The request was retried once the server allowed it.
+         assert(response.status_code == 201)
+         assert(len(Handler.requests) == 2)
+         assert(Handler.requests[1] - Handler.requests[0] >= 0.9)
+         transport.close()
+      finally:
+         server.shutdown()
+         server.server_close()
+         if(os.path.exists(path)):
+            os.remove(path)
+
+if(__name__ == '__main__'):
+   unittest.main()
@@ -23,55 +23,125 @@ import unittest
 
 import requests
 import json
+import threading
+import hashlib
 
 from urllib2 import urlopen
-from urllib import urlencode
+from urllib import urlencode, quote
+
+from pyrdm.checksum import CHUNK_SIZE
+from pyrdm.transport import Transport
+from pyrdm.rate_limit import RateLimiter
+from pyrdm.auth_cache import AuthCache, AuthenticationError
+from pyrdm.pagination import paginate
 
 _LOG = logging.getLogger(__name__)
 
 class Zenodo:
    """ A Python interface to Zenodo via the Zenodo API. """
 
-   def __init__(self, access_token):
+   def __init__(self, access_token, transport=None, auth_cache=None, api_url="https://zenodo.org/api/"):
+      """ Set up the interface using the Zenodo access token 'access_token'. All requests are sent through the
+      connection pool 'transport' (a pyrdm.transport.Transport object), which can be shared with other services. 
+      The API is accessed at 'api_url', which only needs changing to use a different Zenodo instance (e.g. the Zenodo sandbox, or a stand-in server). """
       # The Zenodo authentication tokens.
       self.access_token = access_token
-      self.api_url = "https://zenodo.org/api/"
-
-      _LOG.info("Testing Zenodo authentication...")
-      try:
-         url = self.api_url + "deposit/depositions"
-         url = self._append_suffix(url)
-
-         response = requests.get(url)
-         _LOG.debug("Server returned response %d" % response.status_code)
-         if(response.status_code != requests.codes.ok): # If the status is not "OK", then exit here.
-            raise Exception("Could not authenticate with the Zenodo server.")
-         else:
-            _LOG.info("Authentication test successful.\n")
-      except:
-         _LOG.error("Could not authenticate with the Zenodo server. Check Internet connection? Check Zenodo authentication keys in ~/.config/pyrdm.ini ?")
-         sys.exit(1)
+      self.api_url = api_url.rstrip("/") + "/"
+
+      if(transport is None):
+         transport = Transport(rate_limiter=RateLimiter())
+      self.transport = transport
+
+      # The URLs of the file buckets of the depositions, keyed by deposition ID.
+      self.buckets = {}
+
+      # The access token is tested just before the first request is made, rather than here, so that setting up the interface is free.
+      # A record of recently-validated tokens is kept in 'auth_cache' (a pyrdm.auth_cache.AuthCache object) so that the test is not repeated on every run.
+      if(auth_cache is None):
+         auth_cache = AuthCache(os.path.expanduser("~/.cache/pyrdm/auth.json"))
+      self.auth_cache = auth_cache
+      self.authenticated = False
+      self.auth_lock = threading.Lock()
+      return
+
+   def authenticate(self):
+      """ Check that the access token is accepted by the Zenodo server, unless this has already been done recently. 
+      An AuthenticationError is raised if it is not. """
+      if(self.authenticated):
+         return
+      with self.auth_lock:
+         if(self.authenticated):
+            return
+         if(self.auth_cache.is_valid("zenodo", self.access_token)):
+            _LOG.debug("Zenodo access token was validated recently.")
+            self.authenticated = True
+            return
+
+         _LOG.info("Testing Zenodo authentication...")
+         try:
+            url = self.api_url + "deposit/depositions"
+            url = self._append_suffix(url)
+
+            response = self.transport.get(url)
+            _LOG.debug("Server returned response %d" % response.status_code)
+            if(response.status_code != requests.codes.ok): # If the status is not "OK", then exit here.
+               raise Exception("Could not authenticate with the Zenodo server.")
+            else:
+               _LOG.info("Authentication test successful.\n")
+         except Exception:
+            raise AuthenticationError("Could not authenticate with the Zenodo server. Check Internet connection? Check Zenodo authentication keys in ~/.config/pyrdm.ini ?")
+
+         self.auth_cache.record("zenodo", self.access_token)
+         self.authenticated = True
       return
 
+   def request(self, method, url, cached=False, **kwargs):
+      """ Send an HTTP request to Zenodo through the connection pool and return the response, testing the access token first if necessary.
+      If 'cached' is True, the response to a GET request is cached, and any cached copy is revalidated with the server. """
+      self.authenticate()
+      if(method == "GET" and cached):
+         response = self.transport.cached_get(url, **kwargs)
+      else:
+         response = self.transport.request(method, url, **kwargs)
+      if(response.status_code == requests.codes.unauthorized):
+         # The token has been revoked since it was validated.
+         self.auth_cache.forget("zenodo", self.access_token)
+         raise AuthenticationError("Could not authenticate with the Zenodo server. Check Zenodo authentication keys in ~/.config/pyrdm.ini ?")
+      return response
+
    def _append_suffix(self, url):
       return url + "?access_token=" + self.access_token
 
    # -------------------------------------------
    # Methods for depositions
    # -------------------------------------------
-   def list_depositions(self):
-      """ Lists all depositions on Zenodo (associated with the user's account). """
+   def list_depositions(self, page=None, size=100, query=None):
+      """ Lists the depositions on Zenodo (associated with the user's account). If a page number (counting from 1) is given, only that page 
+      of 'size' depositions is returned. Otherwise, all the depositions are returned (see iter_depositions). If a search query is given 
+      (e.g. 'keywords:"1.0"', using Elasticsearch's query syntax), only the depositions which match it are listed. """
+
+      if(page is None):
+         return list(self.iter_depositions(size=size, query=query))
 
       url = self.api_url + "deposit/depositions"
       url = self._append_suffix(url)
+      parameters = [("page", page), ("size", size)]
+      if(query is not None):
+         parameters.append(("q", query))
+      url += "&" + urlencode(parameters)
 
-      response = requests.get(url)
+      response = self.request("GET", url, cached=True) # Revalidate any cached copy of the response.
       results = json.loads(response.content)
       
       response.raise_for_status()
       
       return results
 
+   def iter_depositions(self, size=100, prefetch=False, query=None):
+      """ Iterate over the depositions associated with the user's account (or, if a search query is given, those which match it), fetching 'size' 
+      depositions at a time as they are needed. If 'prefetch' is True, the next page is fetched in the background. See pyrdm.pagination.paginate. """
+      return paginate(lambda page, size: self.list_depositions(page=page, size=size, query=query), page_size=size, prefetch=prefetch)
+
    def create_deposition(self, title, description, upload_type, creators, keywords, prereserve_doi):
       """ Creates a new deposition on Zenodo. Requires a title, description and upload_type (e.g. software, dataset). 
       Returns a dictionary of information about the created publication. """
@@ -82,8 +152,10 @@ class Zenodo:
       headers = {"content-type": "application/json"}
       data = {"metadata": {"title": title, "description": description, "upload_type": upload_type, "creators": creators, "keywords": keywords, "prereserve_doi": prereserve_doi}}
 
-      response = requests.post(url, data=json.dumps(data), headers=headers)
+      response = self.request("POST", url, data=json.dumps(data), headers=headers)
       results = json.loads(response.content)
+      if("links" in results and "bucket" in results["links"]):
+         self.buckets[results["id"]] = results["links"]["bucket"]
       return results
 
    def retrieve_deposition(self, deposition_id):
@@ -92,7 +164,7 @@ class Zenodo:
       url = self.api_url + "deposit/depositions/%d" % deposition_id
       url = self._append_suffix(url)
 
-      response = requests.get(url)
+      response = self.request("GET", url, cached=True) # Revalidate any cached copy of the response.
       results = json.loads(response.content)
       return results
 
@@ -105,7 +177,7 @@ class Zenodo:
       headers = {"content-type": "application/json"}
       data = {"metadata": {"title": title, "description": description, "upload_type": upload_type, "state": state}}
 
-      response = requests.put(url, data=json.dumps(data), headers=headers)
+      response = self.request("PUT", url, data=json.dumps(data), headers=headers)
       results = json.loads(response.content)
       return results
 
@@ -115,7 +187,7 @@ class Zenodo:
       url = self.api_url + "deposit/depositions/%d" % deposition_id
       url = self._append_suffix(url)
 
-      response = requests.delete(url)
+      response = self.request("DELETE", url)
       response.raise_for_status()
       return
 
@@ -129,22 +201,108 @@ class Zenodo:
       url = self.api_url + "deposit/depositions/%d/files" % deposition_id
       url = self._append_suffix(url)
 
-      response = requests.get(url)
+      response = self.request("GET", url, cached=True) # Revalidate any cached copy of the response.
       results = json.loads(response.content)
       return results
 
-   def create_file(self, deposition_id, file_path):
-      """ Creates a new deposition on Zenodo.  """
+   def iter_files(self, deposition_id):
+      """ Iterate over the files in a given deposition on Zenodo. Zenodo lists all of a deposition's files in a single response
+      (rather than in pages), so this is equivalent to iterating over list_files. """
+      for f in self.list_files(deposition_id):
+         yield f
+
+   def get_bucket_url(self, deposition_id):
+      """ Return the URL of the file bucket of a deposition (with a given deposition_id), or None if the deposition does not have one. """
+      if(deposition_id not in self.buckets):
+         results = self.retrieve_deposition(deposition_id)
+         bucket_url = results.get("links", {}).get("bucket")
+         if(bucket_url is None):
+            return None
+         self.buckets[deposition_id] = bucket_url
+      return self.buckets[deposition_id]
+
+   def create_file(self, deposition_id, file_path, md5=None, stream=False):
+      """ Uploads a file with path 'file_path' to a deposition (with a given deposition_id) on Zenodo, as a multipart/form-data request,
+      and returns a dictionary of information about the deposition file (its 'id', 'filename', 'filesize' and 'checksum').
+      If 'stream' is True (and the deposition has a file bucket), the file is streamed in chunks into the deposition's file bucket instead, 
+      so the memory used does not depend on the size of the file. Note that the bucket's response is returned in that case (see upload_to_bucket), 
+      which gives the file's 'key', 'version_id' and 'checksum' (in the form "md5:<checksum>"), but not its ID in the deposition.
+      If the file's MD5 checksum is given in 'md5', it is compared against the checksum of the uploaded file reported by Zenodo. """
+
+      if(stream):
+         bucket_url = self.get_bucket_url(deposition_id)
+         if(bucket_url is not None):
+            return self.upload_to_bucket(bucket_url, file_path, md5=md5)
 
       url = self.api_url + "deposit/depositions/%d/files" % deposition_id
       url = self._append_suffix(url)
 
       headers = {"content-type": "multipart/form-data"}
       data = {'filename': os.path.basename(file_path)}
-      files = {'file': open(file_path, 'rb')}
+      with open(file_path, 'rb') as f:
+         files = {'file': f}
+         response = self.request("POST", url, data=data, files=files)
+      results = json.loads(response.content)
+      if(md5 is not None and "checksum" in results and results["checksum"] != md5):
+         raise Exception("The checksum of the uploaded file %s (%s) does not match the local checksum (%s)." % (file_path, results["checksum"], md5))
+      return results
+
+   def upload_to_bucket(self, bucket_url, file_path, md5=None):
+      """ Streams a file with path 'file_path' into the file bucket with URL 'bucket_url'. The file is sent in chunks as it is read.
+      If the file's MD5 checksum is given in 'md5', it is compared against the checksum of the uploaded file reported by Zenodo.
+      Returns a dictionary of information about the uploaded file. """
+
+      url = bucket_url + "/" + quote(os.path.basename(file_path))
+      url = self._append_suffix(url)
+
+      headers = {"content-type": "application/octet-stream"}
+      with open(file_path, 'rb') as f:
+         # NOTE: Passing the file object itself (rather than its contents) means that the request body is read and sent a block at a time.
+         response = self.request("PUT", url, data=f, headers=headers)
+      response.raise_for_status()
+      results = json.loads(response.content)
+      
+      # The bucket reports checksums in the form "md5:<checksum>".
+      checksum = results.get("checksum", "").split(":")[-1]
+      if(md5 is not None and checksum != "" and checksum != md5):
+         raise Exception("The checksum of the uploaded file %s (%s) does not match the local checksum (%s)." % (file_path, checksum, md5))
+      return results
 
-      response = requests.post(url, data=data, files=files)
+   def create_file_from_stream(self, deposition_id, name, stream):
+      """ Uploads the data read from the file-like object 'stream' to a deposition (with a given deposition_id) on Zenodo, as a file called 'name'.
+      The data is streamed into the deposition's file bucket as it is read, so its size does not need to be known in advance.
+      Returns a dictionary of information about the uploaded file. """
+      bucket_url = self.get_bucket_url(deposition_id)
+      if(bucket_url is None):
+         raise Exception("Deposition %d does not have a file bucket, so %s cannot be streamed into it." % (deposition_id, name))
+      return self.upload_stream_to_bucket(bucket_url, name, stream)
+
+   def upload_stream_to_bucket(self, bucket_url, name, stream):
+      """ Streams the data read from the file-like object 'stream' into the file bucket with URL 'bucket_url', as a file called 'name'. 
+      The MD5 checksum of the data is computed as it is sent, and compared against the checksum of the uploaded file reported by Zenodo.
+      Returns a dictionary of information about the uploaded file. """
+
+      url = bucket_url + "/" + quote(name)
+      url = self._append_suffix(url)
+
+      # NOTE: The request body is given as a generator, so it is sent using chunked transfer encoding as the data is read.
+      checksum = hashlib.md5()
+      def chunks():
+         while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if(not chunk):
+               break
+            checksum.update(chunk)
+            yield chunk
+
+      headers = {"content-type": "application/octet-stream"}
+      response = self.request("PUT", url, data=chunks(), headers=headers)
+      response.raise_for_status()
       results = json.loads(response.content)
+
+      md5 = checksum.hexdigest()
+      if(results.get("checksum", "").split(":")[-1] not in ("", md5)):
+         raise Exception("The checksum of the uploaded file %s (%s) does not match the local checksum (%s)." % (name, results["checksum"], md5))
       return results
 
    def sort_files(self, deposition_id, file_ids):
@@ -158,17 +316,17 @@ class Zenodo:
       for file_id in file_ids:
          data.append({"id":file_id})
 
-      response = requests.put(url, data=json.dumps(data), headers=headers)
+      response = self.request("PUT", url, data=json.dumps(data), headers=headers)
       results = json.loads(response.content)
       return results
 
    def retrieve_file(self, deposition_id, file_id):
       """ Retrieve details about a file (with a given file_id) in a deposition (with a given deposition_id) on Zenodo. """
 
-      url = self.api_url + "deposit/depositions/%d/files/%d" % (deposition_id, file_id)
+      url = self.api_url + "deposit/depositions/%d/files/%s" % (deposition_id, file_id)
       url = self._append_suffix(url)
 
-      response = requests.get(url)
+      response = self.request("GET", url)
       results = json.loads(response.content)
       return results
 
@@ -176,25 +334,26 @@ class Zenodo:
       """ Updates a file (with a given file_id) in a deposition (with a given deposition_id) on Zenodo. 
           Currently this is only used to rename an existing file on the Zenodo servers. """
 
-      url = self.api_url + "deposit/depositions/%d/files/%d" % (deposition_id, file_id)
+      url = self.api_url + "deposit/depositions/%d/files/%s" % (deposition_id, file_id)
       url = self._append_suffix(url)
 
       headers = {"content-type": "application/json"}
       data = {"filename": new_file_name}
 
-      response = requests.get(url, data=json.dumps(data), headers=headers)
+      response = self.request("GET", url, data=json.dumps(data), headers=headers)
       results = json.loads(response.content)
       return results
 
    def delete_file(self, deposition_id, file_id):
       """ Deletes a file (with a given file_id) in a deposition (with a given deposition_id) on Zenodo. """
 
-      url = self.api_url + "deposit/depositions/%d/files/%d" % (deposition_id, file_id)
+      # NOTE: File IDs are strings (UUIDs), not integers.
+      url = self.api_url + "deposit/depositions/%d/files/%s" % (deposition_id, file_id)
       url = self._append_suffix(url)
 
-      response = requests.delete(url)
-      results = json.loads(response.content)
-      return results
+      response = self.request("DELETE", url)
+      response.raise_for_status() # The server responds with '204 No Content', so there is nothing to return.
+      return
 
    # -------------------------------------------
    # Methods for deposition actions
@@ -205,7 +364,7 @@ class Zenodo:
       url = self.api_url + "deposit/depositions/%d/actions/publish" % deposition_id
       url = self._append_suffix(url)
 
-      response = requests.post(url)
+      response = self.request("POST", url)
       results = json.loads(response.content)
       return results
 
@@ -215,7 +374,7 @@ class Zenodo:
       url = self.api_url + "deposit/depositions/%d/actions/edit" % deposition_id
       url = self._append_suffix(url)
 
-      response = requests.post(url)
+      response = self.request("POST", url)
       results = json.loads(response.content)
       return results
 
@@ -225,7 +384,7 @@ class Zenodo:
       url = self.api_url + "deposit/depositions/%d/actions/discard" % deposition_id
       url = self._append_suffix(url)
 
-      response = requests.post(url)
+      response = self.request("POST", url)
       results = json.loads(response.content)
       return results
 
@@ -263,6 +422,19 @@ class TestLog(unittest.TestCase):
       _LOG.debug(str(results))
       assert(results["filename"] == "test_file.txt")
       return
+
+   def test_zenodo_create_file_stream(self):
+      _LOG.info("Creating test file...")
+      
+      f = open("test_file.txt", "w")
+      f.write("This is a test file for PyRDM's Zenodo module unit tests")
+      f.close()
+      
+      results = self.zenodo.create_file(self.deposition_id, "test_file.txt", stream=True)
+      _LOG.debug(str(results))
+      assert(results["key"] == "test_file.txt")
+      assert(results["checksum"] == "md5:f20660e6d57ca3a191cb773b52184aa5")
+      return
  
 if(__name__ == '__main__'):
    unittest.main()